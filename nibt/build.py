@@ -1,22 +1,44 @@
+import collections
+import functools
 import logging
 import os
 import glob
+import queue
 import subprocess
+import threading
+import time
+
+from nibt import common, metrics, trace, utils
+
+_target_builds = metrics.registry.Counter(
+        "ni_target_builds_total",
+        "Target builds by status: ok, failed, restored or cancelled",
+        ["target", "status"])
+_target_build_duration = metrics.registry.Histogram(
+        "ni_target_build_duration_seconds",
+        "Build time of a target, excluding restores from the saved state",
+        ["target"])
 
 class BuildingContext(object):
-    def __init__(self, targets, build_results):
+    def __init__(self, target_name, targets, build_results, cancellation,
+                 on_output):
+        self.target_name = target_name
         self.build_results = build_results
         self.targets = targets
+        self.cancellation = cancellation
+        self.on_output = on_output
 
 
 class Builder(object):
-    def __init__(self, configuration, targets_state):
+    def __init__(self, configuration, targets_state, state_store):
         self.targets_state = targets_state
+        self.state_store = state_store
         self.build_results = {}
         self.root = configuration.GetExpandedDir("projects", "root_dir")
         self.builders = {}
         self.build_start_handlers = []
         self.build_finish_handlers = []
+        self.build_output_handlers = []
 
     def AddBuildStartHandler(self, handler):
         self.build_start_handlers.append(handler)
@@ -24,6 +46,13 @@ class Builder(object):
     def AddBuildFinishHandler(self, handler):
         self.build_finish_handlers.append(handler)
 
+    def AddBuildOutputHandler(self, handler):
+        self.build_output_handlers.append(handler)
+
+    def _OnBuildOutput(self, target_name, stream_name, text):
+        for output_handler in self.build_output_handlers:
+            output_handler(target_name, stream_name, text)
+
     def RegisterBuilder(self, builder):
         # Class must be in module
         class_name = "%s.%s" % (
@@ -44,8 +73,10 @@ class Builder(object):
         builder = self.builders[definition.builder]
         return builder.GetCompilationFlags(target)  
 
-    def Build(self, target_name):
+    def Build(self, target_name, cancellation=None):
         logging.info("Building %s", target_name)
+        if cancellation is None:
+            cancellation = utils.CancellationToken()
         target = self.targets_state.targets[target_name]
         definition =  target.GetModuleDefinition()
         logging.info("Building definition %s", definition)
@@ -53,12 +84,36 @@ class Builder(object):
 
         logging.info("Picked %s for id %s ", builder, definition.builder)
         
-        context = BuildingContext(self.targets_state.targets,
-                self.build_results)
+        context = BuildingContext(target_name, self.targets_state.targets,
+                self.build_results, cancellation,
+                functools.partial(self._OnBuildOutput, target_name))
         
         for start_handler in self.build_start_handlers:
             start_handler(target_name)
-        result = builder.Build(context, target_name)
+        result = None
+        if target_name not in self.build_results:
+            # First build since the daemon started, previous outputs
+            # can be reused if their inputs did not change
+            with trace.Span("Restore", category="build", target=target_name):
+                result = builder.Restore(context, target_name)
+            if result is not None:
+                logging.info("Restored %s from saved build state", target_name)
+        if result is not None:
+            status = "restored"
+        else:
+            started = time.time()
+            with trace.Span("Build", category="build", target=target_name):
+                result = builder.Build(context, target_name)
+            _target_build_duration.Observe(time.time() - started,
+                                           target=target_name)
+            status = "ok" if all(r.ok() for r in result) else "failed"
+        if cancellation.IsCancelled():
+            logging.info("Build of %s was cancelled, discarding %s",
+                         target_name, result)
+            _target_builds.Inc(target=target_name, status="cancelled")
+            self.SetCancelledResult(target_name)
+            return
+        _target_builds.Inc(target=target_name, status=status)
         for finish_handler in self.build_finish_handlers:
             finish_handler(target_name, result)
 
@@ -66,71 +121,250 @@ class Builder(object):
         self.build_results[target_name] = result
         logging.info("All results: %s", self.build_results)
     
+    def SetFailedResult(self, target_name, result):
+        logging.info("Result for %s: %s", target_name, result)
+        for finish_handler in self.build_finish_handlers:
+            finish_handler(target_name, result)
+        self.build_results[target_name] = result
+
+    def SetCancelledResult(self, target_name):
+        # Ends the started build for the handlers, the previous result is kept
+        for finish_handler in self.build_finish_handlers:
+            finish_handler(target_name,
+                           [common.CancelledBuildResult(target_name)])
+
     def GetBuildResult(self, target_name):
         return self.build_results[target_name]
 
+    def RemoveTargetState(self, target_name):
+        # Saved state of a target that is not tracked anymore
+        target = self.targets_state.targets[target_name]
+        definition = target.GetModuleDefinition()
+        self.builders[definition.builder].RemoveTargetState(target_name)
+
+    def SaveState(self):
+        self.state_store.Flush()
+
 class TargetsState(object):
     def __init__(self):
         self.targets = {}
 
 class BuildTracker(object):
     def __init__(self, graph, targets_state, builder, compilation_database,
-            threading_manager):
+            threading_manager, trace_store):
         self.targets_state = targets_state
+        self.trace_store = trace_store
         self.threading_manager = threading_manager
         self.modified = set()
         self.graph = graph
         self.builder = builder
         self.compilation_database = compilation_database
+        # Guards the scheduling state below, which is shared by the build
+        # loop and the threads reporting changes
+        self._lock = threading.RLock()
+        self._idle = threading.Condition(self._lock)
+        self._building = False
+        self._in_flight = {}
+        # Dependencies of the targets as of their invalidation, the build
+        # loop does not read the graph while it is being changed
+        self._dependencies = {}
+        self._waiting_for = {}
+        self._dependents = {}
+        self._ready = collections.deque()
+        self._schedule_dirty = True
+        self._events = queue.Queue()
 
     def GetBuildResult(self, target_name):
         return self.builder.GetBuildResult(target_name)
 
     def AddTarget(self, target):
-        self.targets_state.targets[target.GetName()] = target
-        self.modified.add(target.GetName())
+        with self._lock:
+            self.targets_state.targets[target.GetName()] = target
+            self._Invalidate(target.GetName())
     
     def RemoveTarget(self, target_name):
-        del self.targets_state.targets[target_name]
-        if target_name in self.modified:
-            self.modified.remove(target_name)
+        with self._lock:
+            self.builder.RemoveTargetState(target_name)
+            del self.targets_state.targets[target_name]
+            self.modified.discard(target_name)
+            self._dependencies.pop(target_name, None)
+            if target_name in self._in_flight:
+                self._in_flight[target_name].Cancel()
+            self._schedule_dirty = True
 
     def ReloadTarget(self, target):
-        self.targets_state.targets[target.GetName()] = target
-        self.modified.add(target.GetName())
+        with self._lock:
+            self.targets_state.targets[target.GetName()] = target
+            self._Invalidate(target.GetName())
 
     def ResetTarget(self, target_name):
-        self.modified.add(target_name)
+        with self._lock:
+            self._Invalidate(target_name)
        
     def GetTarget(self, target_name):
         return self.targets_state.targets[target_name]
 
-    def Build(self):
+    def _Invalidate(self, target_name):
+        self._dependencies[target_name] = set(
+                self.graph.GetDependencies(target_name))
+        self.modified.add(target_name)
+        self._schedule_dirty = True
+        if target_name in self._in_flight:
+            logging.info("Build of %s is stale, cancelling", target_name)
+            self._in_flight[target_name].Cancel()
+        if self._building:
+            self._events.put(None)
+
+    def _GetFailedDependencies(self, target_name):
+        failed = []
+        for dependency in sorted(self._dependencies.get(target_name, ())):
+            for result in self.builder.build_results.get(dependency, []):
+                if not result.ok():
+                    failed.append(result)
+        return failed
+
+    def _RebuildSchedule(self):
+        blocking = self.modified.union(self._in_flight)
+        self._waiting_for = {}
+        self._dependents = collections.defaultdict(set)
+        for target_name in self.modified:
+            dependencies = self._dependencies.get(target_name, set())
+            logging.info("Deps of %s are %s", target_name, dependencies)
+            self._waiting_for[target_name] = blocking.intersection(dependencies)
+            for dependency in self._waiting_for[target_name]:
+                self._dependents[dependency].add(target_name)
+        self._ready = collections.deque(sorted(
+            target_name for target_name, dependencies in self._waiting_for.items()
+            if not dependencies))
+        self._schedule_dirty = False
+
+    def _OnTargetDone(self, target_name):
+        for dependent in sorted(self._dependents.pop(target_name, [])):
+            if dependent not in self._waiting_for:
+                continue
+            self._waiting_for[dependent].discard(target_name)
+            if not self._waiting_for[dependent]:
+                self._ready.append(dependent)
+
+    def _StartReadyTargets(self, executor):
+        while self._ready:
+            target_name = self._ready.popleft()
+            if (target_name not in self.modified or
+                    target_name in self._in_flight):
+                continue
+            self.modified.remove(target_name)
+            del self._waiting_for[target_name]
+            failed_dependencies = self._GetFailedDependencies(target_name)
+            if failed_dependencies:
+                logging.info("Skipping %s, dependencies failed", target_name)
+                self.builder.SetFailedResult(target_name, [
+                    common.FailedBuildResult("Cannot build "+target_name,
+                        failed_dependencies)])
+                self._OnTargetDone(target_name)
+                continue
+            logging.info("Starting build of %s", target_name)
+            cancellation = utils.CancellationToken()
+            self._in_flight[target_name] = cancellation
+            future = executor.submit(
+                    self._BuildTarget, target_name, cancellation, trace.Now())
+            future.add_done_callback(functools.partial(
+                self._OnBuildCompleted, target_name, cancellation))
+
+    def _BuildTarget(self, target_name, cancellation, submitted):
+        trace.AddSpan("Queued", submitted, category="queue",
+                      target=target_name, pool="wave")
+        self.builder.Build(target_name, cancellation)
+
+    def _OnBuildCompleted(self, target_name, cancellation, future):
+        self._events.put((target_name, cancellation, future))
+
+    def _RunBuildLoop(self):
+        executor = self.threading_manager.GetThreadPool("wave")
+        while True:
+            with self._lock:
+                if self._schedule_dirty:
+                    self._RebuildSchedule()
+                self._StartReadyTargets(executor)
+                if not self._in_flight:
+                    if self.modified:
+                        logging.warning("Some targets cannot be built %s",
+                                sorted(self.modified))
+                    self.modified = set()
+                    return
+            event = self._events.get()
+            if event is None:
+                continue
+            target_name, cancellation, future = event
+            try:
+                future.result()
+            except Exception as e:
+                if cancellation.IsCancelled():
+                    self.builder.SetCancelledResult(target_name)
+                else:
+                    logging.exception("Building %s failed", target_name)
+                    self.builder.SetFailedResult(target_name, [
+                        common.FailedBuildResult(
+                            "Cannot build %s: %s" % (target_name, e))])
+            with self._lock:
+                if self._in_flight.get(target_name) is cancellation:
+                    del self._in_flight[target_name]
+                if cancellation.IsCancelled():
+                    # Restarted with fresh inputs once its dependencies allow
+                    self._schedule_dirty = True
+                else:
+                    self._OnTargetDone(target_name)
+
+    def _RunBuildRound(self):
         logging.info("Must build %s", sorted(self.modified))
-        while self.modified:
-            logging.info("Modified %s", self.modified)
-            ready_to_build = set()
-            for target_name in self.modified:
-                dependencies = self.graph.GetDependencies(target_name)
-                logging.info("Deps of %s are %s", target_name, dependencies)
-                if not self.modified.intersection(dependencies):
-                    ready_to_build.add(target_name)
-            if ready_to_build:
-                logging.info("Building wave %s", sorted(ready_to_build))
-                executor = self.threading_manager.GetThreadPool("wave")
-                completion_futures = []
-                for ready_to_build_target_name in ready_to_build:
-                    result = executor.submit(
-                            lambda: self.builder.Build(ready_to_build_target_name))
-                    completion_futures.append(result)
-                for completion_future in completion_futures:
-                    completion_future.result()
-
-                self.modified = self.modified - ready_to_build
-            else:
-                if self.modified:
-                    logging.warning("Some targets cannot be built %s",
-                            sorted(self.modified))
-                break
-        self.modified = set()
+        with trace.Span("BuildTargets", category="build",
+                        targets=len(self.modified)):
+            self._RunBuildLoop()
+        logging.info("Job slots usage: %s",
+                     self.threading_manager.job_slots.GetUsage())
         self.compilation_database.Write()
+        with trace.Span("SaveState", category="build"):
+            self.builder.SaveState()
+
+    def _CutTrace(self):
+        try:
+            trace_id = self.trace_store.CutTrace("build")
+        except Exception:
+            logging.exception("Unable to cut the build trace")
+            return
+        if trace_id is not None:
+            logging.info("Build trace %d is available", trace_id)
+
+    def _RunBuild(self):
+        while True:
+            failed = False
+            try:
+                self._RunBuildRound()
+            except Exception:
+                logging.exception("Build loop failed")
+                failed = True
+            with self._lock:
+                if self.modified and not failed:
+                    continue
+            self._CutTrace()
+            # Changes reported while the trace was cut see _building set and
+            # rely on this loop to build them
+            with self._lock:
+                if failed or not self.modified:
+                    self._building = False
+                    self._idle.notify_all()
+                    return
+
+    def StartBuild(self):
+        with self._lock:
+            if self._building:
+                # The running build loop picks up the new changes
+                self._events.put(None)
+                return
+            self._building = True
+        self.threading_manager.GetThreadPool("build").submit(self._RunBuild)
+
+    def Build(self):
+        self.StartBuild()
+        with self._lock:
+            while self._building:
+                self._idle.wait()
@@ -0,0 +1,166 @@
+import unittest
+
+from nibt import build, common, thread_pools
+import threading
+import time
+
+class FakeConfiguration(object):
+    def Get(self, section, key, raise_exception=True, default=None):
+        return "4"
+
+class FakeGraph(object):
+    def __init__(self, deps):
+        self.deps = deps
+
+    def GetDependencies(self, target_name):
+        return self.deps[target_name]
+
+class FakeCompilationDatabase(object):
+    def Write(self):
+        pass
+
+class FakeTraceStore(object):
+    def __init__(self):
+        self.on_cut = None
+
+    def CutTrace(self, name):
+        on_cut, self.on_cut = self.on_cut, None
+        if on_cut is not None:
+            on_cut()
+        return None
+
+class FakeBuilder(object):
+    def __init__(self, durations, failing):
+        self.durations = durations
+        self.failing = failing
+        self.build_results = {}
+        self.events = []
+        self.lock = threading.Lock()
+
+    def Build(self, target_name, cancellation):
+        with self.lock:
+            self.events.append(("start", target_name))
+        deadline = time.time() + self.durations.get(target_name, 0)
+        while time.time() < deadline and not cancellation.IsCancelled():
+            time.sleep(0.01)
+        if cancellation.IsCancelled():
+            with self.lock:
+                self.events.append(("cancel", target_name))
+            return
+        if target_name in self.failing:
+            result = [common.FailedBuildResult("failed "+target_name)]
+        else:
+            result = [common.SuccessfulBuildResult()]
+        with self.lock:
+            self.events.append(("finish", target_name))
+            self.build_results[target_name] = result
+
+    def SetFailedResult(self, target_name, result):
+        with self.lock:
+            self.events.append(("skip", target_name))
+            self.build_results[target_name] = result
+
+    def SetCancelledResult(self, target_name):
+        with self.lock:
+            self.events.append(("cancelled", target_name))
+
+    def SaveState(self):
+        pass
+
+class BuildTrackerTest(unittest.TestCase):
+    def CreateTracker(self, deps, durations={}, failing=set()):
+        self.builder = FakeBuilder(durations, failing)
+        self.trace_store = FakeTraceStore()
+        self.threading_manager = thread_pools.ThreadingManager(
+                FakeConfiguration())
+        tracker = build.BuildTracker(
+                FakeGraph(deps), build.TargetsState(), self.builder,
+                FakeCompilationDatabase(), self.threading_manager,
+                self.trace_store)
+        for target_name in deps:
+            tracker.ResetTarget(target_name)
+        return tracker
+
+    def tearDown(self):
+        self.threading_manager.Join()
+
+    def testDependenciesAreBuiltFirst(self):
+        deps = {
+            "bin": set(["a", "b"]),
+            "a": set(["c"]),
+            "b": set(["c"]),
+            "c": set(),
+        }
+        self.CreateTracker(deps).Build()
+        events = self.builder.events
+        self.assertEqual(4, len([e for e in events if e[0] == "start"]))
+        for target_name, dependencies in deps.items():
+            for dependency in dependencies:
+                self.assertLess(events.index(("finish", dependency)),
+                                events.index(("start", target_name)))
+
+    def testIndependentTargetIsNotStalled(self):
+        deps = {
+            "slow": set(),
+            "fast": set(),
+            "after_fast": set(["fast"]),
+        }
+        self.CreateTracker(deps, durations={"slow": 0.3}).Build()
+        events = self.builder.events
+        self.assertLess(events.index(("finish", "after_fast")),
+                        events.index(("finish", "slow")))
+
+    def testTargetIsSkippedWhenDependencyFailed(self):
+        deps = {
+            "bin": set(["lib"]),
+            "lib": set(),
+        }
+        self.CreateTracker(deps, failing=set(["lib"])).Build()
+        self.assertIn(("skip", "bin"), self.builder.events)
+        self.assertNotIn(("start", "bin"), self.builder.events)
+        self.assertFalse(self.builder.build_results["bin"][0].ok())
+
+    def testStaleBuildIsRestarted(self):
+        deps = {
+            "bin": set(["lib"]),
+            "lib": set(),
+        }
+        tracker = self.CreateTracker(deps, durations={"lib": 0.5})
+        tracker.StartBuild()
+        while ("start", "lib") not in self.builder.events:
+            time.sleep(0.01)
+        tracker.ResetTarget("lib")
+        tracker.Build()
+        events = self.builder.events
+        self.assertEqual([("start", "lib"), ("cancel", "lib"), ("start", "lib"),
+                          ("finish", "lib"), ("start", "bin"), ("finish", "bin")],
+                         events)
+
+    def testScheduleDoesNotReadChangingGraph(self):
+        deps = {
+            "bin": set(["lib"]),
+            "lib": set(),
+        }
+        tracker = self.CreateTracker(deps)
+        # Targets removed from the graph while the build loop runs
+        deps.clear()
+        tracker.Build()
+        events = self.builder.events
+        self.assertLess(events.index(("finish", "lib")),
+                        events.index(("start", "bin")))
+
+    def testChangeDuringShutdownIsBuilt(self):
+        deps = {"a": set()}
+        tracker = self.CreateTracker(deps)
+        def StartBuildOfB():
+            deps["b"] = set()
+            tracker.ResetTarget("b")
+            tracker.StartBuild()
+        # Reported after the last round, before the loop stopped
+        self.trace_store.on_cut = StartBuildOfB
+        tracker.Build()
+        self.assertIn(("finish", "b"), self.builder.events)
+        self.assertEqual(set(), tracker.modified)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -33,6 +33,10 @@ class FailedBuildResult(object):
     def __str__(self):
         return "FailedBuildResult(%s)" % self.GetErrorMessage()
 
+class CancelledBuildResult(FailedBuildResult):
+    def __init__(self, target_name):
+        FailedBuildResult.__init__(self, "Build of %s was cancelled" % target_name)
+
 class Error(Exception):
     pass
 
@@ -1,6 +1,9 @@
 import os
 import json
 import logging
+import threading
+
+from nibt import trace, utils
 
 class DbEntry(object):
     def __init__(self, root, command, file_path):
@@ -31,11 +34,18 @@ def DbEntryDecoder(dct):
     return dct
 
 class Database(object):
-    def __init__(self, configuration):
+    def __init__(self, configuration, threading_manager):
         self._root = configuration.GetExpandedDir("projects","root_dir")
         self._compile_commands_file_path = os.path.join(
                 self._root, "compile_commands.json")
+        self._threading_manager = threading_manager
         self._database = {}
+        self._lock = threading.Lock()
+        # Serializes writers so that a newer snapshot is never overwritten
+        # by an older one
+        self._write_lock = threading.Lock()
+        self._dirty = False
+        self._write_scheduled = False
         self._LoadDatabase()
 
     def _LoadDatabase(self):
@@ -54,19 +64,69 @@ class Database(object):
                                 "making empty database...")
 
     def _CleanFromNonExisting(self):
+        # Only done on load, deletions while running come from the watcher
         new_database = {}
         for _, entry in self._database.items():
             if entry.FileExists():
                 new_database[entry.file_path] = entry
+        if len(new_database) != len(self._database):
+            self._dirty = True
         self._database = new_database
 
     def SubmitCommand(self, file_name, command):
-        self._database[file_name] = DbEntry(self._root, command, file_name)
+        with self._lock:
+            entry = self._database.get(file_name)
+            if entry is not None and entry.command == command:
+                return
+            self._database[file_name] = DbEntry(self._root, command, file_name)
+            self._dirty = True
+
+    def RemoveCommands(self, file_names):
+        # Sources dropped from their targets, or of removed targets
+        with self._lock:
+            removed = [file_name for file_name in file_names
+                       if file_name in self._database]
+            for file_name in removed:
+                del self._database[file_name]
+            if removed:
+                self._dirty = True
+
+    def OnFileDeleted(self, file_path, is_dir):
+        with self._lock:
+            removed = [file_path] if file_path in self._database else []
+            if is_dir:
+                prefix = file_path + os.sep
+                removed.extend(entry_path for entry_path in self._database
+                               if entry_path.startswith(prefix))
+            for entry_path in removed:
+                del self._database[entry_path]
+            if removed:
+                logging.info("Removed %d deleted files from compilation database",
+                             len(removed))
+                self._dirty = True
 
     def Write(self):
-        self._CleanFromNonExisting()
-        with open(self._compile_commands_file_path, "w") as f:
-            db_list = []
-            for _, value in self._database.items():
-                db_list.append(value)
-            json.dump(db_list,fp=f, cls=DbEntryEncoder)
+        with self._lock:
+            if not self._dirty or self._write_scheduled:
+                return
+            self._write_scheduled = True
+        self._threading_manager.GetThreadPool("compile_db").submit(
+                self._WriteDatabase)
+
+    def _WriteDatabase(self):
+        with self._write_lock, trace.Span("WriteCompilationDatabase",
+                                          category="compile_db"):
+            with self._lock:
+                db_list = [self._database[file_path]
+                           for file_path in sorted(self._database)]
+                self._dirty = False
+                self._write_scheduled = False
+            try:
+                utils.WriteFileAtomically(self._compile_commands_file_path,
+                        json.dumps(db_list, cls=DbEntryEncoder))
+            except Exception:
+                logging.exception("Unable to write compilation database")
+                with self._lock:
+                    self._dirty = True
+                return
+        logging.info("Written compilation database: %d entries", len(db_list))
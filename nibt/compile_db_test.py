@@ -0,0 +1,105 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from nibt import compile_db, config
+
+class FakeThreadingManager(object):
+    # Runs the submitted writes right away
+    def __init__(self):
+        self.submitted = 0
+
+    def GetThreadPool(self, name):
+        return self
+
+    def submit(self, fn, *args, **kwargs):
+        self.submitted += 1
+        fn(*args, **kwargs)
+
+class DatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.database_path = os.path.join(self.root_dir,
+                                          "compile_commands.json")
+        settings = "[projects]\nroot_dir=%s\n" % self.root_dir
+        self.configuration = config.Configuration(
+                [io.BytesIO(settings.encode())])
+        self.threading_manager = FakeThreadingManager()
+        self.database = self.CreateDatabase()
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def CreateDatabase(self):
+        return compile_db.Database(self.configuration, self.threading_manager)
+
+    def WriteSource(self, relative_path):
+        path = os.path.join(self.root_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write("")
+        return path
+
+    def ReadEntries(self):
+        with open(self.database_path, "r") as f:
+            return {entry["file"]: entry["command"] for entry in json.load(f)}
+
+    def testWriteSkipsUnchangedDatabase(self):
+        self.database.Write()
+        self.assertEqual(0, self.threading_manager.submitted)
+        self.assertFalse(os.path.exists(self.database_path))
+
+        self.database.SubmitCommand("a.cc", "c++ -c a.cc")
+        self.database.Write()
+        self.assertEqual(1, self.threading_manager.submitted)
+        self.assertEqual({"a.cc": "c++ -c a.cc"}, self.ReadEntries())
+
+        # Resubmitting the same command does not dirty the database
+        self.database.SubmitCommand("a.cc", "c++ -c a.cc")
+        self.database.RemoveCommands(["b.cc"])
+        self.database.OnFileDeleted("b.cc", False)
+        self.database.Write()
+        self.assertEqual(1, self.threading_manager.submitted)
+
+        self.database.SubmitCommand("a.cc", "c++ -O2 -c a.cc")
+        self.database.Write()
+        self.assertEqual(2, self.threading_manager.submitted)
+        self.assertEqual({"a.cc": "c++ -O2 -c a.cc"}, self.ReadEntries())
+
+    def testRemovedSourcesDropTheirEntries(self):
+        for name in ["a.cc", "b.cc", "c.cc"]:
+            self.database.SubmitCommand(name, "c++ -c " + name)
+        self.database.RemoveCommands(["a.cc", "c.cc", "missing.cc"])
+        self.database.Write()
+        self.assertEqual({"b.cc": "c++ -c b.cc"}, self.ReadEntries())
+
+    def testDeletedFilesAndDirectoriesDropTheirEntries(self):
+        sources = ["lib/a.cc", "lib/sub/b.cc", "lib2/c.cc", "d.cc"]
+        for path in [os.path.join(self.root_dir, s) for s in sources]:
+            self.database.SubmitCommand(path, "c++ -c " + path)
+        self.database.OnFileDeleted(os.path.join(self.root_dir, "lib"), True)
+        self.database.OnFileDeleted(os.path.join(self.root_dir, "d.cc"), False)
+        self.database.Write()
+        self.assertEqual([os.path.join(self.root_dir, "lib2/c.cc")],
+                         list(self.ReadEntries()))
+
+    def testMissingSourcesAreDroppedOnLoad(self):
+        kept = self.WriteSource("a.cc")
+        deleted = self.WriteSource("b.cc")
+        self.database.SubmitCommand(kept, "c++ -c a.cc")
+        self.database.SubmitCommand(deleted, "c++ -c b.cc")
+        self.database.Write()
+        os.remove(deleted)
+
+        database = self.CreateDatabase()
+        database.Write()
+        self.assertEqual({kept: "c++ -c a.cc"}, self.ReadEntries())
+        # Nothing changed since the cleaned database was written
+        database.Write()
+        self.assertEqual(2, self.threading_manager.submitted)
+
+if __name__ == '__main__':
+    unittest.main()
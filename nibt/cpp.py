@@ -1,9 +1,23 @@
+import collections
+import hashlib
 import logging
 import os
 import subprocess
 import glob
+import threading
 
-from nibt import common, moduledef, plugin, utils
+from nibt import common, fingerprint, metrics, moduledef, object_cache, plugin, trace, utils, worker
+
+_object_cache_hits = metrics.registry.Counter(
+        "ni_object_cache_hits_total", "Objects restored from the object cache")
+_object_cache_misses = metrics.registry.Counter(
+        "ni_object_cache_misses_total", "Objects not found in the object cache")
+_worker_jobs = metrics.registry.Counter(
+        "ni_worker_jobs_total", "Compilations done by a worker", ["worker"])
+_worker_failures = metrics.registry.Counter(
+        "ni_worker_failures_total", "Failed requests to a worker", ["worker"])
+_worker_in_flight = metrics.registry.Gauge(
+        "ni_worker_in_flight", "Compilations sent to a worker", ["worker"])
 
 
 class CppLibrary(moduledef.ModuleDefinitionFactory):
@@ -13,6 +27,12 @@ class CppLibrary(moduledef.ModuleDefinitionFactory):
     lflags = []
     deps = []
     sources = None
+    pch = None
+    # Compiles sources in generated batches of at most unity_batch_files
+    # files and unity_batch_bytes bytes
+    unity = False
+    unity_batch_files = 16
+    unity_batch_bytes = 256 * 1024
 
 
 class CppBinary(moduledef.ModuleDefinitionFactory):
@@ -23,14 +43,37 @@ class CppBinary(moduledef.ModuleDefinitionFactory):
     binary_name = None
 
 class CppStaticLibraryResult(common.SuccessfulBuildResult):
-    def __init__(self, archive_path, lflags, pkg_deps):
+    def __init__(self, archive_path, lflags, pkg_deps, content_hash):
         self.archive_path = archive_path
         self.lflags = lflags
         self.pkg_deps = pkg_deps
+        # Changes only when the archived objects change
+        self.content_hash = content_hash
 
     def __repr__(self):
         return "lib(%s, %s, %s)" % (self.archive_path, self.lflags, self.pkg_deps)
 
+class ObjectCompilation(object):
+    def __init__(self, source, output_file, args, object_fingerprint,
+                 pch_fingerprint=None, unity_members=None):
+        self.source = source
+        self.output_file = output_file
+        self.args = args
+        self.object_fingerprint = object_fingerprint
+        self.pch_fingerprint = pch_fingerprint
+        self.unity_members = unity_members
+
+    def GetCommand(self):
+        # Precompiled headers are passed by path, their content is
+        # accounted through the fingerprint
+        command = " ".join(self.args)
+        if self.pch_fingerprint:
+            command += " #pch=" + self.pch_fingerprint
+        return command
+
+    def __repr__(self):
+        return "ObjectCompilation(%s -> %s)" % (self.source, self.output_file)
+
 class CppStaticBinaryResult(common.SuccessfulBuildResult, common.ExecutableBuildResult):
     def __init__(self, binary_path):
         self.binary_path = binary_path
@@ -41,25 +84,89 @@ class CppStaticBinaryResult(common.SuccessfulBuildResult, common.ExecutableBuild
     def __repr__(self):
         return "bin(%s)" % (self.binary_path,)
 
+def ParseDepfile(depfile_path):
+    with open(depfile_path, "r") as f:
+        content = f.read().replace("\\\n", " ")
+    _, separator, dependencies = content.partition(": ")
+    if not separator:
+        raise ValueError("Malformed depfile %s" % depfile_path)
+    result = []
+    current = []
+    escaped = False
+    for char in dependencies:
+        if escaped:
+            current.append(char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char.isspace():
+            if current:
+                result.append("".join(current))
+                current = []
+        else:
+            current.append(char)
+    if current:
+        result.append("".join(current))
+    return result
+
 class CppStaticLibraryBuilder(object):
     def __init__(self, compilation_database, pkg_config, threading_manager,
-                 configuration):
+                 configuration, state_store, object_cache, worker_pool):
         self.threading_manager = threading_manager
         self.compilation_database = compilation_database
         self.pkg_config = pkg_config
+        self.state_store = state_store
+        self.object_cache = object_cache
+        self.worker_pool = worker_pool
         self.root_dir = configuration.GetExpandedDir("projects","root_dir")
+        self.thin_archives = configuration.Get(
+                "cpp", "thin_archives", raise_exception=False,
+                default="true") == "true"
+        self.compiler = configuration.Get(
+                "cpp", "compiler", raise_exception=False, default="clang++")
+        self.linker = configuration.Get(
+                "cpp", "linker", raise_exception=False, default="")
+        self.file_hasher = fingerprint.FileHasher()
+        self._pch_locks = collections.defaultdict(threading.Lock)
+        self._pch_locks_lock = threading.Lock()
+        self._is_clang = None
+        self._is_clang_lock = threading.Lock()
+        # Guards the saved sources of targets that are compiled outside of
+        # their unity batches because they are being edited
+        self._hot_sources_lock = threading.Lock()
     
     def GetWatchableSources(self, target):
-        sources = target.GetModuleDefinition().sources[:]
+        sources = target.GetModuleDefinition().sources
         if sources is None:
-            sources = [target.GetName()+ext for ext in [".cc", ".cpp", ".c++"]]
+            sources = [os.path.basename(target.GetName())+ext
+                       for ext in [".cc", ".cpp", ".c++"]]
+        sources = list(sources)
+        # Until every object compiled once, headers named after the sources
+        # are watched instead of the ones they include
+        guessed_headers = sorted(set(
+                os.path.splitext(source)[0] + ext
+                for source in sources for ext in [".h", ".hpp"]))
 
-        no_ext_set = {os.path.splitext(source)[0] for source in sources}
+        module_dir = os.path.dirname(
+                os.path.join(self.root_dir, target.GetName()))
+        headers = set()
+        output_files = self.state_store.Get(
+                "target_objects", target.GetName(), [])
+        guess = not output_files
+        if target.GetModuleDefinition().pch:
+            sources.append(target.GetModuleDefinition().pch)
+            output_files = output_files + [self._PlanPch(
+                target, self.GetCompilationFlags(target)).output_file]
+        for output_file in output_files:
+            object_state = self.state_store.Get("objects", output_file, {})
+            if "includes" not in object_state:
+                guess = True
+            headers.update(object_state.get("includes", []))
         
-        headers = [no_ext+ext for ext in [".h", ".hpp"]
-                   for no_ext in no_ext_set]
-        
-        sources.extend(headers)
+        sources.extend(sorted(os.path.relpath(header, module_dir)
+                              for header in headers))
+        if guess:
+            sources.extend(guessed_headers)
         return sources 
     
     def GetCompilationFlags(self, target):
@@ -76,46 +183,82 @@ class CppStaticLibraryBuilder(object):
         flags.extend(["-I"+self.root_dir])
         return flags
 
+    def Restore(self, context, target_name):
+        target = context.targets[target_name]
+        definition = target.GetModuleDefinition()
+        library_state = self.state_store.Get("libraries", target_name)
+        if library_state is None:
+            return None
+        compilations = self._PlanCompilations(target)
+        if definition.pch and compilations:
+            pch_compilation = self._PlanPch(
+                    target, self.GetCompilationFlags(target))
+            if not self._IsObjectUpToDate(pch_compilation):
+                return None
+        for compilation in compilations:
+            if not self._IsObjectUpToDate(compilation):
+                return None
+        output_files = [c.output_file for c in compilations]
+        if output_files != library_state["objects"]:
+            return None
+        if not output_files:
+            return []
+        output_archive = library_state["archive_path"]
+        if (fingerprint.GetFileStamp(output_archive) !=
+                library_state["archive_stamp"]):
+            return None
+        return [CppStaticLibraryResult(output_archive,
+                definition.lflags, set(definition.pkg_config),
+                self._GetArchiveContentHash(output_files))]
+
     def Build(self, context, target_name):
         target = context.targets[target_name]
         definition = target.GetModuleDefinition()
         pkg_config_deps = definition.pkg_config
-        
-        flags = self.GetCompilationFlags(target)
+        library_state = self.state_store.Get("libraries", target_name)
+        self.state_store.Delete("libraries", target_name)
 
-        sources = self._ResolveSources(target)
-        logging.info("Sources %s", sources)
+        # Targets without sources do not use their precompiled header
+        if definition.pch and self._ResolveSources(target):
+            pch_error = self._BuildPch(context, target)
+            if pch_error is not None:
+                return [common.FailedBuildResult(
+                        "Cannot precompile header of "+target.GetName(),
+                        [pch_error])]
         
-        obj_dir = os.path.join(self.root_dir, "obj", os.path.dirname(target.GetName())) 
+        compilations = self._PlanCompilations(target)
+        output_files = [c.output_file for c in compilations]
+        self._RemoveObjectStates(set(self.state_store.Get(
+                "target_objects", target_name, [])) - set(output_files))
+        self.state_store.Set("target_objects", target_name, output_files)
 
-        if not os.path.exists(obj_dir):
-            os.makedirs(obj_dir)
-        
-        output_files = []
         executor = self.threading_manager.GetThreadPool("modules")
-        futures = {}
-        for source in sources:
-            args = []
-            args.extend(["clang++"])
-            args.extend(flags)
-            args.extend(["-c"])
-            args.extend([source])
-            output_file = os.path.join(
-                    obj_dir,
-                    os.path.basename(source)+".o")
-            output_files.append(output_file)
-            args.extend(["-o", output_file])
-            self.compilation_database.SubmitCommand(source, " ".join(args))
-            result = executor.submit(utils.RunProcess, args)
-            futures[source] = result
+        cache_stats = object_cache.ObjectCacheStats()
+        futures = []
+        for compilation in compilations:
+            if self._IsObjectUpToDate(compilation):
+                logging.info("Object %s is up to date", compilation.output_file)
+                continue
+            result = executor.submit(self._CompileObjectTraced, context,
+                    compilation, cache_stats, trace.Now())
+            futures.append(result)
+        logging.info("Compiling %d of %d sources of %s", len(futures),
+                     len(compilations), target.GetName())
         
         errors = []
 
-        for source, future in futures.items():
-            result, out, err = future.result()
+        for future in futures:
+            result, err = future.result()
             if result != 0:
-                errors.append(common.FailedBuildResult(err.decode()))
+                errors.append(common.FailedBuildResult(err.decode(errors="replace")))
+        if self.object_cache.IsEnabled() and futures:
+            logging.info("Object cache for %s: %s (total: %s)",
+                         target.GetName(), cache_stats, self.object_cache.stats)
+        if self.worker_pool.IsEnabled() and futures:
+            logging.info("Compile workers: %s", self.worker_pool.GetStats())
         
+        if context.cancellation.IsCancelled():
+            return [common.FailedBuildResult("Cancelled "+target.GetName())]
         if errors:
             return [common.FailedBuildResult("Cannot build "+target.GetName(),
                     errors)]
@@ -126,18 +269,425 @@ class CppStaticLibraryBuilder(object):
                 os.makedirs(module_parent_dir)
             output_archive = os.path.join(module_parent_dir,
                     "lib%s.a" % (os.path.basename(target.GetName())))
+            archive_error = self._UpdateArchive(context, target_name,
+                    output_archive, output_files, library_state)
+            if archive_error is not None:
+                return [common.FailedBuildResult(
+                        "Cannot archive "+target.GetName(), [archive_error])]
+            return [CppStaticLibraryResult(output_archive,
+                    definition.lflags, set(pkg_config_deps),
+                    self._GetArchiveContentHash(output_files))]
+        else:
+            self.state_store.Set("libraries", target_name, {
+                "archive_path": None,
+                "archive_stamp": None,
+                "objects": [],
+            })
+            return []
+
+    def _RemoveObjectStates(self, output_files):
+        for output_file in output_files:
+            self.state_store.Delete("objects", output_file)
+
+    def RemoveTargetState(self, target_name):
+        with self._hot_sources_lock:
+            self.state_store.Delete("hot_sources", target_name)
+        self._RemoveObjectStates(self.state_store.Get(
+                "target_objects", target_name, []))
+        self.state_store.Delete("target_objects", target_name)
+        self.compilation_database.RemoveCommands(self.state_store.Get(
+                "target_sources", target_name, []))
+        self.state_store.Delete("target_sources", target_name)
+        self.state_store.Delete("libraries", target_name)
+
+    def _GetArchiveContentHash(self, output_files):
+        # Thin archives do not change when their members do, so the
+        # members are hashed instead of the archive
+        content_hash = hashlib.sha1()
+        for output_file in output_files:
+            content_hash.update(("%s=%s\n" % (
+                output_file, self.file_hasher.GetHash(output_file))).encode())
+        return content_hash.hexdigest()
+
+    def _UpdateArchive(self, context, target_name, output_archive,
+                       output_files, library_state):
+        # Objects rebuilt to the same bytes do not need to be archived again
+        member_hashes = {output_file: self.file_hasher.GetHash(output_file)
+                         for output_file in output_files}
+        # Members are replaced in place as long as the archive is the one
+        # written last time and holds the same set of objects
+        reusable = (library_state is not None and
+                library_state["archive_path"] == output_archive and
+                library_state["objects"] == output_files and
+                library_state.get("thin") == self.thin_archives and
+                library_state["archive_stamp"] ==
+                    fingerprint.GetFileStamp(output_archive))
+        if reusable:
+            previous_hashes = library_state.get("member_hashes", {})
+            changed = [output_file for output_file in output_files
+                       if previous_hashes.get(output_file) !=
+                           member_hashes[output_file]]
+        else:
             if os.path.exists(output_archive):
                 os.remove(output_archive)
+            changed = output_files
+        if changed:
+            logging.info("Archiving %d of %d objects into %s", len(changed),
+                         len(output_files), output_archive)
             args = []
-            args.extend(["ar","rc"])
+            args.extend(["ar", "rcsT" if self.thin_archives else "rcs"])
             args.extend([output_archive])
-            args.extend(output_files)
-            utils.RunProcess(args)
-            return [CppStaticLibraryResult(output_archive,
-                    definition.lflags, set(pkg_config_deps))]
+            args.extend(changed)
+            result, _, err = utils.RunProcess(args,
+                    context.cancellation, context.on_output)
+            if result != 0:
+                return common.FailedBuildResult(err.decode(errors="replace"))
         else:
-            return []
+            logging.info("Archive %s is up to date", output_archive)
+        self.state_store.Set("libraries", target_name, {
+            "archive_path": output_archive,
+            "archive_stamp": fingerprint.GetFileStamp(output_archive),
+            "objects": output_files,
+            "member_hashes": member_hashes,
+            "thin": self.thin_archives,
+        })
+        return None
+
+    def _PlanPch(self, target, flags):
+        module_dir = os.path.dirname(os.path.join(self.root_dir, target.GetName()))
+        header = os.path.normpath(os.path.join(
+            module_dir, target.GetModuleDefinition().pch))
+        # Shared by all targets precompiling the same header with same flags
+        pch_key = hashlib.sha1(
+                ("%s\0%s" % (header, " ".join(flags))).encode()).hexdigest()
+        pch_name = "%s-%s" % (os.path.basename(header), pch_key[:16])
+        if self._IsClang():
+            output_file = os.path.join(self.root_dir, "obj", "pch",
+                                       pch_name + ".pch")
+        else:
+            # GCC uses <header>.gch in place of an included <header>
+            output_file = os.path.join(self.root_dir, "obj", "pch", pch_name,
+                                       os.path.basename(header) + ".gch")
+        args = []
+        args.extend([self.compiler, "-x", "c++-header"])
+        args.extend(flags)
+        args.extend([header, "-o", output_file])
+        args.extend(["-MD", "-MF", output_file+".d"])
+        object_fingerprint = fingerprint.ObjectFingerprint(
+                self.file_hasher, header, " ".join(args),
+                self._GetIncludedHeaders(output_file))
+        return ObjectCompilation(header, output_file, args, object_fingerprint)
+
+    def _BuildPch(self, context, target):
+        pch_compilation = self._PlanPch(target, self.GetCompilationFlags(target))
+        with self._pch_locks_lock:
+            pch_lock = self._pch_locks[pch_compilation.output_file]
+        with pch_lock:
+            if self._IsObjectUpToDate(pch_compilation):
+                logging.info("Precompiled header %s is up to date",
+                             pch_compilation.output_file)
+                return None
+            pch_dir = os.path.dirname(pch_compilation.output_file)
+            if not os.path.exists(pch_dir):
+                os.makedirs(pch_dir, exist_ok=True)
+            if not self._IsClang():
+                # Included in place of the header, GCC falls back to it
+                # when the .gch next to it is rejected
+                self._WriteIncludingSource(
+                        os.path.splitext(pch_compilation.output_file)[0],
+                        [pch_compilation.source])
+            result, _, err = utils.RunProcess(pch_compilation.args,
+                    context.cancellation, context.on_output)
+            if result != 0:
+                self._InvalidateObjectState(pch_compilation.output_file)
+                return common.FailedBuildResult(err.decode(errors="replace"))
+            self._SaveObjectState(pch_compilation,
+                    self._GetObjectIncludes(pch_compilation))
+        return None
+
+    def _IsClang(self):
+        with self._is_clang_lock:
+            if self._is_clang is None:
+                try:
+                    result, out, _ = utils.RunProcess(
+                            [self.compiler, "--version"])
+                except OSError:
+                    result, out = -1, b""
+                self._is_clang = result == 0 and b"clang" in out
+                if not self._is_clang:
+                    logging.info("%s is not clang, precompiled headers "
+                                 "are used through -include and .gch files",
+                                 self.compiler)
+            return self._is_clang
+
+    def _GetPchArgs(self, pch_compilation):
+        if self._IsClang():
+            return ["-include-pch", pch_compilation.output_file]
+        return ["-Winvalid-pch", "-include",
+                os.path.splitext(pch_compilation.output_file)[0]]
+
+    def _PlanCompilations(self, target):
+        flags = self.GetCompilationFlags(target)
+
+        sources = self._ResolveSources(target)
+        logging.info("Sources %s", sources)
+        
+        obj_dir = os.path.join(self.root_dir, "obj", os.path.dirname(target.GetName())) 
+
+        if not os.path.exists(obj_dir):
+            os.makedirs(obj_dir)
+
+        pch_args = []
+        database_pch_args = []
+        pch_fingerprint = None
+        if target.GetModuleDefinition().pch:
+            pch_compilation = self._PlanPch(target, flags)
+            pch_args = self._GetPchArgs(pch_compilation)
+            # Tools reading the compilation database parse the header itself
+            database_pch_args = ["-include", pch_compilation.source]
+            pch_state = self.state_store.Get(
+                    "objects", pch_compilation.output_file, {})
+            pch_fingerprint = pch_state.get("fingerprint", fingerprint.MISSING)
+
+        def GetArgs(source, output_file, extra_args):
+            args = []
+            args.extend([self.compiler])
+            args.extend(flags)
+            args.extend(extra_args)
+            args.extend(["-c"])
+            args.extend([source])
+            args.extend(["-o", output_file])
+            return args
+
+        for source in sources:
+            self.compilation_database.SubmitCommand(source, " ".join(GetArgs(
+                source, os.path.join(obj_dir, os.path.basename(source)+".o"),
+                database_pch_args)))
+        self.compilation_database.RemoveCommands(set(self.state_store.Get(
+                "target_sources", target.GetName(), [])) - set(sources))
+        self.state_store.Set("target_sources", target.GetName(), sources)
+
+        units = [(source, None) for source in sources]
+        if target.GetModuleDefinition().unity:
+            units = self._PlanUnityBatches(target, sources, obj_dir)
+
+        compilations = []
+        for source, unity_members in units:
+            output_file = os.path.join(
+                    obj_dir,
+                    os.path.basename(source)+".o")
+            args = GetArgs(source, output_file, pch_args)
+            args.extend(["-MD", "-MF", output_file+".d"])
+            compilation = ObjectCompilation(
+                source, output_file, args, None, pch_fingerprint,
+                unity_members)
+            compilation.object_fingerprint = fingerprint.ObjectFingerprint(
+                    self.file_hasher, source, compilation.GetCommand(),
+                    self._GetIncludedHeaders(output_file))
+            compilations.append(compilation)
+        return compilations
+
+    def _SplitIntoBatches(self, definition, sources):
+        batches = []
+        batch = []
+        batch_bytes = 0
+        for source in sorted(sources):
+            try:
+                size = os.path.getsize(source)
+            except OSError:
+                size = 0
+            if batch and (len(batch) >= definition.unity_batch_files or
+                          batch_bytes + size > definition.unity_batch_bytes):
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(source)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _PlanUnityBatches(self, target, sources, obj_dir):
+        # Batches are computed over all sources, so that a source leaving
+        # its batch does not move the others
+        batches = self._SplitIntoBatches(target.GetModuleDefinition(), sources)
+        with self._hot_sources_lock:
+            # Saved, so that a restarted daemon plans the same batches.
+            # Sources deleted or removed from the target are forgotten.
+            hot_sources = set(self.state_store.Get(
+                    "hot_sources", target.GetName(), [])).intersection(sources)
+            units = self._PlanUnityUnits(target, batches, obj_dir, hot_sources)
+            if hot_sources:
+                self.state_store.Set("hot_sources", target.GetName(),
+                                     sorted(hot_sources))
+            else:
+                self.state_store.Delete("hot_sources", target.GetName())
+        return units
+
+    def _PlanUnityUnits(self, target, batches, obj_dir, hot_sources):
+        units = []
+        for index, batch in enumerate(batches):
+            unity_source = os.path.join(obj_dir, "%s.unity%d.cc" % (
+                os.path.basename(target.GetName()), index))
+            previous_members = self.state_store.Get(
+                    "objects", unity_source+".o", {}).get("members", {})
+            for source in batch:
+                if (source in previous_members and previous_members[source] !=
+                        self.file_hasher.GetHash(source)):
+                    logging.info("%s is being edited, compiling it alone",
+                                 source)
+                    hot_sources.add(source)
+            cold = [source for source in batch if source not in hot_sources]
+            units.extend((source, None) for source in batch
+                         if source not in cold)
+            if len(cold) == 1:
+                units.append((cold[0], None))
+            elif cold:
+                self._WriteIncludingSource(unity_source, cold)
+                units.append((unity_source, cold))
+        return units
+
+    def _WriteIncludingSource(self, path, headers):
+        content = "".join('#include "%s"\n' % header for header in headers)
+        try:
+            with open(path, "r") as f:
+                if f.read() == content:
+                    return
+        except OSError:
+            pass
+        utils.WriteFileAtomically(path, content)
+
+    def _CompileObjectTraced(self, context, compilation, cache_stats,
+                             submitted):
+        trace.AddSpan("Queued", submitted, category="queue",
+                      target=context.target_name, pool="modules")
+        with trace.Span("Compile", category="compile",
+                        target=context.target_name, source=compilation.source):
+            return self._CompileObject(context, compilation, cache_stats)
+
+    def _CompileObject(self, context, compilation, cache_stats):
+        manifest_key = None
+        if self.object_cache.IsEnabled():
+            manifest_key = self.object_cache.GetManifestKey(
+                    compilation.args[0], compilation.GetCommand(),
+                    self.file_hasher.GetHash(compilation.source))
+            includes = self.object_cache.Fetch(
+                    manifest_key, self.file_hasher, compilation.output_file,
+                    cache_stats)
+            if includes is not None:
+                self._SaveObjectState(compilation, includes)
+                return 0, b""
+
+        result = None
+        # Precompiled headers cannot be shipped along with the source
+        if self.worker_pool.IsEnabled() and not compilation.pch_fingerprint:
+            result, err = self._CompileRemotely(context, compilation)
+        if result is None:
+            result, _, err = utils.RunProcess(compilation.args,
+                    context.cancellation, context.on_output)
+        if result != 0:
+            self._InvalidateObjectState(compilation.output_file)
+            return result, err
+        includes = self._GetObjectIncludes(compilation)
+        self._SaveObjectState(compilation, includes)
+        if manifest_key is not None:
+            self.object_cache.Store(manifest_key, self.file_hasher, includes,
+                                    compilation.output_file)
+        return result, err
+
+    def _CompileRemotely(self, context, compilation):
+        # Preprocesses locally and compiles on a worker, (None, None) means
+        # that the source has to be compiled locally
+        compile_worker = self.worker_pool.Acquire()
+        if compile_worker is None:
+            return None, None
+        preprocessed_file = compilation.output_file + ".ii"
+        try:
+            args = list(compilation.args)
+            args[args.index("-c")] = "-E"
+            args[args.index("-o") + 1] = preprocessed_file
+            result, _, err = utils.RunProcess(args,
+                    context.cancellation, context.on_output)
+            if result != 0:
+                return result, err
+            with open(preprocessed_file, "rb") as f:
+                source = f.read()
+            try:
+                result, object_data, err = self.worker_pool.Compile(
+                        compile_worker, worker.GetRemoteArgs(compilation.args),
+                        source, ".ii")
+            except worker.WorkerError:
+                return None, None
+            if err:
+                context.on_output("stderr", err.decode(errors="replace"))
+            if result == 0:
+                utils.WriteFileAtomically(compilation.output_file, object_data)
+            return result, err
+        finally:
+            self.worker_pool.Release(compile_worker)
+            if os.path.exists(preprocessed_file):
+                os.remove(preprocessed_file)
+
+    def _GetIncludedHeaders(self, output_file):
+        object_state = self.state_store.Get("objects", output_file, {})
+        return object_state.get("includes", [])
+
+    def _GetObjectIncludes(self, compilation):
+        depfile_path = compilation.output_file+".d"
+        try:
+            dependencies = ParseDepfile(depfile_path)
+        except (OSError, ValueError):
+            logging.warning("Unable to read dependencies from %s", depfile_path)
+            dependencies = []
+        # Only headers of the project are tracked, system and third
+        # party headers are expected to change together with the toolchain
+        root_prefix = os.path.join(self.root_dir, "")
+        # Precompiled headers are accounted through their own fingerprint
+        output_prefixes = (os.path.join(self.root_dir, "obj", ""),
+                           os.path.join(self.root_dir, "out", ""))
+        source = os.path.normpath(compilation.source)
+        headers = set()
+        for dependency in dependencies:
+            dependency = os.path.normpath(dependency)
+            if (dependency.startswith(root_prefix) and dependency != source and
+                    not dependency.startswith(output_prefixes)):
+                headers.add(dependency)
+        return sorted(headers)
+
+    def _SaveObjectState(self, compilation, includes):
+        # The fingerprint is recomputed against the fresh include map, so that
+        # the next build can tell whether any of the headers changed
+        object_state = {
+            "fingerprint": fingerprint.ObjectFingerprint(
+                self.file_hasher, compilation.source,
+                compilation.GetCommand(), includes),
+            "includes": includes,
+            "stamp": fingerprint.GetFileStamp(compilation.output_file),
+        }
+        if compilation.unity_members:
+            # Tells which of the members are edited later on
+            object_state["members"] = {
+                member: self.file_hasher.GetHash(member)
+                for member in compilation.unity_members}
+        self.state_store.Set("objects", compilation.output_file, object_state)
 
+    def _InvalidateObjectState(self, output_file):
+        # The includes of the last successful compile are kept, so that
+        # fixing a header that broke the compile rebuilds the object
+        object_state = self.state_store.Get("objects", output_file)
+        if object_state is None:
+            return
+        object_state.pop("fingerprint", None)
+        object_state.pop("stamp", None)
+        self.state_store.Set("objects", output_file, object_state)
+
+    def _IsObjectUpToDate(self, compilation):
+        object_state = self.state_store.Get("objects", compilation.output_file)
+        if object_state is None or "fingerprint" not in object_state:
+            return False
+        return (object_state["fingerprint"] == compilation.object_fingerprint and
+                object_state["stamp"] ==
+                    fingerprint.GetFileStamp(compilation.output_file))
 
     def _ResolveSources(self, target):
         module_definition = target.GetModuleDefinition()
@@ -160,14 +710,39 @@ class CppBinaryBuilder(CppStaticLibraryBuilder):
     
     def GetWatchableSources(self, target):
         return []
+
+    def Restore(self, context, target_name):
+        binary_state = self.state_store.Get("binaries", target_name)
+        if binary_state is None:
+            return None
+        target = context.targets[target_name]
+        deps = self._CollectDependencies(context, target)
+        if not all(dep.ok() for dep in deps):
+            return None
+        binary_name = binary_state["binary_path"]
+        if not self._IsBinaryUpToDate(binary_state,
+                self._GetLinkArgs(deps, binary_name), deps):
+            return None
+        self._SymlinkBinary(target, binary_name)
+        return [CppStaticBinaryResult(binary_name)]
+
+    def RemoveTargetState(self, target_name):
+        CppStaticLibraryBuilder.RemoveTargetState(self, target_name)
+        self.state_store.Delete("binaries", target_name)
+
+    def _IsBinaryUpToDate(self, binary_state, args, deps):
+        if binary_state is None:
+            return False
+        return (binary_state.get("link_fingerprint") ==
+                    self._GetLinkFingerprint(args, deps) and
+                fingerprint.GetFileStamp(binary_state["binary_path"]) ==
+                    binary_state["binary_stamp"])
     
     def Build(self, context, target_name):
-        deps = []
         target = context.targets[target_name]
-        definition = target.GetModuleDefinition()
-        for dep_name in definition.deps:
-            self._FillDependencies(context, dep_name, deps)
-        logging.info("Collected deps for %s: %s", target_name, deps)
+        binary_state = self.state_store.Get("binaries", target_name)
+        self.state_store.Delete("binaries", target_name)
+        deps = self._CollectDependencies(context, target)
         binary_name = os.path.join(
                 self.root_dir, "out", target.GetName())
 
@@ -180,28 +755,68 @@ class CppBinaryBuilder(CppStaticLibraryBuilder):
             return [common.FailedBuildResult("Cannot build "+target.GetName(),
                     dep_errors)]
 
+        if not os.path.exists(os.path.dirname(binary_name)):
+            os.makedirs(os.path.dirname(binary_name))
+        args = self._GetLinkArgs(deps, binary_name)
+        if self._IsBinaryUpToDate(binary_state, args, deps):
+            logging.info("Link inputs of %s did not change", binary_name)
+        else:
+            result, _, err = utils.RunProcess(args,
+                        context.cancellation, context.on_output)
+            if result != 0:
+                return [common.FailedBuildResult("Cannot link "+target.GetName(),
+                        [common.FailedBuildResult(err.decode(errors="replace"))])]
+        self.state_store.Set("binaries", target_name, {
+            "binary_path": binary_name,
+            "binary_stamp": fingerprint.GetFileStamp(binary_name),
+            "link_fingerprint": self._GetLinkFingerprint(args, deps),
+        })
+
+        self._SymlinkBinary(target, binary_name)
+
+        return [CppStaticBinaryResult(binary_name)]
+
+    def _CollectDependencies(self, context, target):
+        deps = []
+        definition = target.GetModuleDefinition()
+        for dep_name in definition.deps:
+            self._FillDependencies(context, dep_name, deps)
+        logging.info("Collected deps for %s: %s", target.GetName(), deps)
+        return deps
+
+    def _GetLinkArgs(self, deps, binary_name):
         args = []
-        args.extend(["clang++"])
+        args.extend([self.compiler])
+        if self.linker:
+            args.extend(["-fuse-ld="+self.linker])
         pkg_deps = set()
         for dep in deps:
             args.extend([dep.archive_path])
             args.extend(dep.lflags)
             pkg_deps.update(dep.pkg_deps)
-        args.extend(self.pkg_config.GetFlags(tuple(pkg_deps), libs=True))
+        args.extend(self.pkg_config.GetFlags(tuple(sorted(pkg_deps)), libs=True))
         args.extend(["-o", binary_name])
-        utils.RunProcess(args)
+        return args
 
+    def _GetLinkFingerprint(self, args, deps):
+        link_fingerprint = hashlib.sha1()
+        link_fingerprint.update(" ".join(args).encode())
+        for dep in deps:
+            link_fingerprint.update(("\0%s=%s" % (
+                dep.archive_path, dep.content_hash)).encode())
+        return link_fingerprint.hexdigest()
+
+    def _SymlinkBinary(self, target, binary_name):
+        definition = target.GetModuleDefinition()
         if definition.binary_name:
             symlink_full_path = os.path.join(self.root_dir, "bin", definition.binary_name)
             logging.info("Symlinking %s to %s", binary_name, symlink_full_path)
             if not os.path.exists(os.path.dirname(symlink_full_path)):
                 os.makedirs(os.path.dirname(symlink_full_path))
-            if os.path.exists(symlink_full_path):
+            if os.path.lexists(symlink_full_path):
                 os.remove(symlink_full_path)
             os.symlink(binary_name, symlink_full_path)
 
-        return [CppStaticBinaryResult(binary_name)]
-
     def _FillDependencies(self, context, target_name, deps):
         logging.info("Fill %r %r", context.build_results, deps)
         if target_name in context.build_results:
@@ -217,12 +832,26 @@ class CppPlugin(plugin.Plugin):
         return [CppBinary, CppLibrary]
 
     def RegisterBuilders(self, builder):
+        self.object_cache = object_cache.ObjectCache(self.configuration)
+        self.worker_pool = worker.WorkerPool(self.configuration)
         self.cpp_lib_builder = CppStaticLibraryBuilder(
                 self.compilation_database, self.pkg_config, self.threading_manager,
-                self.configuration)
+                self.configuration, self.state_store, self.object_cache,
+                self.worker_pool)
         self.cpp_binary_builder = CppBinaryBuilder(
                 self.compilation_database, self.pkg_config, self.threading_manager,
-                self.configuration)
+                self.configuration, self.state_store, self.object_cache,
+                self.worker_pool)
         
         builder.RegisterBuilder(self.cpp_lib_builder)
         builder.RegisterBuilder(self.cpp_binary_builder)
+
+    def UpdateMetrics(self):
+        _object_cache_hits.Set(self.object_cache.stats.hits)
+        _object_cache_misses.Set(self.object_cache.stats.misses)
+        for worker_stats in self.worker_pool.GetStats():
+            _worker_jobs.Set(worker_stats.jobs, worker=worker_stats.address)
+            _worker_failures.Set(worker_stats.failures,
+                                 worker=worker_stats.address)
+            _worker_in_flight.Set(worker_stats.in_flight,
+                                  worker=worker_stats.address)
@@ -0,0 +1,218 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from pkg_resources import resource_stream
+
+from nibt import (build, common, config, cpp, object_cache, state,
+                  thread_pools, utils, worker)
+
+COMPILER = shutil.which("g++") or shutil.which("clang++")
+
+SETTINGS = """
+[projects]
+root_dir=%(root)s
+
+[cpp]
+compiler=%(compiler)s
+
+[object_cache]
+enabled=false
+dir=%(root)s/cache
+"""
+
+class FakeCompilationDatabase(object):
+    def __init__(self):
+        self.commands = {}
+
+    def SubmitCommand(self, source, command):
+        self.commands[source] = command
+
+    def RemoveCommands(self, sources):
+        for source in sources:
+            self.commands.pop(source, None)
+
+class FakePkgConfig(object):
+    def GetFlags(self, packages_list, cflags=False, libs=False):
+        return []
+
+class ParseDepfileTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.depfile_path = os.path.join(self.temp_dir, "a.o.d")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def Parse(self, content):
+        with open(self.depfile_path, "w") as f:
+            f.write(content)
+        return cpp.ParseDepfile(self.depfile_path)
+
+    def testEscapedSpaces(self):
+        self.assertEqual(["/src/my dir/a.cc", "/src/a b.h", "/src/c.h"],
+                         self.Parse("a.o: /src/my\\ dir/a.cc /src/a\\ b.h "
+                                    "/src/c.h\n"))
+
+    def testLineContinuations(self):
+        self.assertEqual(["/src/a.cc", "/src/a.h", "/src/b.h", "/src/c.h"],
+                         self.Parse("a.o: /src/a.cc \\\n /src/a.h \\\n"
+                                    "  /src/b.h\\\n /src/c.h\n"))
+
+    def testMultipleTargets(self):
+        self.assertEqual(["/src/a.cc", "/src/a.h"],
+                         self.Parse("a.o a.o.d: /src/a.cc \\\n /src/a.h\n"))
+
+    def testTargetWithoutDependencies(self):
+        self.assertEqual([], self.Parse("a.o: \n"))
+
+    def testMalformedDepfile(self):
+        self.assertRaises(ValueError, self.Parse, "a.o /src/a.cc\n")
+
+    def testMissingDepfile(self):
+        self.assertRaises(OSError, cpp.ParseDepfile, self.depfile_path)
+
+@unittest.skipIf(COMPILER is None, "No C++ compiler found")
+class CppStaticLibraryBuilderTest(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.mtime = 1000000000
+        self.targets = {}
+        self.configuration = config.Configuration([
+            io.BytesIO((SETTINGS % {
+                "root": self.root_dir, "compiler": COMPILER}).encode()),
+            resource_stream("nibt", "default_settings.ini")])
+        self.threading_manager = thread_pools.ThreadingManager(
+                self.configuration)
+        self.compilation_database = FakeCompilationDatabase()
+        self.builder = self.CreateBuilder()
+
+    def tearDown(self):
+        self.threading_manager.Join()
+        shutil.rmtree(self.root_dir)
+
+    def CreateBuilder(self):
+        # Builders created later act as restarted daemons
+        return cpp.CppStaticLibraryBuilder(
+                self.compilation_database, FakePkgConfig(),
+                self.threading_manager, self.configuration,
+                state.StateStore(self.configuration),
+                object_cache.ObjectCache(self.configuration),
+                worker.WorkerPool(self.configuration))
+
+    def WriteFile(self, relative_path, content):
+        path = os.path.join(self.root_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+        # Every write gets a distinct stamp, also on coarse mtime filesystems
+        self.mtime += 10
+        os.utime(path, (self.mtime, self.mtime))
+
+    def AddLibrary(self, target_name, **attributes):
+        definition = cpp.CppLibrary()
+        for name, value in attributes.items():
+            setattr(definition, name, value)
+        target = common.Target(target_name)
+        target.SetModuleDefinition(definition)
+        self.targets[target_name] = target
+
+    def CreateContext(self, target_name):
+        return build.BuildingContext(
+                target_name, self.targets, {}, utils.CancellationToken(),
+                lambda stream_name, text: None)
+
+    def Build(self, target_name):
+        result = self.builder.Build(self.CreateContext(target_name),
+                                    target_name)
+        return all(r.ok() for r in result)
+
+    def testFixedHeaderOfFailedCompileIsWatched(self):
+        self.WriteFile("lib/a.h", "int A();\n")
+        self.WriteFile("lib/a.cc", '#include "a.h"\nint A() { return 1; }\n')
+        self.AddLibrary("lib/a", sources=["a.cc"])
+        self.assertTrue(self.Build("lib/a"))
+
+        self.WriteFile("lib/a.h", "int A(\n")
+        self.assertFalse(self.Build("lib/a"))
+        self.assertIn("a.h", self.builder.GetWatchableSources(
+                self.targets["lib/a"]))
+        self.WriteFile("lib/a.h", "int A();\n\n")
+        self.assertTrue(self.Build("lib/a"))
+
+    def testHeadersAreGuessedBeforeFirstCompile(self):
+        self.WriteFile("lib/b.h", "int B(\n")
+        self.WriteFile("lib/b.cc", '#include "b.h"\n')
+        self.AddLibrary("lib/b", sources=["b.cc"])
+        self.assertFalse(self.Build("lib/b"))
+        self.assertEqual(["b.cc", "b.h", "b.hpp"],
+                         self.builder.GetWatchableSources(self.targets["lib/b"]))
+
+    def testHotSourcesSurviveRestart(self):
+        for name in ["c1", "c2", "c3"]:
+            self.WriteFile("lib/%s.cc" % name, "int %s() { return 1; }\n" % name)
+        self.AddLibrary("lib/c", sources=["c1.cc", "c2.cc", "c3.cc"],
+                        unity=True)
+        self.assertTrue(self.Build("lib/c"))
+        self.WriteFile("lib/c2.cc", "int c2() { return 2; }\n")
+        self.assertTrue(self.Build("lib/c"))
+
+        self.builder.state_store.Flush()
+        self.builder = self.CreateBuilder()
+        self.assertIsNotNone(self.builder.Restore(
+                self.CreateContext("lib/c"), "lib/c"))
+
+    def testRemovedSourcesLeaveCompilationDatabase(self):
+        self.WriteFile("lib/d1.cc", "int d1() { return 1; }\n")
+        self.WriteFile("lib/d2.cc", "int d2() { return 2; }\n")
+        self.AddLibrary("lib/d", sources=["d1.cc", "d2.cc"])
+        self.assertTrue(self.Build("lib/d"))
+        source1, source2 = [os.path.join(self.root_dir, "lib", name)
+                            for name in ["d1.cc", "d2.cc"]]
+        self.assertEqual([source1, source2],
+                         sorted(self.compilation_database.commands))
+
+        self.AddLibrary("lib/d", sources=["d1.cc"])
+        self.assertTrue(self.Build("lib/d"))
+        self.assertEqual([source1], list(self.compilation_database.commands))
+
+        self.builder.RemoveTargetState("lib/d")
+        self.assertEqual({}, self.compilation_database.commands)
+
+    def testIdenticalRebuiltObjectIsNotArchivedAgain(self):
+        self.WriteFile("lib/e.cc", "int e() { return 1; }\n")
+        self.AddLibrary("lib/e", sources=["e.cc"])
+        self.assertTrue(self.Build("lib/e"))
+        archive = os.path.join(self.root_dir, "out", "lib", "libe.a")
+        archive_stamp = os.stat(archive).st_mtime_ns
+
+        self.WriteFile("lib/e.cc", "// Comment\nint e() { return 1; }\n")
+        self.assertTrue(self.Build("lib/e"))
+        self.assertEqual(archive_stamp, os.stat(archive).st_mtime_ns)
+
+        self.WriteFile("lib/e.cc", "int e() { return 2; }\n")
+        self.assertTrue(self.Build("lib/e"))
+        self.assertNotEqual(archive_stamp, os.stat(archive).st_mtime_ns)
+
+    def testPrecompiledHeaderOfGcc(self):
+        if self.builder._IsClang():
+            self.skipTest("Compiler is clang")
+        self.WriteFile("lib/p.h", "int P();\n")
+        self.WriteFile("lib/f.cc", "int f() { return P(); }\n")
+        self.AddLibrary("lib/f", sources=["f.cc"], pch="p.h")
+        self.assertTrue(self.Build("lib/f"))
+        object_file = os.path.join(self.root_dir, "obj", "lib", "f.cc.o")
+        # Headers read from the .gch are not listed as includes
+        self.assertEqual([], self.builder.state_store.Get(
+                "objects", object_file)["includes"])
+
+        self.WriteFile("lib/p.h", "int P();\nint Q();\n")
+        self.WriteFile("lib/f.cc", "int f() { return P() + Q(); }\n")
+        self.assertTrue(self.Build("lib/f"))
+        self.assertEqual([], self.builder.state_store.Get(
+                "objects", object_file)["includes"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -38,6 +38,15 @@ class DBusInterface(dbus.service.Object):
         self.bus = dbus.SessionBus()
         bus_name = dbus.service.BusName(APP_SVC_NAME, bus=self.bus)
         dbus.service.Object.__init__(self, bus_name, APP_SVC_PATH)
+        self.builder.AddBuildOutputHandler(self.OnBuildOutput)
+
+    def OnBuildOutput(self, target_name, stream_name, text):
+        # Signals must be emitted from the main loop thread
+        GObject.idle_add(self.BuildOutput, target_name, stream_name, text)
+
+    @dbus.service.signal(dbus_interface=APP_SVC_NAME, signature="sss")
+    def BuildOutput(self, target_name, stream_name, text):
+        pass
 
     def _GetPool(self):
         return self.threading_manager.GetThreadPool("dbus")
@@ -147,7 +156,7 @@ class DBusInterface(dbus.service.Object):
                     continue
                 relative = full_filename[(len(self._root)+1):]
                 first_path = relative.split("/")
-                if first_path[0] in set(["out","obj"]):
+                if first_path[0] in set(["out","obj",".nibt"]):
                     continue
                 Walk(relative)
 
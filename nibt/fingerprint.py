@@ -0,0 +1,56 @@
+import hashlib
+import logging
+import os
+import threading
+
+MISSING = "missing"
+
+# Content hashes of files, cached by their (mtime, size) stamp
+class FileHasher(object):
+    def __init__(self):
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def GetHash(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return MISSING
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._hashes.get(path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        content_hash = hashlib.sha1()
+        try:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 16), b""):
+                    content_hash.update(chunk)
+        except OSError:
+            logging.warning("Unable to read '%s' for hashing", path)
+            return MISSING
+        digest = content_hash.hexdigest()
+        with self._lock:
+            self._hashes[path] = (stamp, digest)
+        return digest
+
+
+def ObjectFingerprint(file_hasher, source, command, headers):
+    fingerprint = hashlib.sha1()
+    fingerprint.update(command.encode())
+    fingerprint.update(b"\0")
+    fingerprint.update(file_hasher.GetHash(source).encode())
+    for header in sorted(headers):
+        fingerprint.update(b"\0")
+        fingerprint.update(header.encode())
+        fingerprint.update(b"=")
+        fingerprint.update(file_hasher.GetHash(header).encode())
+    return fingerprint.hexdigest()
+
+
+def GetFileStamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
@@ -1,13 +1,26 @@
+import collections
 import logging
 import functools
+import threading
+
+from nibt import common, trace
+
+class CycleError(common.Error):
+    pass
 
 class DependencyTracker(object):
 
-    def __init__(self, get_dependencies):
+    def __init__(self, get_dependencies, executor=None):
         self._get_dependencies = get_dependencies
+        self._executor = executor
         self._provides = {}
         self._depends = {}
+        # Guards changes of _depends against readers on other threads
+        self._depends_lock = threading.Lock()
         self._active_targets = set()
+        # Length of the longest dependency chain below a target, dependencies
+        # always have lower levels than the targets that depend on them
+        self._levels = {}
 
         default_tracking = functools.partial(
                 DependencyTracker._LogEvent, self, "Tracking %s")
@@ -24,7 +37,14 @@ class DependencyTracker(object):
         return self._depends[target_name]
     
     def GetAllDependencies(self):
-        return self._depends
+        # A copy, safe to iterate while the graph is being changed
+        with self._depends_lock:
+            return dict(self._depends)
+
+    def GetTopologicalOrder(self, targets=None):
+        if targets is None:
+            targets = self._levels
+        return sorted(targets, key=lambda target: (self._levels[target], target))
 
     def _LogEvent(self, message, item):
         logging.info(message, item)
@@ -33,34 +53,169 @@ class DependencyTracker(object):
         for handler in handlers:
             handler(item)
 
-    def _AddTarget(self, target):
-        if target not in self._depends:
-            dependencies = self._get_dependencies(target)
-            self._depends[target] = dependencies
+    def _LoadDependencies(self, targets):
+        if self._executor is None or len(targets) < 2:
+            return [self._get_dependencies(target) for target in targets]
+        return list(self._executor.map(self._get_dependencies, targets))
+
+    def _ExpandTarget(self, target, reload_target=False):
+        # Loads definitions of all targets reachable from target that are not
+        # tracked yet, a whole frontier at a time
+        new_depends = {}
+        if reload_target or target not in self._depends:
+            frontier = [target]
+        else:
+            frontier = []
+        while frontier:
+            loaded = self._LoadDependencies(frontier)
+            next_frontier = set()
+            for frontier_target, dependencies in zip(frontier, loaded):
+                new_depends[frontier_target] = set(dependencies)
+                for dependency in dependencies:
+                    if (dependency not in self._depends and
+                            dependency not in new_depends):
+                        next_frontier.add(dependency)
+            frontier = sorted(target for target in next_frontier
+                              if target not in new_depends)
+        self._CheckCycles(new_depends)
+        return new_depends
+
+    def _CheckCycles(self, new_depends):
+        def GetDependencies(target):
+            if target in new_depends:
+                return new_depends[target]
+            return self._depends.get(target, set())
+
+        # Iterative Tarjan's strongly connected components
+        index = {}
+        low_link = {}
+        stack = []
+        on_stack = set()
+        cycles = []
+        for root in sorted(new_depends):
+            if root in index:
+                continue
+            work = [(root, iter(sorted(GetDependencies(root))))]
+            index[root] = low_link[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                target, dependencies = work[-1]
+                dependency = next(dependencies, None)
+                if dependency is not None:
+                    if dependency not in index:
+                        index[dependency] = low_link[dependency] = len(index)
+                        stack.append(dependency)
+                        on_stack.add(dependency)
+                        work.append((dependency,
+                                     iter(sorted(GetDependencies(dependency)))))
+                    elif dependency in on_stack:
+                        low_link[target] = min(low_link[target], index[dependency])
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low_link[parent] = min(low_link[parent], low_link[target])
+                if low_link[target] == index[target]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        component.append(member)
+                        if member == target:
+                            break
+                    if len(component) > 1 or target in GetDependencies(target):
+                        cycles.append(sorted(component))
+        if cycles:
+            raise CycleError("Dependency cycles found: %s" % "; ".join(
+                " -> ".join(cycle + [cycle[0]]) for cycle in cycles))
+
+    def _MergeDepends(self, new_depends):
+        for target, dependencies in new_depends.items():
+            with self._depends_lock:
+                self._depends[target] = dependencies
             for dependency in dependencies:
                 if dependency not in self._provides:
                     self._provides[dependency] = set([target])
                 else:
                     self._provides[dependency].add(target)
-                self._AddTarget(dependency)
             self._items_added.add(target)
+        self._UpdateLevels(new_depends)
+
+    def _ComputeLevel(self, target):
+        return 1 + max([self._levels[dependency]
+                        for dependency in self._depends[target]] + [-1])
+
+    def _UpdateLevels(self, targets):
+        changed = []
+        visited = set()
+        for root in targets:
+            if root in visited:
+                continue
+            work = [(root, False)]
+            while work:
+                target, dependencies_done = work.pop()
+                if dependencies_done:
+                    level = self._ComputeLevel(target)
+                    if self._levels.get(target) != level:
+                        self._levels[target] = level
+                        changed.append(target)
+                    continue
+                if target in visited:
+                    continue
+                visited.add(target)
+                work.append((target, True))
+                for dependency in self._depends[target]:
+                    if dependency in targets and dependency not in visited:
+                        work.append((dependency, False))
+        # Dependents outside of targets are recomputed once per round, not
+        # once per changed dependency
+        pending = collections.deque()
+        queued = set()
+        for target in changed:
+            for dependent in self._provides.get(target, ()):
+                if dependent not in targets and dependent not in queued:
+                    queued.add(dependent)
+                    pending.append(dependent)
+        while pending:
+            target = pending.popleft()
+            queued.remove(target)
+            level = self._ComputeLevel(target)
+            if self._levels.get(target) == level:
+                continue
+            self._levels[target] = level
+            for dependent in self._provides.get(target, ()):
+                if dependent not in queued:
+                    queued.add(dependent)
+                    pending.append(dependent)
+
+    def _AddTarget(self, target):
+        self._MergeDepends(self._ExpandTarget(target))
 
     def _RemoveTarget(self, target):
-        if target not in self._active_targets and target not in self._provides:
-            if target in self._depends:
-                dependencies = self._depends[target]
-                del self._depends[target] 
-                for dependency in dependencies:
-                    self._provides[dependency].remove(target)
-                    if not self._provides[dependency]:
-                        del self._provides[dependency]
-                    self._RemoveTarget(dependency)
-                self._items_removed.add(target)
+        removal_stack = [target]
+        while removal_stack:
+            target = removal_stack.pop()
+            if (target in self._active_targets or target in self._provides or
+                    target not in self._depends):
+                continue
+            with self._depends_lock:
+                dependencies = self._depends.pop(target)
+            del self._levels[target]
+            for dependency in dependencies:
+                self._provides[dependency].remove(target)
+                if not self._provides[dependency]:
+                    del self._provides[dependency]
+                removal_stack.append(dependency)
+            self._items_removed.add(target)
     
     def _DumpState(self):
-        logging.info("Active: %s", self._active_targets)
-        logging.info("Depends: %s", self._depends)
-        logging.info("Provides: %s", self._provides)
+        logging.info("Tracking %d targets, %d of them active",
+                len(self._depends), len(self._active_targets))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Active: %s", self._active_targets)
+            logging.debug("Depends: %s", self._depends)
+            logging.debug("Provides: %s", self._provides)
 
     def AddTrackedHandler(self, handler):
         self._on_tracked_handlers.add(handler)
@@ -77,8 +232,12 @@ class DependencyTracker(object):
    
     def _GetEligibleForRefreshItems(self, dependency_target):
         refresh_set = set([dependency_target])
-        for provide_targets in self._provides.get(dependency_target, set()):
-            refresh_set.update(self._GetEligibleForRefreshItems(provide_targets))
+        pending = [dependency_target]
+        while pending:
+            for provide_target in self._provides.get(pending.pop(), ()):
+                if provide_target not in refresh_set:
+                    refresh_set.add(provide_target)
+                    pending.append(provide_target)
         return refresh_set
 
     def _NotifyOnChanges(self):
@@ -91,41 +250,41 @@ class DependencyTracker(object):
         return final_items_added, final_items_removed
 
     def AddTopLevelTarget(self, target):
-        self._StartRecoding()
-        logging.info("Adding top level target %s", target)
-        if target not in self._active_targets:
-            self._active_targets.add(target)
-            self._AddTarget(target)
-        self._DumpState()
-        return self._NotifyOnChanges()
+        with trace.Span("AddTopLevelTarget", category="graph", top_level=target):
+            self._StartRecoding()
+            logging.info("Adding top level target %s", target)
+            if target not in self._active_targets:
+                self._AddTarget(target)
+                self._active_targets.add(target)
+            self._DumpState()
+            return self._NotifyOnChanges()
 
     def RemoveTopLevelTarget(self, target):
-        self._StartRecoding()
-        logging.info("Removing top level target %s", target)
-        if target in self._active_targets:
-            self._active_targets.remove(target)
-            self._RemoveTarget(target)
-        self._DumpState()
-        return self._NotifyOnChanges()
+        with trace.Span("RemoveTopLevelTarget", category="graph", top_level=target):
+            self._StartRecoding()
+            logging.info("Removing top level target %s", target)
+            if target in self._active_targets:
+                self._active_targets.remove(target)
+                self._RemoveTarget(target)
+            self._DumpState()
+            return self._NotifyOnChanges()
 
     def RefreshTarget(self, target):
-        self._StartRecoding()
-        logging.info("Refreshing target %s", target)
-        dependencies = self._depends[target]
-        for dependency in dependencies:
-            self._provides[dependency].remove(target)
-            if not self._provides[dependency]:
-                del self._provides[dependency]
-            self._RemoveTarget(dependency)
-        del self._depends[target]
-        self._items_removed.add(target)
-        self._AddTarget(target)
-        self._DumpState()
-        added, removed = self._NotifyOnChanges()
-        refreshed = self._GetEligibleForRefreshItems(target)
-        for refreshed_item in refreshed:
-            self._Notify(self._on_refreshed_handlers, refreshed_item)
-        return added, removed, refreshed
-    
-
-
+        with trace.Span("RefreshTarget", category="graph", refreshed=target):
+            self._StartRecoding()
+            logging.info("Refreshing target %s", target)
+            old_dependencies = self._depends[target]
+            new_depends = self._ExpandTarget(target, reload_target=True)
+            self._items_removed.add(target)
+            self._MergeDepends(new_depends)
+            for dependency in old_dependencies - self._depends[target]:
+                self._provides[dependency].remove(target)
+                if not self._provides[dependency]:
+                    del self._provides[dependency]
+                self._RemoveTarget(dependency)
+            self._DumpState()
+            added, removed = self._NotifyOnChanges()
+            refreshed = self._GetEligibleForRefreshItems(target)
+            for refreshed_item in self.GetTopologicalOrder(refreshed):
+                self._Notify(self._on_refreshed_handlers, refreshed_item)
+            return added, removed, refreshed
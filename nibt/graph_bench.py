@@ -0,0 +1,93 @@
+import argparse
+import json
+import logging
+import random
+import sys
+import time
+
+from nibt import graph
+
+# Synthetic dependency graphs, each generator returns the dependency map,
+# the top level target and a leaf target to refresh
+
+def Chain(size):
+    deps = {"t%d" % i: set(["t%d" % (i+1)]) for i in range(size-1)}
+    deps["t%d" % (size-1)] = set()
+    return deps, "t0", "t%d" % (size-1)
+
+def Diamonds(size):
+    # top/i -> left/i, right/i -> top/i+1
+    levels = max(1, size // 3)
+    deps = {}
+    for i in range(levels):
+        next_top = set(["top/%d" % (i+1)]) if i+1 < levels else set()
+        deps["top/%d" % i] = set(["left/%d" % i, "right/%d" % i])
+        deps["left/%d" % i] = next_top
+        deps["right/%d" % i] = set(next_top)
+    return deps, "top/0", "top/%d" % (levels-1)
+
+def WideFanIn(size):
+    middle = ["t%d" % i for i in range(size-2)]
+    deps = {"root": set(middle)}
+    for target in middle:
+        deps[target] = set(["leaf"])
+    deps["leaf"] = set()
+    return deps, "root", "leaf"
+
+def RandomLayers(size, layer_width=100, fan_out=5, seed=0):
+    rnd = random.Random(seed)
+    names = ["t%d" % i for i in range(size-2)]
+    layers = [names[start:start+layer_width]
+              for start in range(0, len(names), layer_width)]
+    deps = {"root": set(layers[0])}
+    for layer, next_layer in zip(layers, layers[1:] + [["leaf"]]):
+        for target in layer:
+            deps[target] = set(rnd.sample(next_layer, min(fan_out, len(next_layer))))
+    deps["leaf"] = set()
+    return deps, "root", "leaf"
+
+GENERATORS = {
+    "chain": Chain,
+    "diamonds": Diamonds,
+    "wide_fan_in": WideFanIn,
+    "random_layers": RandomLayers,
+}
+
+def Measure(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+def RunBenchmark(shape, size):
+    deps, top, leaf = GENERATORS[shape](size)
+    tracker = graph.DependencyTracker(lambda target: deps.get(target, set()))
+    _, add_time = Measure(lambda: tracker.AddTopLevelTarget(top))
+    (_, _, refreshed), refresh_time = Measure(lambda: tracker.RefreshTarget(leaf))
+    _, remove_time = Measure(lambda: tracker.RemoveTopLevelTarget(top))
+    return {
+        "shape": shape,
+        "nodes": len(deps),
+        "edges": sum(len(d) for d in deps.values()),
+        "refreshed": len(refreshed),
+        "add_s": round(add_time, 6),
+        "refresh_s": round(refresh_time, 6),
+        "remove_s": round(remove_time, 6),
+    }
+
+def Main():
+    parser = argparse.ArgumentParser(
+            description="Benchmarks DependencyTracker on synthetic graphs")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 50000])
+    parser.add_argument("--shapes", nargs="+", default=sorted(GENERATORS),
+                        choices=sorted(GENERATORS))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    for size in args.sizes:
+        for shape in args.shapes:
+            json.dump(RunBenchmark(shape, size), sys.stdout)
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    Main()
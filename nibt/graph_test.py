@@ -1,6 +1,7 @@
 import unittest
 
-from nibt import common, graph
+from nibt import common, graph, graph_bench
+import concurrent.futures
 import functools
 import logging
 
@@ -28,5 +29,90 @@ class DependencyTrackerTest(unittest.TestCase):
         logging.info("RefreshedTarget e: %s",self.d.RefreshTarget("e"))
         logging.info("RefreshedTarget b`: %s",self.d.RefreshTarget("b"))
 
+    def testStateIsConsistentAfterRefresh(self):
+        self.d.AddTopLevelTarget("a")
+        added, removed, refreshed = self.d.RefreshTarget("d")
+        self.assertEqual(set(), added)
+        self.assertEqual(set(), removed)
+        self.assertEqual(set(["a", "b", "d"]), refreshed)
+        self.assertEqual(set(["a", "b", "c", "d", "e", "f"]),
+                         set(self.d.GetAllDependencies()))
+        self.d.RemoveTopLevelTarget("a")
+        self.assertEqual({}, self.d.GetAllDependencies())
+
+    def testCycleIsReported(self):
+        deps = {
+            "a": set(["b"]),
+            "b": set(["c"]),
+            "c": set(["a"]),
+        }
+        d = graph.DependencyTracker(lambda target: deps.get(target, set()))
+        with self.assertRaises(graph.CycleError) as cm:
+            d.AddTopLevelTarget("a")
+        self.assertIn("a -> b -> c -> a", str(cm.exception))
+        self.assertEqual({}, d.GetAllDependencies())
+
+    def testCycleIntroducedByRefreshKeepsState(self):
+        deps = {
+            "a": set(["b"]),
+            "b": set(),
+        }
+        d = graph.DependencyTracker(lambda target: deps.get(target, set()))
+        d.AddTopLevelTarget("a")
+        deps["b"] = set(["a"])
+        with self.assertRaises(graph.CycleError):
+            d.RefreshTarget("b")
+        self.assertEqual({"a": set(["b"]), "b": set()}, d.GetAllDependencies())
+
+    def testDeepChain(self):
+        depth = 5000
+        d = graph.DependencyTracker(
+                lambda target: set([target+1]) if target < depth else set())
+        added, removed = d.AddTopLevelTarget(0)
+        self.assertEqual(depth+1, len(added))
+        added, removed = d.RemoveTopLevelTarget(0)
+        self.assertEqual(depth+1, len(removed))
+
+    def testConcurrentExpansion(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            d = graph.DependencyTracker(self.deps1, executor)
+            d.AddTopLevelTarget("a")
+        self.d.AddTopLevelTarget("a")
+        self.assertEqual(self.d.GetAllDependencies(), d.GetAllDependencies())
+
+    def AssertTopologicalOrder(self, d):
+        order = d.GetTopologicalOrder()
+        self.assertEqual(set(d.GetAllDependencies()), set(order))
+        position = {target: index for index, target in enumerate(order)}
+        for target, dependencies in d.GetAllDependencies().items():
+            for dependency in dependencies:
+                self.assertLess(position[dependency], position[target])
+
+    def testTopologicalOrderIsMaintained(self):
+        deps = {
+            "a": set(["b", "c"]),
+            "b": set(["d"]),
+            "c": set(),
+            "d": set(),
+        }
+        d = graph.DependencyTracker(lambda target: deps.get(target, set()))
+        d.AddTopLevelTarget("a")
+        self.AssertTopologicalOrder(d)
+        deps["c"] = set(["b"])
+        d.RefreshTarget("c")
+        self.AssertTopologicalOrder(d)
+        deps["b"] = set()
+        d.RefreshTarget("b")
+        self.AssertTopologicalOrder(d)
+        self.assertNotIn("d", d.GetAllDependencies())
+
+    def testRefreshOfDiamondLadderIsLinear(self):
+        deps, top, leaf = graph_bench.Diamonds(300)
+        d = graph.DependencyTracker(lambda target: deps.get(target, set()))
+        d.AddTopLevelTarget(top)
+        _, _, refreshed = d.RefreshTarget(leaf)
+        self.assertEqual(len(deps), len(refreshed) + 2)
+        self.AssertTopologicalOrder(d)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,15 @@
 import os
 
-from nibt import common
+from nibt import common, metrics, trace
+import contextlib
 import logging
 import time
 import threading
 
+_lock_wait = metrics.registry.Histogram(
+        "ni_build_serialization_lock_wait_seconds",
+        "Time spent waiting for the graph changes lock", ["operation"])
+
 class Manager(object):
     def __init__(self, configuration, graph, target_watcher, build_tracker,
             module_definition_evaluator):
@@ -18,25 +23,35 @@ class Manager(object):
     def Join(self):
         self.target_watcher.Join()
 
+    @contextlib.contextmanager
+    def _SerializeGraphChanges(self, operation):
+        started = time.time()
+        with self.build_serialization_lock:
+            _lock_wait.Observe(time.time() - started, operation=operation)
+            yield
+
     def GetDependencies(self, dep):
         target = self._LoadTarget(dep)
         return set(target.GetModuleDefinition().deps)
 
+    # Only graph changes are serialized, the build itself runs in the
+    # background and restarts targets whose inputs change meanwhile
+
     def AddActiveTarget(self, target_name):
-        with self.build_serialization_lock:
+        with self._SerializeGraphChanges("AddActiveTarget"):
             self.graph.AddTopLevelTarget(target_name)
-            self.build_tracker.Build()
+        self.build_tracker.Build()
    
     def BuildTarget(self, target_name):
-        with self.build_serialization_lock:
+        with self._SerializeGraphChanges("BuildTarget"):
             self.graph.AddTopLevelTarget(target_name)
-            self.build_tracker.Build()
-            return self.build_tracker.GetBuildResult(target_name)
+        self.build_tracker.Build()
+        return self.build_tracker.GetBuildResult(target_name)
 
     def RemoveActiveTarget(self, target_name):
-        with self.build_serialization_lock:
+        with self._SerializeGraphChanges("RemoveActiveTarget"):
             self.graph.RemoveTopLevelTarget(target_name)
-            self.build_tracker.Build()
+        self.build_tracker.Build()
 
     def _AddTarget(self, target_name):
         target = self._LoadTarget(target_name)
@@ -63,18 +78,21 @@ class Manager(object):
         logging.info("Manager refreshing %s", target_name)
 
     def OnModifiedFiles(self, modified_module_definitions, modified_other_files):
-        with self.build_serialization_lock:
+        with self._SerializeGraphChanges("OnModifiedFiles"):
             started_eval = time.time()
-            for modified_module_definition in modified_module_definitions:
-                self.graph.RefreshTarget(modified_module_definition.GetName())
-            for modified_other_files_item in modified_other_files:
-                self.graph.RefreshTarget(modified_other_files_item.GetName())
-            started_build = time.time()
+            trace_start = trace.Now()
+            for modified_target in (list(modified_module_definitions) +
+                                    list(modified_other_files)):
+                try:
+                    self.graph.RefreshTarget(modified_target.GetName())
+                except common.Error:
+                    logging.exception("Unable to refresh %s", modified_target)
             logging.info("Changes detection took %.0f ms",
-                    (started_build - started_eval)*1000)
-            self.build_tracker.Build()
-            logging.info("Building changed targets took %.3f sec",
-                    time.time() - started_build)
+                    (time.time() - started_eval)*1000)
+            trace.AddSpan("ChangesDetection", trace_start, category="manager",
+                    module_definitions=len(modified_module_definitions),
+                    targets=len(modified_other_files))
+        self.build_tracker.StartBuild()
 
     def _LoadTarget(self, target_name):
         target = common.Target(target_name)
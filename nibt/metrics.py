@@ -0,0 +1,231 @@
+import contextlib
+import logging
+import math
+import threading
+import time
+
+# Daemon metrics in the Prometheus text exposition format, served by the
+# web UI at /metrics. Values kept elsewhere (thread pools, caches) are
+# copied into metrics by collectors right before every exposition.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300)
+
+def _FormatValue(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def _EscapeLabelValue(value):
+    return (value.replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+def _FormatLabels(names, values):
+    if not names:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, _EscapeLabelValue(value))
+                             for name, value in zip(names, values))
+
+
+class _Metric(object):
+    type_name = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _Key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError("Metric %s has labels %s, got %s" % (
+                self.name, self.label_names, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def Clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def GetValue(self, **labels):
+        with self._lock:
+            return self._values.get(self._Key(labels), 0)
+
+    def _ExposeSamples(self, values):
+        return ["%s%s %s" % (self.name, _FormatLabels(self.label_names, key),
+                             _FormatValue(value))
+                for key, value in values]
+
+    def _Snapshot(self):
+        with self._lock:
+            return sorted(self._values.items())
+
+    def Expose(self):
+        values = self._Snapshot()
+        lines = [
+            "# HELP %s %s" % (self.name, self.help_text),
+            "# TYPE %s %s" % (self.name, self.type_name),
+        ]
+        lines.extend(self._ExposeSamples(values))
+        return lines
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def Inc(self, amount=1, **labels):
+        key = self._Key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def Set(self, value, **labels):
+        # For counts kept by another component
+        key = self._Key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def Set(self, value, **labels):
+        key = self._Key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def Inc(self, amount=1, **labels):
+        key = self._Key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def Dec(self, amount=1, **labels):
+        self.Inc(-amount, **labels)
+
+
+class _HistogramValue(object):
+    def __init__(self, buckets):
+        self.bucket_counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def Observe(self, value, **labels):
+        key = self._Key(labels)
+        with self._lock:
+            histogram_value = self._values.get(key)
+            if histogram_value is None:
+                histogram_value = _HistogramValue(self.buckets)
+                self._values[key] = histogram_value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram_value.bucket_counts[i] += 1
+                    break
+            histogram_value.sum += value
+            histogram_value.count += 1
+
+    @contextlib.contextmanager
+    def Time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.Observe(time.perf_counter() - started, **labels)
+
+    def GetValue(self, **labels):
+        with self._lock:
+            histogram_value = self._values.get(self._Key(labels))
+            if histogram_value is None:
+                return 0, 0
+            return histogram_value.count, histogram_value.sum
+
+    def _ExposeSamples(self, values):
+        lines = []
+        label_names = self.label_names + ("le",)
+        for key, histogram_value in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets,
+                                    histogram_value.bucket_counts):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (
+                    self.name,
+                    _FormatLabels(label_names, key + (_FormatValue(bound),)),
+                    cumulative))
+            labels = _FormatLabels(self.label_names, key)
+            lines.append("%s_sum%s %s" % (
+                self.name, labels, _FormatValue(histogram_value.sum)))
+            lines.append("%s_count%s %d" % (
+                self.name, labels, histogram_value.count))
+        return lines
+
+    def _Snapshot(self):
+        # Copied so that observations do not race with the exposition
+        snapshot = []
+        with self._lock:
+            for key, histogram_value in sorted(self._values.items()):
+                copy = _HistogramValue(self.buckets)
+                copy.bucket_counts = list(histogram_value.bucket_counts)
+                copy.sum = histogram_value.sum
+                copy.count = histogram_value.count
+                snapshot.append((key, copy))
+        return snapshot
+
+
+class Registry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def _Register(self, metric_class, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, *args, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, metric_class):
+                raise ValueError("Metric %s is already a %s" % (
+                    name, metric.type_name))
+            return metric
+
+    def Counter(self, name, help_text, labels=()):
+        return self._Register(Counter, name, help_text, labels)
+
+    def Gauge(self, name, help_text, labels=()):
+        return self._Register(Gauge, name, help_text, labels)
+
+    def Histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._Register(Histogram, name, help_text, labels, buckets)
+
+    def Get(self, name):
+        with self._lock:
+            return self._metrics.get(name)
+
+    def AddCollector(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def Expose(self):
+        with self._lock:
+            collectors = list(self._collectors)
+        for collector in collectors:
+            try:
+                collector()
+            except Exception:
+                logging.exception("Metrics collector %s failed", collector)
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for _, metric in metrics:
+            lines.extend(metric.Expose())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
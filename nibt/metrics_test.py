@@ -0,0 +1,40 @@
+import unittest
+
+from nibt import metrics
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def testCounterAndGaugeExposition(self):
+        builds = self.registry.Counter(
+                "builds_total", "Builds", ["target", "status"])
+        queued = self.registry.Gauge("queued", "Queued tasks", ["pool"])
+        builds.Inc(target="a/b", status="ok")
+        builds.Inc(2, target="a/b", status="ok")
+        self.registry.AddCollector(lambda: queued.Set(4, pool="wave"))
+
+        text = self.registry.Expose()
+        self.assertIn("# TYPE builds_total counter\n", text)
+        self.assertIn('builds_total{target="a/b",status="ok"} 3\n', text)
+        self.assertIn('queued{pool="wave"} 4\n', text)
+        self.assertIs(builds, self.registry.Counter(
+                "builds_total", "Builds", ["target", "status"]))
+        with self.assertRaises(ValueError):
+            builds.Inc(target="a/b")
+
+    def testHistogramBucketsAreCumulative(self):
+        latency = self.registry.Histogram(
+                "latency_seconds", "Latency", buckets=(0.1, 1))
+        for value in [0.05, 0.5, 0.5, 5]:
+            latency.Observe(value)
+
+        lines = self.registry.Expose().splitlines()
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{le="1"} 3', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('latency_seconds_sum 6.05', lines)
+        self.assertIn('latency_seconds_count 4', lines)
+
+if __name__ == '__main__':
+    unittest.main()
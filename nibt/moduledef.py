@@ -1,8 +1,9 @@
-from nibt import common
+from nibt import common, trace
 
 import copy
 import logging
 import os
+import threading
 
 
 class ModuleDefinitionFactory(object):
@@ -65,13 +66,25 @@ class DirectoryModulesConfiguration(object):
         if not target_name.startswith(self.relative_dir):
             raise ValueError("DirectoryModulesConfiguration for '"+self.relative_dir+"' does not"
                     " contain configuration for '+"+target_name+"'")
-        target_in_dir = target_name[len(self.relative_dir)+1:]
+        if self.relative_dir:
+            target_in_dir = target_name[len(self.relative_dir)+1:]
+        else:
+            target_in_dir = target_name
         logging.info("Querying %s for %s", self.explicit_targets, target_in_dir)
-        return self.explicit_targets[target_in_dir]
+        # Definitions are cached and shared by all loads of the directory
+        return copy.deepcopy(self.explicit_targets[target_in_dir])
     
     def __repr__(self):
         return "DirectoryModulesConfiguration(explicit=%s)" % (self.explicit_targets,)
 
+class ModuleDefinitionCacheEntry(object):
+    def __init__(self, stamps, targets_definition_accumulator, found_targets,
+                 dir_modules):
+        self.stamps = stamps
+        self.targets_definition_accumulator = targets_definition_accumulator
+        self.found_targets = found_targets
+        self.dir_modules = dir_modules
+
 class Evaluator(object):
     def __init__(self, target_factories, configuration):
         self._moddef_filename = configuration.Get(
@@ -79,30 +92,95 @@ class Evaluator(object):
         self._root_dir = configuration.GetExpandedDir(
                 "projects","root_dir")
         self._target_factories = target_factories
+        # Module definition path -> (stamp, code object)
+        self._code_cache = {}
+        # Relative dir -> ModuleDefinitionCacheEntry
+        self._modules_cache = {}
+        self._cache_lock = threading.Lock()
         
     def GetModuleDefinitionForPath(self, path):
         return os.path.join(path, self._moddef_filename)
 
-    def LoadModuleDefinition(self, relative_target_dir):
-        logging.info("Reading module definitions for configs in %s", relative_target_dir)
+    def InvalidateModuleDefinition(self, relative_dir):
+        logging.info("Invalidating module definitions under '%s'", relative_dir)
+        module_definition_path = self.GetModuleDefinitionForPath(
+                os.path.join(self._root_dir, relative_dir))
+        prefix = os.path.join(relative_dir, "") if relative_dir else ""
+        with self._cache_lock:
+            self._code_cache.pop(module_definition_path, None)
+            for cached_dir in list(self._modules_cache.keys()):
+                if cached_dir == relative_dir or cached_dir.startswith(prefix):
+                    del self._modules_cache[cached_dir]
+
+    def _GetStamp(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _GetCode(self, module_definition_path, stamp):
+        with self._cache_lock:
+            cached = self._code_cache.get(module_definition_path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        logging.info("Reading %s...", module_definition_path)
+        with open(module_definition_path, "r") as f:
+            code = compile(f.read(), module_definition_path, "exec")
+        with self._cache_lock:
+            self._code_cache[module_definition_path] = (stamp, code)
+        return code
+
+    def _CopyTargetsDefinitionAccumulator(self, targets_definition_accumulator):
+        return TargetsDefinitionAccumulator(
+                list(targets_definition_accumulator.targets_dict.values()))
 
-        current_module_def_dir = self._root_dir
+    def LoadModuleDefinition(self, relative_target_dir):
+        with trace.Span("LoadModuleDefinition", category="moduledef",
+                        dir=relative_target_dir):
+            return self._LoadModuleDefinition(relative_target_dir)
 
-        targets_definition_accumulator = TargetsDefinitionAccumulator(self._target_factories)
+    def _LoadModuleDefinition(self, relative_target_dir):
+        logging.info("Reading module definitions for configs in %s", relative_target_dir)
 
-        module_evaluation_context = ModuleEvaluationContext(targets_definition_accumulator)
-        relative_dir = ""
-        found_targets = {}
-        for dir_in_path in [""]+relative_target_dir.split("/"):
-            relative_dir = os.path.join(relative_dir, dir_in_path)
+        relative_dirs = [""]
+        for dir_in_path in relative_target_dir.split("/"):
+            if dir_in_path:
+                relative_dirs.append(os.path.join(relative_dirs[-1], dir_in_path))
+        module_definition_paths = [
+                self.GetModuleDefinitionForPath(
+                    os.path.join(self._root_dir, relative_dir))
+                for relative_dir in relative_dirs]
+        stamps = [self._GetStamp(path) for path in module_definition_paths]
+
+        # Resume from the deepest directory whose definitions are still valid
+        cache_entry = None
+        with self._cache_lock:
+            for level, relative_dir in enumerate(relative_dirs):
+                entry = self._modules_cache.get(relative_dir)
+                if entry is None or entry.stamps != stamps[:level+1]:
+                    break
+                cache_entry = entry
+                first_level = level + 1
+        if cache_entry is None:
+            first_level = 0
+            targets_definition_accumulator = TargetsDefinitionAccumulator(self._target_factories)
+            found_targets = {}
+            dir_modules = None
+        else:
+            targets_definition_accumulator = self._CopyTargetsDefinitionAccumulator(
+                    cache_entry.targets_definition_accumulator)
+            found_targets = dict(cache_entry.found_targets)
+            dir_modules = cache_entry.dir_modules
+
+        for level in range(first_level, len(relative_dirs)):
+            relative_dir = relative_dirs[level]
             logging.info("Relative dir: '%s'", relative_dir)
             module_evaluation_context = ModuleEvaluationContext(targets_definition_accumulator)
-            current_module_def_dir = os.path.join(current_module_def_dir, dir_in_path)
-            module_definition_path = self.GetModuleDefinitionForPath(current_module_def_dir)
-            if os.path.exists(module_definition_path):
-                logging.info("Reading %s...", module_definition_path)
-                with open(module_definition_path, "r") as f:
-                    exec(f.read(), module_evaluation_context.GetEnv()) 
+            module_definition_path = module_definition_paths[level]
+            if stamps[level] is not None:
+                code = self._GetCode(module_definition_path, stamps[level])
+                exec(code, module_evaluation_context.GetEnv()) 
             else:
                 logging.debug("No module definition at %s found.",
                         module_definition_path)
@@ -116,12 +194,17 @@ class Evaluator(object):
             for local_target_name, module_definition in discovered_modules.items():
                 found_targets[local_target_name] = module_definition
         
-        dir_modules = DirectoryModulesConfiguration(
-                relative_dir,
-                found_targets)
+            dir_modules = DirectoryModulesConfiguration(
+                    relative_dir,
+                    dict(found_targets))
+            with self._cache_lock:
+                self._modules_cache[relative_dir] = ModuleDefinitionCacheEntry(
+                        stamps[:level+1],
+                        self._CopyTargetsDefinitionAccumulator(
+                            targets_definition_accumulator),
+                        dict(found_targets),
+                        dir_modules)
         
         logging.info("Parsed following modules: %s", dir_modules)
 
         return dir_modules
-    
-
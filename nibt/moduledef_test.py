@@ -0,0 +1,91 @@
+import unittest
+
+from nibt import moduledef
+import os
+import shutil
+import tempfile
+import time
+
+class FakeConfiguration(object):
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def Get(self, section, key, raise_exception=True, default=None):
+        return "ni.py"
+
+    def GetExpandedDir(self, section, key, raise_exception=True, default=None):
+        return self.root_dir
+
+class Library(moduledef.ModuleDefinitionFactory):
+    cflags = []
+    deps = []
+
+class EvaluatorTest(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.root_dir, "evaluations.log")
+        self.WriteModuleDefinition("", "targets.Library.cflags.append('-DROOT')\n")
+        self.WriteModuleDefinition("a", "modules.x = targets.Library()\n")
+        self.WriteModuleDefinition("b", "modules.y = targets.Library()\n"
+                                        "modules.y.deps = ['a/x']\n")
+        self.evaluator = moduledef.Evaluator(
+                [Library], FakeConfiguration(self.root_dir))
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def WriteModuleDefinition(self, relative_dir, content):
+        path = os.path.join(self.root_dir, relative_dir, "ni.py")
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write("open(%r, 'a').write('%s;')\n" % (self.log_path, relative_dir))
+            f.write(content)
+
+    def GetEvaluations(self):
+        with open(self.log_path) as f:
+            evaluations = f.read().split(";")[:-1]
+        os.remove(self.log_path)
+        return evaluations
+
+    def testDefinitions(self):
+        x = self.evaluator.LoadModuleDefinition("a").GetConfig("a/x")
+        y = self.evaluator.LoadModuleDefinition("b").GetConfig("b/y")
+        self.assertEqual(["-DROOT"], x.cflags)
+        self.assertEqual(["-DROOT"], y.cflags)
+        self.assertEqual(["a/x"], y.deps)
+
+    def testCachedDefinitionsAreNotShared(self):
+        x = self.evaluator.LoadModuleDefinition("a").GetConfig("a/x")
+        x.cflags.append("-DCHANGED")
+        x = self.evaluator.LoadModuleDefinition("a").GetConfig("a/x")
+        self.assertEqual(["-DROOT"], x.cflags)
+
+    def testParentDefinitionsAreEvaluatedOnce(self):
+        self.evaluator.LoadModuleDefinition("a")
+        self.evaluator.LoadModuleDefinition("b")
+        self.evaluator.LoadModuleDefinition("a")
+        self.assertEqual(["", "a", "b"], self.GetEvaluations())
+
+    def testInvalidation(self):
+        self.evaluator.LoadModuleDefinition("a")
+        self.evaluator.LoadModuleDefinition("b")
+        self.GetEvaluations()
+        self.evaluator.InvalidateModuleDefinition("")
+        self.evaluator.LoadModuleDefinition("a")
+        self.assertEqual(["", "a"], self.GetEvaluations())
+
+    def testModifiedDefinitionIsReevaluated(self):
+        self.evaluator.LoadModuleDefinition("a")
+        self.GetEvaluations()
+        self.WriteModuleDefinition("a", "modules.x = targets.Library()\n"
+                                        "modules.x.deps = ['c']\n")
+        # Make the stamp differ even on coarse mtime filesystems
+        later = time.time() + 10
+        os.utime(os.path.join(self.root_dir, "a", "ni.py"), (later, later))
+        x = self.evaluator.LoadModuleDefinition("a").GetConfig("a/x")
+        self.assertEqual(["c"], x.deps)
+        self.assertEqual(["a"], self.GetEvaluations())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,360 @@
+import argparse
+import collections
+import functools
+import json
+import logging
+import os
+import resource
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+from pkg_resources import resource_stream
+
+from nibt import config, thread_pools, pkg_config, graph, state, trace
+from nibt import compile_db, build, notify, moduledef, manager, cpp, metrics
+from nibt import graph_bench
+
+# End to end incremental build benchmark on a generated project tree. The
+# daemon is driven through Manager like the D-Bus interface does, file
+# events are injected in process and a fake compiler only sleeps and
+# writes placeholder outputs, so the numbers measure nibt itself.
+
+FAKE_COMPILER = """#!%(python)s
+import os
+import re
+import sys
+import time
+import zlib
+
+INCLUDE = re.compile(r'^\\s*#\\s*include\\s+"([^"]+)"', re.M)
+VALUE_ARGS = set(["-o", "-MF", "-MT", "-MQ", "-x", "-include", "-include-pch"])
+
+def FindHeaders(source, include_dirs, found):
+    with open(source) as f:
+        text = f.read()
+    for name in INCLUDE.findall(text):
+        for include_dir in [os.path.dirname(source)] + include_dirs:
+            path = os.path.join(include_dir, name)
+            if os.path.exists(path):
+                if path not in found:
+                    found.add(path)
+                    FindHeaders(path, include_dirs, found)
+                break
+
+def Main(args):
+    if "--version" in args:
+        print("nibt benchmark compiler")
+        return 0
+    compiling = "-c" in args or "-x" in args
+    headers = set()
+    options = {}
+    inputs = []
+    include_dirs = []
+    args = iter(args)
+    for arg in args:
+        if arg in VALUE_ARGS:
+            options[arg] = next(args)
+        elif arg.startswith("-I"):
+            include_dirs.append(arg[2:])
+        elif not arg.startswith("-"):
+            inputs.append(arg)
+    if compiling:
+        time.sleep(%(compile_ms)d / 1000.0)
+        for source in inputs:
+            FindHeaders(source, include_dirs, headers)
+        if "-MF" in options:
+            with open(options["-MF"], "w") as f:
+                f.write("%%s: %%s\\n" %% (options["-o"], " ".join(
+                    inputs + sorted(headers))))
+    else:
+        time.sleep(%(link_ms)d / 1000.0)
+    # Outputs change together with their inputs
+    with open(options["-o"], "w") as f:
+        for path in inputs + sorted(headers):
+            with open(path, "rb") as input_file:
+                f.write("%%s %%d\\n" %% (path, zlib.crc32(input_file.read())))
+    if not compiling:
+        os.chmod(options["-o"], 0o755)
+    return 0
+
+sys.exit(Main(sys.argv[1:]))
+"""
+
+# Only work directories containing this file are cleaned up before a run
+WORK_DIR_MARKER = ".ni-bench"
+
+SETTINGS = """
+[projects]
+root_dir=%(root)s
+
+[file_watcher]
+event_batch_timeout_ms=%(batch_timeout_ms)d
+
+[object_cache]
+enabled=false
+
+[pkg_config]
+cache_file=%(work_dir)s/pkg_config.json
+
+[cpp]
+compiler=%(compiler)s
+
+[trace]
+enabled=false
+"""
+
+def _LibraryDir(node):
+    return "libs/" + node.replace("/", "_")
+
+def GenerateTree(root, shape, libraries, sources):
+    # Every library header includes the headers of its dependencies, so
+    # editing the header of the bottom library recompiles everything
+    deps, top, leaf = graph_bench.GENERATORS[shape](libraries)
+    for node, node_deps in deps.items():
+        lib_dir = os.path.join(root, _LibraryDir(node))
+        os.makedirs(lib_dir)
+        dep_dirs = sorted(_LibraryDir(dep) for dep in node_deps)
+        with open(os.path.join(lib_dir, "ni.py"), "w") as f:
+            f.write("modules.lib = targets.CppLibrary()\n")
+            f.write("modules.lib.sources = ['*.cc']\n")
+            f.write("modules.lib.deps = %r\n" % (
+                [dep_dir + "/lib" for dep_dir in dep_dirs],))
+        with open(os.path.join(lib_dir, "lib.h"), "w") as f:
+            f.write("#pragma once\n")
+            for dep_dir in dep_dirs:
+                f.write('#include "%s/lib.h"\n' % dep_dir)
+            f.write("int %s_value();\n" % node.replace("/", "_"))
+        for i in range(sources):
+            with open(os.path.join(lib_dir, "s%d.cc" % i), "w") as f:
+                f.write('#include "%s/lib.h"\n' % _LibraryDir(node))
+                f.write("int s%d() { return %d; }\n" % (i, i))
+    app_dir = os.path.join(root, "app")
+    os.makedirs(app_dir)
+    with open(os.path.join(app_dir, "ni.py"), "w") as f:
+        f.write("modules.mainlib = targets.CppLibrary()\n")
+        f.write("modules.mainlib.sources = ['main.cc']\n")
+        f.write("modules.mainlib.deps = ['%s/lib']\n" % _LibraryDir(top))
+        f.write("modules.main = targets.CppBinary()\n")
+        f.write("modules.main.deps = ['app/mainlib']\n")
+    with open(os.path.join(app_dir, "main.cc"), "w") as f:
+        f.write('#include "%s/lib.h"\n' % _LibraryDir(top))
+        f.write("int main() { return 0; }\n")
+    return {
+        "libraries": len(deps),
+        "sources": len(deps) * sources + 1,
+        "leaf_source": os.path.join(root, _LibraryDir(top), "s0.cc"),
+        "root_header": os.path.join(root, _LibraryDir(leaf), "lib.h"),
+    }
+
+def WriteFakeCompiler(path, compile_ms, link_ms):
+    with open(path, "w") as f:
+        f.write(FAKE_COMPILER % {
+            "python": sys.executable,
+            "compile_ms": compile_ms,
+            "link_ms": link_ms,
+        })
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+
+FileEvent = collections.namedtuple("FileEvent", ["mask", "pathname", "dir"])
+
+class InProcessTargetWatcher(notify.TargetWatcher):
+    # File events are reported by the benchmark instead of inotify
+
+    def _StartNotifier(self):
+        pass
+
+    def Join(self):
+        pass
+
+    def NotifyModified(self, path):
+        self.ProcessEvent(FileEvent(
+            notify.EventsCodes.ALL_FLAGS['IN_MODIFY'], path, False))
+
+
+class BenchmarkDaemon(object):
+    # Server without the D-Bus interface and the web UI
+
+    def __init__(self, settings_path):
+        self.configuration = config.Configuration([
+            settings_path, resource_stream("nibt", "default_settings.ini")])
+        self.threading_manager = thread_pools.ThreadingManager(self.configuration)
+        self.pkg_config = pkg_config.PkgConfig(self.configuration)
+        self.graph = graph.DependencyTracker(
+                lambda deps: self.manager.GetDependencies(deps),
+                self.threading_manager.GetThreadPool("graph"))
+        self.compilation_database = compile_db.Database(
+                self.configuration, self.threading_manager)
+        self.targets_state = build.TargetsState()
+        self.state_store = state.StateStore(self.configuration)
+        self.trace_store = trace.TraceStore(self.configuration)
+        self.builder = build.Builder(
+                self.configuration, self.targets_state, self.state_store)
+        self.build_tracker = build.BuildTracker(
+                self.graph, self.targets_state, self.builder,
+                self.compilation_database, self.threading_manager,
+                self.trace_store)
+        self.watch_index = notify.WatchIndex()
+        self.target_watcher = InProcessTargetWatcher(
+                self.configuration, self.builder, self.watch_index)
+        self.cpp_plugin = cpp.CppPlugin(
+                self.compilation_database, self.pkg_config,
+                self.threading_manager, self.configuration, self.state_store)
+        self.cpp_plugin.RegisterBuilders(self.builder)
+        self.module_definition_evaluator = moduledef.Evaluator(
+                self.cpp_plugin.GetTargets(), self.configuration)
+        self.manager = manager.Manager(
+                self.configuration, self.graph, self.target_watcher,
+                self.build_tracker, self.module_definition_evaluator)
+
+        self.graph.AddTrackedHandler(
+                functools.partial(manager.Manager.OnTracked, self.manager))
+        self.graph.AddUntrackedHandler(
+                functools.partial(manager.Manager.OnUntracked, self.manager))
+        self.graph.AddRefreshingHandler(
+                functools.partial(manager.Manager.OnRefreshedAsDependency, self.manager))
+        self.target_watcher.AddModuleDefinitionChangeHandler(
+                self.module_definition_evaluator.InvalidateModuleDefinition)
+        self.target_watcher.AddDeletionHandler(
+                self.compilation_database.OnFileDeleted)
+        self.target_watcher.AddModificationHandler(
+                functools.partial(manager.Manager.OnModifiedFiles, self.manager))
+        self._modifications = threading.Event()
+        self.target_watcher.AddModificationHandler(self._OnModifiedFiles)
+
+    def _OnModifiedFiles(self, modified_module_definitions, modified_targets):
+        self._modifications.set()
+
+    def ModifyAndBuild(self, path, content, timeout):
+        # Returns False when no target was affected by the change
+        self._modifications.clear()
+        with open(path, "w") as f:
+            f.write(content)
+        self.target_watcher.NotifyModified(path)
+        if not self._modifications.wait(timeout):
+            return False
+        self.build_tracker.Build()
+        return True
+
+    def Join(self):
+        self.threading_manager.Join()
+
+
+def GetRss():
+    # Current and peak resident set size in MB
+    current = 0
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    current = int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    peak = max(current,
+               resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+    return round(current, 1), round(peak, 1)
+
+def _GetProcessCount(program):
+    processes = metrics.registry.Get("ni_processes_total")
+    return sum(processes.GetValue(program=program, status=status)
+               for status in ["ok", "failed", "cancelled"])
+
+def RunBenchmark(shape, libraries, sources, compile_ms, link_ms,
+                 batch_timeout_ms, work_dir):
+    root = os.path.join(work_dir, "root")
+    os.makedirs(root)
+    tree = GenerateTree(root, shape, libraries, sources)
+    compiler = os.path.join(work_dir, "bench-cc")
+    WriteFakeCompiler(compiler, compile_ms, link_ms)
+    settings_path = os.path.join(work_dir, "settings.ini")
+    with open(settings_path, "w") as f:
+        f.write(SETTINGS % {
+            "root": root,
+            "work_dir": work_dir,
+            "compiler": compiler,
+            "batch_timeout_ms": batch_timeout_ms,
+        })
+
+    daemon = BenchmarkDaemon(settings_path)
+    results = collections.OrderedDict([
+        ("shape", shape),
+        ("libraries", tree["libraries"]),
+        ("sources", tree["sources"]),
+        ("compile_ms", compile_ms),
+        ("link_ms", link_ms),
+    ])
+
+    def Measure(step, func):
+        processes = _GetProcessCount(os.path.basename(compiler))
+        started = time.perf_counter()
+        affected = func()
+        results[step + "_s"] = round(time.perf_counter() - started, 4)
+        results[step + "_processes"] = (
+            _GetProcessCount(os.path.basename(compiler)) - processes)
+        if affected is False:
+            logging.warning("%s did not trigger a build", step)
+
+    def Edit(path, suffix):
+        with open(path) as f:
+            content = f.read()
+        return lambda: daemon.ModifyAndBuild(path, content + suffix, timeout)
+
+    timeout = 60 + batch_timeout_ms / 1000.0
+    Measure("cold", lambda: daemon.manager.AddActiveTarget("app/main"))
+    Measure("noop", Edit(tree["leaf_source"], ""))
+    Measure("leaf_source_edit",
+            Edit(tree["leaf_source"], "int bench_edit() { return 1; }\n"))
+    Measure("root_header_edit",
+            Edit(tree["root_header"], "int bench_edit();\n"))
+    results["rss_mb"], results["peak_rss_mb"] = GetRss()
+    if not daemon.builder.GetBuildResult("app/main")[0].ok():
+        results["error"] = daemon.builder.GetBuildResult(
+                "app/main")[0].GetErrorMessage()
+    daemon.Join()
+    return results
+
+def Main():
+    parser = argparse.ArgumentParser(
+            description="Benchmarks incremental builds of a synthetic tree")
+    parser.add_argument("--shape", default="random_layers",
+                        choices=sorted(graph_bench.GENERATORS))
+    parser.add_argument("--libraries", type=int, default=100)
+    parser.add_argument("--sources", type=int, default=10,
+                        help="Sources per library")
+    parser.add_argument("--compile-ms", type=int, default=50)
+    parser.add_argument("--link-ms", type=int, default=200)
+    parser.add_argument("--batch-timeout-ms", type=int, default=100)
+    parser.add_argument("--work-dir",
+                        help="Kept after the run, a temporary one by "
+                        "default. An existing one must be empty or from a "
+                        "previous run")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.work_dir:
+        work_dir = args.work_dir
+        marker_path = os.path.join(work_dir, WORK_DIR_MARKER)
+        if os.path.exists(work_dir) and os.listdir(work_dir):
+            if not os.path.exists(marker_path):
+                parser.error("%s is not empty and was not created by this "
+                             "benchmark" % work_dir)
+            shutil.rmtree(work_dir)
+        os.makedirs(work_dir, exist_ok=True)
+        open(marker_path, "w").close()
+    else:
+        work_dir = tempfile.mkdtemp(prefix="ni-bench-")
+    try:
+        results = RunBenchmark(args.shape, args.libraries, args.sources,
+                               args.compile_ms, args.link_ms,
+                               args.batch_timeout_ms, work_dir)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    json.dump(results, sys.stdout)
+    sys.stdout.write("\n")
+
+if __name__ == '__main__':
+    Main()
@@ -7,34 +7,137 @@ import threading
 import time
 import queue
 import fnmatch
+import re
 
+from nibt import metrics, trace
+
+_batch_events = metrics.registry.Histogram(
+        "ni_inotify_batch_events", "inotify events processed per batch",
+        buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 20000))
+_watch_index_globs = metrics.registry.Gauge(
+        "ni_watch_index_globs", "Globs watched for changes, by kind", ["kind"])
+_watch_index_targets = metrics.registry.Gauge(
+        "ni_watch_index_targets", "Targets with watched globs")
+
+
+GLOB_CHARS = frozenset("*?[")
+
+def _IsGlob(rel_path):
+    return not GLOB_CHARS.isdisjoint(rel_path)
+
+class GlobTrieNode(object):
+    def __init__(self):
+        self.children = {}
+        # Glob -> compiled matcher of the part after this node's prefix
+        self.patterns = {}
 
 class WatchIndex(object):
     def __init__(self):
         self.target_by_glob = collections.defaultdict(dict)
         self.globs_by_target = {}
+        self.glob_trie = GlobTrieNode()
+        self.lock = threading.RLock()
+
+    def _SplitGlob(self, rel_glob):
+        components = rel_glob.split("/")
+        for index, component in enumerate(components):
+            if _IsGlob(component):
+                return components[:index], "/".join(components[index:])
+        return components, ""
+
+    def _AddGlobToTrie(self, rel_glob):
+        prefix, wildcard_suffix = self._SplitGlob(rel_glob)
+        node = self.glob_trie
+        for component in prefix:
+            node = node.children.setdefault(component, GlobTrieNode())
+        node.patterns[rel_glob] = re.compile(
+                fnmatch.translate(wildcard_suffix)).match
+
+    def _RemoveGlobFromTrie(self, rel_glob):
+        prefix, _ = self._SplitGlob(rel_glob)
+        nodes = [self.glob_trie]
+        for component in prefix:
+            nodes.append(nodes[-1].children[component])
+        del nodes[-1].patterns[rel_glob]
+        # Prune branches left without patterns
+        for depth in range(len(prefix), 0, -1):
+            if nodes[depth].patterns or nodes[depth].children:
+                break
+            del nodes[depth-1].children[prefix[depth-1]]
+
+    def _GetMatchingGlobs(self, rel_path):
+        found_globs = []
+        if rel_path in self.target_by_glob and not _IsGlob(rel_path):
+            found_globs.append(rel_path)
+        components = rel_path.split("/")
+        node = self.glob_trie
+        depth = 0
+        while node is not None:
+            # Below the root the suffix is matched after a '/' separator
+            if node.patterns and (depth == 0 or depth < len(components)):
+                remainder = "/".join(components[depth:])
+                for rel_glob, match in node.patterns.items():
+                    if match(remainder):
+                        found_globs.append(rel_glob)
+            if depth == len(components):
+                break
+            node = node.children.get(components[depth])
+            depth += 1
+        return found_globs
+
+    def UpdateMetrics(self):
+        with self.lock:
+            wildcard_globs = sum(1 for rel_glob in self.target_by_glob
+                                 if _IsGlob(rel_glob))
+            _watch_index_globs.Set(wildcard_globs, kind="wildcard")
+            _watch_index_globs.Set(len(self.target_by_glob) - wildcard_globs,
+                                   kind="exact")
+            _watch_index_targets.Set(len(self.globs_by_target))
 
     def GetMatchingTargets(self, rel_path):
-        #TODO Use efficient search instead of linear scan across dict
         found_targets = {}
-        for glob_pattern, targets in self.target_by_glob.items():
-            if fnmatch.fnmatchcase(rel_path, glob_pattern):
-                found_targets.update(targets)
+        with self.lock:
+            for rel_glob in self._GetMatchingGlobs(rel_path):
+                found_targets.update(self.target_by_glob[rel_glob])
         if found_targets:
             logging.info("Found targets for '%s': %s",
                          rel_path, found_targets)
         else:
             logging.info("No targets for '%s'", rel_path)
         return found_targets
+
+    def GetMatchingTargetsBatch(self, rel_paths):
+        found_targets = {}
+        matched_paths = 0
+        with self.lock:
+            for rel_path in set(rel_paths):
+                found_globs = self._GetMatchingGlobs(rel_path)
+                if found_globs:
+                    matched_paths += 1
+                for rel_glob in found_globs:
+                    found_targets.update(self.target_by_glob[rel_glob])
+        logging.info("%d of %d paths matched targets %s", matched_paths,
+                     len(rel_paths), sorted(found_targets))
+        return found_targets
     
     def LoadGlobsForTarget(self, target, rel_globs):
         logging.info("Setting watchable sources for %s: %s", target, rel_globs)
-        for targets_glob in self.globs_by_target.get(
-                target.GetName(),[]):
-            del self.target_by_glob[targets_glob][target.GetName()]
-        self.globs_by_target[target.GetName()] = rel_globs
-        for rel_glob in rel_globs:
-            self.target_by_glob[rel_glob][target.GetName()] = target
+        with self.lock:
+            for targets_glob in set(self.globs_by_target.get(
+                    target.GetName(),[])):
+                del self.target_by_glob[targets_glob][target.GetName()]
+                if not self.target_by_glob[targets_glob]:
+                    del self.target_by_glob[targets_glob]
+                    if _IsGlob(targets_glob):
+                        self._RemoveGlobFromTrie(targets_glob)
+            if rel_globs:
+                self.globs_by_target[target.GetName()] = rel_globs
+            else:
+                self.globs_by_target.pop(target.GetName(), None)
+            for rel_glob in rel_globs:
+                if rel_glob not in self.target_by_glob and _IsGlob(rel_glob):
+                    self._AddGlobToTrie(rel_glob)
+                self.target_by_glob[rel_glob][target.GetName()] = target
 
 
 class TargetWatcher(object):
@@ -45,27 +148,38 @@ class TargetWatcher(object):
             configuration.Get("file_watcher", "event_batch_timeout_ms")) / 1000
         self._moddef_filename = configuration.Get(
                 "general", "module_definition_filename")
-        self.wm = WatchManager()
-        
         self.watch_index = watch_index
         self.watched_module_definitions = collections.defaultdict(dict)
+        self.watched_targets = {}
+        self._builder.AddBuildFinishHandler(self.OnBuildFinished)
 
-        mask = (EventsCodes.ALL_FLAGS['IN_DELETE'] | 
-                EventsCodes.ALL_FLAGS['IN_CREATE'] |
-                EventsCodes.ALL_FLAGS['IN_MODIFY'] )
-        handler = functools.partial(TargetWatcher.ProcessEvent, self)
-        
         self.events_queue = queue.Queue()
+        self.modification_handlers = []
+        self.module_definition_change_handlers = []
+        self.deletion_handlers = []
 
         self.acc_thread = threading.Thread(target=functools.partial(
             TargetWatcher.AccumulationThreadProc, self), daemon=True)
         self.acc_thread.start()
-        
+
+        self._StartNotifier()
+
+    def _StartNotifier(self):
+        mask = (EventsCodes.ALL_FLAGS['IN_DELETE'] | 
+                EventsCodes.ALL_FLAGS['IN_CREATE'] |
+                EventsCodes.ALL_FLAGS['IN_MODIFY'] )
+        handler = functools.partial(TargetWatcher.ProcessEvent, self)
+        self.wm = WatchManager()
         self.notifier = ThreadedNotifier(self.wm, handler)
         self.notifier.start()
         self.watch = self.wm.add_watch(
-                self._root, mask, rec=True, auto_add=True)
-        self.modification_handlers = []
+                self._root, mask, rec=True, auto_add=True,
+                exclude_filter=self._IsExcludedFromWatch)
+
+    def _IsExcludedFromWatch(self, path):
+        # Build state and traces are written under it during builds
+        state_dir = os.path.join(self._root, ".nibt")
+        return path == state_dir or path.startswith(state_dir + os.sep)
     
     def _GetAllModuleDefinitionsForTarget(self, target_name):
         prefix = ""
@@ -81,19 +195,34 @@ class TargetWatcher(object):
     def AddModificationHandler(self, handler):
         self.modification_handlers.append(handler)
 
+    def AddModuleDefinitionChangeHandler(self, handler):
+        self.module_definition_change_handlers.append(handler)
+
+    def AddDeletionHandler(self, handler):
+        self.deletion_handlers.append(handler)
+
     def ProcessEventsBatch(self, batch):
         modified_targets = set()
         modified_module_definitions = set()
         root_prefix_len = len(self._root)
+        other_rel_paths = []
         for event in batch:
+            if event.mask & EventsCodes.ALL_FLAGS['IN_DELETE']:
+                for handler in self.deletion_handlers:
+                    handler(event.pathname, event.dir)
             rel_path = event.pathname[root_prefix_len+1:]
             if rel_path.endswith(self._moddef_filename):
                 conf_dir = rel_path[:-len(self._moddef_filename)-1]
+                for handler in self.module_definition_change_handlers:
+                    handler(conf_dir)
                 modified_module_definitions.update(
                     set(self.watched_module_definitions[conf_dir].values()))
             else:
-                found_targets = self.watch_index.GetMatchingTargets(rel_path)
-                modified_targets.update(found_targets.values())
+                other_rel_paths.append(rel_path)
+        if other_rel_paths:
+            found_targets = self.watch_index.GetMatchingTargetsBatch(
+                    other_rel_paths)
+            modified_targets.update(found_targets.values())
 
         if modified_module_definitions or modified_targets:
             self.ModificationsFound(modified_module_definitions,
@@ -114,11 +243,17 @@ class TargetWatcher(object):
                             block=True,timeout=self._batch_timeout)
                 else:
                     item = self.events_queue.get(block=True)
+                    batch_start = trace.Now()
                 event_buffer.append(item)
             except queue.Empty as e:
+                trace.AddSpan("EventBatching", batch_start, category="watcher",
+                              events=len(event_buffer))
+                _batch_events.Observe(len(event_buffer))
                 try:
-                    self.ProcessEventsBatch(event_buffer[:])
-                except e:
+                    with trace.Span("ProcessEventsBatch", category="watcher",
+                                    events=len(event_buffer)):
+                        self.ProcessEventsBatch(event_buffer[:])
+                except Exception:
                     logging.exception("Uncaught change event processing error")
                 event_buffer = []
 
@@ -131,20 +266,29 @@ class TargetWatcher(object):
     def _RefreshGlobs(self, target):
         watched_globs = self._builder.GetWatchableSources(target.GetName())
         target_dir = os.path.dirname(target.GetName())
-        rel_globs = [os.path.join(target_dir, glob_p)
+        rel_globs = [os.path.normpath(os.path.join(target_dir, glob_p))
                      for glob_p in watched_globs]
         self.watch_index.LoadGlobsForTarget(target, rel_globs) 
 
+    def OnBuildFinished(self, target_name, result):
+        # Header dependencies are only known after compilation
+        target = self.watched_targets.get(target_name)
+        if target is not None:
+            self._RefreshGlobs(target)
+
     def ReloadTarget(self, target):
+        self.watched_targets[target.GetName()] = target
         self._RefreshGlobs(target)
 
     def AddTarget(self, target): 
+        self.watched_targets[target.GetName()] = target
         self._RefreshGlobs(target)
         for prefix in self._GetAllModuleDefinitionsForTarget(target.GetName()):
             self.watched_module_definitions[prefix][target.GetName()]=target
 
     def RemoveTarget(self, target):
-        del self.watched[target.GetName()]
+        del self.watched_targets[target.GetName()]
+        self.watch_index.LoadGlobsForTarget(target, [])
         for prefix in self._GetAllModuleDefinitionsForTarget(target.GetName()):
             del self.watched_module_definitions[prefix][target.GetName()]
 
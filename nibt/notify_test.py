@@ -0,0 +1,98 @@
+import fnmatch
+import unittest
+
+try:
+    from nibt import notify
+except ImportError:
+    # pyinotify is missing
+    notify = None
+
+GLOBS = [
+    "*.h", "BUILD", "a/b.cc", "a/*.cc", "a/b*", "a/?.h", "a/[bc]/*.cc",
+    "a/b/c.cc", "a/b/*", "a/b/*/d.h", "x/y/z.cc", "x/*/z.cc",
+]
+
+PATHS = [
+    "a.h", "BUILD", "a/BUILD", "a/b.cc", "a/c.cc", "a/b", "a/b.h", "a/bb.h",
+    "a/b/c.cc", "a/b/d.h", "a/b/e/d.h", "a/c/f.cc", "a/d/f.cc", "a/b/c/d.h",
+    "a/c.h", "x/y/z.cc", "x/w/z.cc", "x/y", "x/y/v/z.cc", "b.cc", "a",
+]
+
+class FakeTarget(object):
+    def __init__(self, name):
+        self.name = name
+
+    def GetName(self):
+        return self.name
+
+def ExpectedGlobs(rel_path, globs):
+    return sorted(rel_glob for rel_glob in globs
+                  if (fnmatch.fnmatchcase(rel_path, rel_glob)
+                      if notify._IsGlob(rel_glob) else rel_path == rel_glob))
+
+@unittest.skipIf(notify is None, "pyinotify is not available")
+class WatchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = notify.WatchIndex()
+        self.targets = {}
+
+    def LoadGlobs(self, target_name, rel_globs):
+        target = self.targets.setdefault(target_name, FakeTarget(target_name))
+        self.index.LoadGlobsForTarget(target, rel_globs)
+
+    def testMatchesLikeFnmatch(self):
+        for i, rel_glob in enumerate(GLOBS):
+            self.LoadGlobs("t%d" % i, [rel_glob])
+        for rel_path in PATHS:
+            self.assertEqual(ExpectedGlobs(rel_path, GLOBS),
+                             sorted(self.index._GetMatchingGlobs(rel_path)),
+                             rel_path)
+
+    def testBatchMatchesUnionOfPaths(self):
+        for i, rel_glob in enumerate(GLOBS):
+            self.LoadGlobs("t%d" % i, [rel_glob])
+        expected = set()
+        for rel_path in PATHS:
+            expected.update("t%d" % GLOBS.index(rel_glob)
+                            for rel_glob in ExpectedGlobs(rel_path, GLOBS))
+        self.assertEqual(expected, set(
+                self.index.GetMatchingTargetsBatch(PATHS + PATHS)))
+
+    def testExactAndWildcardOnSamePath(self):
+        self.LoadGlobs("exact", ["a/b.cc"])
+        self.LoadGlobs("wildcard", ["a/*.cc"])
+        self.assertEqual(["exact", "wildcard"], sorted(
+                self.index.GetMatchingTargets("a/b.cc")))
+        self.LoadGlobs("exact", [])
+        self.assertEqual(["wildcard"], sorted(
+                self.index.GetMatchingTargets("a/b.cc")))
+
+    def testSharedGlobStaysUntilLastTargetIsRemoved(self):
+        self.LoadGlobs("t1", ["a/*.cc"])
+        self.LoadGlobs("t2", ["a/*.cc"])
+        self.LoadGlobs("t1", [])
+        self.assertEqual(["t2"], sorted(
+                self.index.GetMatchingTargets("a/b.cc")))
+        self.LoadGlobs("t2", [])
+        self.assertEqual({}, self.index.GetMatchingTargets("a/b.cc"))
+
+    def testRemovedGlobsPruneEmptyNodes(self):
+        self.LoadGlobs("t1", ["a/b/*/d.h", "a/*.cc", "*.h"])
+        self.LoadGlobs("t2", ["a/b/c/*.cc"])
+        self.LoadGlobs("t1", ["a/*.cc"])
+        self.assertEqual(["a"], list(self.index.glob_trie.children))
+        self.assertEqual(["b"], list(self.index.glob_trie.children["a"].children))
+        self.assertEqual({}, self.index.glob_trie.patterns)
+
+        self.LoadGlobs("t2", [])
+        node = self.index.glob_trie.children["a"]
+        self.assertEqual({}, node.children)
+        self.assertEqual(["a/*.cc"], list(node.patterns))
+
+        self.LoadGlobs("t1", [])
+        self.assertEqual({}, self.index.glob_trie.children)
+        self.assertEqual({}, self.index.target_by_glob)
+        self.assertEqual({}, self.index.globs_by_target)
+
+if __name__ == '__main__':
+    unittest.main()
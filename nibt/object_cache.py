@@ -0,0 +1,183 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+
+from nibt import utils
+
+# Entries of the manifest of a source file, different include sets of
+# the same source can produce different objects
+MAX_MANIFEST_ENTRIES = 16
+
+_compiler_identity_lock = threading.Lock()
+
+def GetCompilerIdentity(compiler):
+    # Concurrent compilations would all miss and run the compiler
+    with _compiler_identity_lock:
+        return _GetCompilerIdentity(compiler)
+
+@utils.memoize(log=True, max_size=16)
+def _GetCompilerIdentity(compiler):
+    result, out, err = utils.RunProcess([compiler, "--version"])
+    if result != 0:
+        raise ValueError("Unable to identify compiler '%s': %s" % (
+            compiler, err.decode()))
+    return hashlib.sha1(out).hexdigest()
+
+
+class ObjectCacheStats(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+
+    def AddHit(self, size):
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += size
+
+    def AddMiss(self):
+        with self._lock:
+            self.misses += 1
+
+    def __repr__(self):
+        return "%d hits, %d misses, %.1f MB saved" % (
+            self.hits, self.misses, self.bytes_saved / (1024.0 * 1024.0))
+
+
+class ObjectCache(object):
+    def __init__(self, configuration):
+        self._enabled = configuration.Get(
+                "object_cache", "enabled") == "true"
+        self._cache_dir = configuration.GetExpandedDir("object_cache", "dir")
+        self._max_size = int(configuration.Get(
+            "object_cache", "max_size_mb")) * 1024 * 1024
+        self._lock = threading.RLock()
+        # Relative path -> size, least recently used first
+        self._entries = collections.OrderedDict()
+        self._total_size = 0
+        self.stats = ObjectCacheStats()
+        if self._enabled:
+            self._LoadIndex()
+
+    def IsEnabled(self):
+        return self._enabled
+
+    def _LoadIndex(self):
+        files = []
+        for dir_path, _, file_names in os.walk(self._cache_dir):
+            for file_name in file_names:
+                full_path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(full_path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, os.path.relpath(
+                    full_path, self._cache_dir), stat.st_size))
+        for _, rel_path, size in sorted(files):
+            self._entries[rel_path] = size
+            self._total_size += size
+        logging.info("Object cache at %s: %d files, %.1f MB",
+                     self._cache_dir, len(self._entries),
+                     self._total_size / (1024.0 * 1024.0))
+
+    def _GetPath(self, kind, key, ext):
+        return os.path.join(kind, key[:2], key + ext)
+
+    def GetManifestKey(self, compiler, command, source_hash):
+        manifest_key = hashlib.sha1()
+        manifest_key.update(GetCompilerIdentity(compiler).encode())
+        manifest_key.update(b"\0")
+        manifest_key.update(command.encode())
+        manifest_key.update(b"\0")
+        manifest_key.update(source_hash.encode())
+        return manifest_key.hexdigest()
+
+    def Fetch(self, manifest_key, file_hasher, output_file, build_stats):
+        manifest = self._ReadManifest(manifest_key)
+        for entry in manifest:
+            includes = entry["includes"]
+            if not all(file_hasher.GetHash(header) == header_hash
+                       for header, header_hash in includes.items()):
+                continue
+            object_path = self._GetPath("objects", entry["object"], ".o")
+            try:
+                tmp_output_file = "%s.tmp.%d" % (output_file, threading.get_ident())
+                shutil.copyfile(os.path.join(self._cache_dir, object_path),
+                                tmp_output_file)
+                os.replace(tmp_output_file, output_file)
+            except OSError:
+                logging.info("Cached object %s is gone", object_path)
+                continue
+            size = self._Touch(object_path)
+            self._Touch(self._GetPath("manifests", manifest_key, ".json"))
+            self.stats.AddHit(size)
+            build_stats.AddHit(size)
+            logging.info("Object cache hit for %s", output_file)
+            return sorted(includes.keys())
+        self.stats.AddMiss()
+        build_stats.AddMiss()
+        return None
+
+    def Store(self, manifest_key, file_hasher, includes, output_file):
+        with open(output_file, "rb") as f:
+            object_data = f.read()
+        object_key = hashlib.sha1(object_data).hexdigest()
+        object_path = self._GetPath("objects", object_key, ".o")
+        self._WriteEntry(object_path, object_data)
+
+        entry = {
+            "includes": {header: file_hasher.GetHash(header)
+                         for header in includes},
+            "object": object_key,
+        }
+        with self._lock:
+            manifest = [e for e in self._ReadManifest(manifest_key)
+                        if e["includes"] != entry["includes"]]
+            manifest.insert(0, entry)
+            self._WriteEntry(
+                self._GetPath("manifests", manifest_key, ".json"),
+                json.dumps(manifest[:MAX_MANIFEST_ENTRIES]))
+            self._Evict()
+
+    def _ReadManifest(self, manifest_key):
+        manifest_path = os.path.join(self._cache_dir,
+                self._GetPath("manifests", manifest_key, ".json"))
+        try:
+            with open(manifest_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def _WriteEntry(self, rel_path, data):
+        utils.WriteFileAtomically(os.path.join(self._cache_dir, rel_path), data)
+        with self._lock:
+            self._total_size -= self._entries.pop(rel_path, 0)
+            self._entries[rel_path] = len(data)
+            self._total_size += len(data)
+
+    def _Touch(self, rel_path):
+        full_path = os.path.join(self._cache_dir, rel_path)
+        try:
+            os.utime(full_path)
+        except OSError:
+            pass
+        with self._lock:
+            if rel_path in self._entries:
+                self._entries.move_to_end(rel_path)
+            return self._entries.get(rel_path, 0)
+
+    def _Evict(self):
+        with self._lock:
+            while self._total_size > self._max_size and self._entries:
+                rel_path, size = self._entries.popitem(last=False)
+                self._total_size -= size
+                logging.info("Evicting %s from object cache", rel_path)
+                try:
+                    os.remove(os.path.join(self._cache_dir, rel_path))
+                except OSError:
+                    pass
@@ -0,0 +1,158 @@
+import io
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+
+from pkg_resources import resource_stream
+
+from nibt import config, object_cache
+
+SETTINGS = """
+[object_cache]
+enabled=true
+dir=%(root)s/cache
+max_size_mb=1
+"""
+
+OBJECT_SIZE = 400 * 1024
+
+class FakeFileHasher(object):
+    def __init__(self):
+        self.hashes = {}
+
+    def GetHash(self, path):
+        return self.hashes.get(path)
+
+class CompilerIdentityTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def testConcurrentMissesRunCompilerOnce(self):
+        calls_file = os.path.join(self.temp_dir, "calls")
+        compiler = os.path.join(self.temp_dir, "compiler")
+        with open(compiler, "w") as f:
+            f.write("#!/bin/sh\necho x >> %s\nsleep 0.2\necho 1.0\n" % calls_file)
+        os.chmod(compiler, stat.S_IRWXU)
+
+        identities = []
+        threads = [threading.Thread(target=lambda: identities.append(
+                object_cache.GetCompilerIdentity(compiler))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(8, len(identities))
+        self.assertEqual(1, len(set(identities)))
+        with open(calls_file, "r") as f:
+            self.assertEqual(1, len(f.readlines()))
+
+class ObjectCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.configuration = config.Configuration([
+            io.BytesIO((SETTINGS % {"root": self.root_dir}).encode()),
+            resource_stream("nibt", "default_settings.ini")])
+        self.cache = object_cache.ObjectCache(self.configuration)
+        self.file_hasher = FakeFileHasher()
+        self.build_stats = object_cache.ObjectCacheStats()
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def WriteObject(self, name, content, size=0):
+        path = os.path.join(self.root_dir, name)
+        with open(path, "wb") as f:
+            f.write(content.encode().ljust(size, b"\0"))
+        return path
+
+    def ReadObject(self, path):
+        with open(path, "rb") as f:
+            return f.read().rstrip(b"\0").decode()
+
+    def Store(self, manifest_key, content, includes=(), size=0):
+        self.cache.Store(manifest_key, self.file_hasher, list(includes),
+                         self.WriteObject("stored.o", content, size))
+
+    def Fetch(self, manifest_key):
+        output_file = os.path.join(self.root_dir, "fetched.o")
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        includes = self.cache.Fetch(manifest_key, self.file_hasher,
+                                    output_file, self.build_stats)
+        if includes is None:
+            return None
+        return self.ReadObject(output_file), includes
+
+    def testObjectIsFetchedForSameIncludes(self):
+        self.file_hasher.hashes = {"a.h": "1", "b.h": "1"}
+        self.Store("key", "object", ["a.h", "b.h"])
+        self.assertEqual(("object", ["a.h", "b.h"]), self.Fetch("key"))
+        self.assertIsNone(self.Fetch("other"))
+
+        self.file_hasher.hashes["b.h"] = "2"
+        self.assertIsNone(self.Fetch("key"))
+        self.assertEqual((1, 2), (self.build_stats.hits,
+                                  self.build_stats.misses))
+
+    def testManifestKeepsEntryPerIncludeSet(self):
+        self.file_hasher.hashes = {"a.h": "1"}
+        self.Store("key", "object1", ["a.h"])
+        self.file_hasher.hashes = {"a.h": "2"}
+        self.Store("key", "object2", ["a.h"])
+        self.assertEqual(("object2", ["a.h"]), self.Fetch("key"))
+        self.file_hasher.hashes = {"a.h": "1"}
+        self.assertEqual(("object1", ["a.h"]), self.Fetch("key"))
+        # Storing the same include set again replaces its entry
+        self.Store("key", "object3", ["a.h"])
+        self.assertEqual(2, len(self.cache._ReadManifest("key")))
+        self.assertEqual(("object3", ["a.h"]), self.Fetch("key"))
+
+    def testManifestIsBounded(self):
+        for i in range(object_cache.MAX_MANIFEST_ENTRIES + 2):
+            self.file_hasher.hashes = {"a.h": str(i)}
+            self.Store("key", "object%d" % i, ["a.h"])
+        self.assertEqual(object_cache.MAX_MANIFEST_ENTRIES,
+                         len(self.cache._ReadManifest("key")))
+        self.file_hasher.hashes = {"a.h": "0"}
+        self.assertIsNone(self.Fetch("key"))
+        self.file_hasher.hashes = {"a.h": "2"}
+        self.assertEqual(("object2", ["a.h"]), self.Fetch("key"))
+
+    def testLeastRecentlyUsedObjectIsEvicted(self):
+        self.Store("a", "a", size=OBJECT_SIZE)
+        self.Store("b", "b", size=OBJECT_SIZE)
+        self.assertEqual(("a", []), self.Fetch("a"))
+        self.Store("c", "c", size=OBJECT_SIZE)
+
+        self.assertLessEqual(self.cache._total_size, 1024 * 1024)
+        self.assertIsNone(self.Fetch("b"))
+        self.assertEqual(("a", []), self.Fetch("a"))
+        self.assertEqual(("c", []), self.Fetch("c"))
+
+    def testEvictedObjectIsStoredAgain(self):
+        self.Store("a", "a", size=OBJECT_SIZE)
+        self.Store("b", "b", size=OBJECT_SIZE)
+        self.Store("c", "c", size=OBJECT_SIZE)
+        # The manifest of a outlived its object
+        self.assertEqual(1, len(self.cache._ReadManifest("a")))
+        self.assertIsNone(self.Fetch("a"))
+
+        self.Store("a", "a", size=OBJECT_SIZE)
+        self.assertEqual(("a", []), self.Fetch("a"))
+        self.assertLessEqual(self.cache._total_size, 1024 * 1024)
+
+    def testSizeIsRestoredOnRestart(self):
+        self.Store("a", "a", size=OBJECT_SIZE)
+        self.Store("b", "b", size=OBJECT_SIZE)
+        restarted = object_cache.ObjectCache(self.configuration)
+        self.assertEqual(self.cache._total_size, restarted._total_size)
+        self.assertEqual(set(self.cache._entries), set(restarted._entries))
+
+if __name__ == '__main__':
+    unittest.main()
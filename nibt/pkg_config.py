@@ -1,19 +1,175 @@
-from nibt import utils
+import json
+import logging
+import os
+import threading
+
+from nibt import fingerprint, utils, worker
+
+CACHE_VERSION = 1
+
+# Flags whose value is the next argument, they are deduplicated together
+ARGS_WITH_VALUE = (worker.LOCAL_ARGS_WITH_VALUE |
+                   worker.REMOTE_ARGS_WITH_VALUE | set(["-framework"]))
+
+def _GroupArgs(flags):
+    groups = []
+    flags = iter(flags)
+    for flag in flags:
+        if flag in ARGS_WITH_VALUE:
+            groups.append((flag, next(flags, "")))
+        else:
+            groups.append((flag,))
+    return groups
+
+def _DedupeKeepFirst(flags):
+    seen = set()
+    result = []
+    for group in _GroupArgs(flags):
+        if group not in seen:
+            seen.add(group)
+            result.extend(group)
+    return result
+
+def _NormalizeLibs(flags):
+    # Libraries must stay after everything that depends on them, search
+    # paths keep their priority, other linker flags are kept as they are
+    last_library = {}
+    for i, flag in enumerate(flags):
+        if flag.startswith("-l"):
+            last_library[flag] = i
+    seen_paths = set()
+    result = []
+    for i, flag in enumerate(flags):
+        if flag.startswith("-l") and last_library[flag] != i:
+            continue
+        if flag.startswith("-L"):
+            if flag in seen_paths:
+                continue
+            seen_paths.add(flag)
+        result.append(flag)
+    return result
 
 
 class PkgConfig(object):
+    def __init__(self, configuration):
+        self._cache_file = configuration.GetExpandedDir(
+                "pkg_config", "cache_file")
+        self._search_path = os.environ.get("PKG_CONFIG_PATH", "")
+        self._lock = threading.Lock()
+        # Package -> {"cflags", "libs", "pc_files": {path: stamp}}
+        self._packages = {}
+        self._LoadCache()
+
+    def _LoadCache(self):
+        try:
+            with open(self._cache_file, "r") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return
+        if (cache.get("version") != CACHE_VERSION or
+                cache.get("search_path") != self._search_path):
+            logging.info("Discarding pkg-config cache %s", self._cache_file)
+            return
+        self._packages = cache.get("packages", {})
+        logging.info("Loaded pkg-config cache: %d packages",
+                     len(self._packages))
+
+    def _SaveCache(self):
+        with self._lock:
+            data = json.dumps({
+                "version": CACHE_VERSION,
+                "search_path": self._search_path,
+                "packages": self._packages,
+            }, sort_keys=True)
+        try:
+            utils.WriteFileAtomically(self._cache_file, data)
+        except OSError:
+            logging.exception("Unable to write pkg-config cache")
+
+    def _IsUpToDate(self, package_info):
+        return all(fingerprint.GetFileStamp(pc_file) == stamp
+                   for pc_file, stamp in package_info["pc_files"].items())
+
+    def _RunPkgConfig(self, package, *options):
+        result, out, err = utils.RunProcess(
+                ["pkg-config"] + list(options) + [package])
+        if result != 0:
+            raise ValueError("pkg-config %s %s failed: %s" % (
+                " ".join(options), package,
+                err.decode(errors="replace").strip()))
+        return out.decode()
+
+    def _QueryPackage(self, package):
+        # .pc files and required packages in one process, flags are printed
+        # by pkg-config as one line and need a process each
+        pc_files = []
+        requires = []
+        output = self._RunPkgConfig(package, "--path", "--print-requires",
+                                    "--print-requires-private")
+        for line in output.splitlines():
+            line = line.strip()
+            if os.path.isabs(line) and line.endswith(".pc"):
+                pc_files.append(line)
+            elif line:
+                requires.append(line.split()[0])
+        return pc_files, requires
+
+    def _GetCachedPackage(self, package):
+        with self._lock:
+            package_info = self._packages.get(package)
+        if package_info is not None and self._IsUpToDate(package_info):
+            return package_info
+        return None
+
+    def _ResolvePackage(self, package):
+        package_info = self._GetCachedPackage(package)
+        if package_info is not None:
+            return package_info
+
+        logging.info("Resolving pkg-config package %s", package)
+        # Flags of a package depend on the .pc files of everything it requires
+        pc_files = {}
+        pending = [package]
+        seen = set(pending)
+        while pending:
+            current = pending.pop()
+            required_info = None
+            if current != package:
+                required_info = self._GetCachedPackage(current)
+            if required_info is not None:
+                pc_files.update(required_info["pc_files"])
+                continue
+            current_pc_files, requires = self._QueryPackage(current)
+            for pc_file in current_pc_files:
+                pc_files[pc_file] = fingerprint.GetFileStamp(pc_file)
+            for required in requires:
+                if required not in seen:
+                    seen.add(required)
+                    pending.append(required)
+        package_info = {
+            "cflags": self._RunPkgConfig(package, "--cflags").split(),
+            "libs": self._RunPkgConfig(package, "--libs").split(),
+            "pc_files": pc_files,
+        }
+        with self._lock:
+            self._packages[package] = package_info
+        self._SaveCache()
+        return package_info
 
-    @utils.memoize(log=True)
     def GetFlags(self, packages_list, cflags=False, libs=False):
-        if packages_list:
-            args = []
-            args.extend(["pkg-config"])
-            if cflags:
-                args.extend(["--cflags"])
-            if libs:
-                args.extend(["--libs"])
-            args.extend(list(packages_list))
-            _, out, _ = utils.RunProcess(args)
-            return out.decode().strip().split(" ")
-        else:
-            return []
+        flags_cflags = []
+        flags_libs = []
+        for package in packages_list:
+            try:
+                package_info = self._ResolvePackage(package)
+            except ValueError:
+                logging.exception("Unable to resolve package %s", package)
+                continue
+            flags_cflags.extend(package_info["cflags"])
+            flags_libs.extend(package_info["libs"])
+        flags = []
+        if cflags:
+            flags.extend(_DedupeKeepFirst(flags_cflags))
+        if libs:
+            flags.extend(_NormalizeLibs(flags_libs))
+        return flags
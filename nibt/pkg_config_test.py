@@ -0,0 +1,102 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from nibt import config, pkg_config
+
+PC_FILE = """Name: %(name)s
+Description: Test package
+Version: 1.0
+Requires: %(requires)s
+Cflags: -I/include/%(name)s
+Libs: -l%(name)s
+"""
+
+class CountingPkgConfig(pkg_config.PkgConfig):
+    def __init__(self, configuration):
+        pkg_config.PkgConfig.__init__(self, configuration)
+        self.runs = []
+
+    def _RunPkgConfig(self, package, *options):
+        self.runs.append((package,) + options)
+        return pkg_config.PkgConfig._RunPkgConfig(self, package, *options)
+
+class NormalizeFlagsTest(unittest.TestCase):
+    def testCflagsKeepFirstOccurrence(self):
+        self.assertEqual(["-I/a", "-DX", "-I/b"], pkg_config._DedupeKeepFirst(
+            ["-I/a", "-DX", "-I/a", "-I/b", "-DX"]))
+
+    def testSeparatedArgumentsKeepTheirValues(self):
+        self.assertEqual(
+                ["-isystem", "/a", "-isystem", "/b", "-include", "x.h",
+                 "-Xclang", "-fno-pch", "-framework", "Cocoa"],
+                pkg_config._DedupeKeepFirst(
+                    ["-isystem", "/a", "-isystem", "/b", "-isystem", "/a",
+                     "-include", "x.h", "-Xclang", "-fno-pch",
+                     "-include", "x.h", "-framework", "Cocoa",
+                     "-framework", "Cocoa"]))
+
+    def testSeparatedValueIsNotMergedWithFlags(self):
+        self.assertEqual(["-I/a", "-I", "/a", "-DX", "-D", "Y"],
+                pkg_config._DedupeKeepFirst(
+                    ["-I/a", "-I", "/a", "-DX", "-D", "Y", "-I/a", "-D", "Y"]))
+
+    def testLibrariesKeepLastOccurrence(self):
+        self.assertEqual(["-L/a", "-lb", "-L/c", "-la", "-lc"],
+                pkg_config._NormalizeLibs(
+                    ["-L/a", "-la", "-lb", "-L/a", "-L/c", "-la", "-lc"]))
+
+@unittest.skipIf(shutil.which("pkg-config") is None, "pkg-config is missing")
+class PkgConfigCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.saved_path = os.environ.get("PKG_CONFIG_PATH")
+        os.environ["PKG_CONFIG_PATH"] = self.temp_dir
+        self._WritePc("nitesta", "nitestb")
+        self._WritePc("nitestb", "")
+        settings = "[pkg_config]\ncache_file=%s\n" % os.path.join(
+                self.temp_dir, "cache.json")
+        self.configuration = config.Configuration(
+                [io.BytesIO(settings.encode())])
+
+    def tearDown(self):
+        if self.saved_path is None:
+            del os.environ["PKG_CONFIG_PATH"]
+        else:
+            os.environ["PKG_CONFIG_PATH"] = self.saved_path
+        shutil.rmtree(self.temp_dir)
+
+    def _WritePc(self, name, requires):
+        with open(os.path.join(self.temp_dir, name + ".pc"), "w") as f:
+            f.write(PC_FILE % {"name": name, "requires": requires})
+
+    def testCacheHitDoesNotRunPkgConfig(self):
+        resolver = CountingPkgConfig(self.configuration)
+        self.assertEqual(["-I/include/nitesta", "-I/include/nitestb"],
+                         sorted(resolver.GetFlags(["nitesta"], cflags=True)))
+        self.assertEqual(4, len(resolver.runs))
+
+        del resolver.runs[:]
+        resolver.GetFlags(["nitesta"], cflags=True, libs=True)
+        self.assertEqual([], resolver.runs)
+        # Loaded from the cache file by the next daemon
+        reloaded = CountingPkgConfig(self.configuration)
+        reloaded.GetFlags(["nitesta"], libs=True)
+        self.assertEqual([], reloaded.runs)
+
+    def testChangedRequiredPcFileInvalidatesEntry(self):
+        resolver = CountingPkgConfig(self.configuration)
+        resolver.GetFlags(["nitesta"], cflags=True)
+        pc_path = os.path.join(self.temp_dir, "nitestb.pc")
+        stat = os.stat(pc_path)
+        os.utime(pc_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        del resolver.runs[:]
+        resolver.GetFlags(["nitesta"], cflags=True)
+        self.assertEqual(set(["nitesta", "nitestb"]),
+                         set(run[0] for run in resolver.runs))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,8 @@
 class Plugin(object):
-    def __init__(self, compilation_database, pkg_config, threading_manager, configuration):
+    def __init__(self, compilation_database, pkg_config, threading_manager, configuration,
+            state_store):
         self.compilation_database = compilation_database
         self.pkg_config = pkg_config
         self.threading_manager = threading_manager
         self.configuration = configuration
+        self.state_store = state_store
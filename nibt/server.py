@@ -3,7 +3,7 @@ import logging
 
 from pkg_resources import resource_stream
 
-from nibt import config, thread_pools, pkg_config, graph, web
+from nibt import config, thread_pools, pkg_config, graph, web, state, trace, metrics
 from nibt import compile_db, build, notify, moduledef, manager, cpp, dbusinterface
 
 class Server(object):
@@ -19,20 +19,28 @@ class Server(object):
         
         self.threading_manager = thread_pools.ThreadingManager(self.configuration)
 
-        self.pkg_config = pkg_config.PkgConfig()
+        self.pkg_config = pkg_config.PkgConfig(self.configuration)
 
         self.graph = graph.DependencyTracker(
-                lambda deps: self.manager.GetDependencies(deps))
+                lambda deps: self.manager.GetDependencies(deps),
+                self.threading_manager.GetThreadPool("graph"))
         
-        self.compilation_database = compile_db.Database(self.configuration)
+        self.compilation_database = compile_db.Database(
+                self.configuration, self.threading_manager)
         
         self.targets_state = build.TargetsState()
 
-        self.builder = build.Builder(self.configuration, self.targets_state)
+        self.state_store = state.StateStore(self.configuration)
+
+        self.trace_store = trace.TraceStore(self.configuration)
+
+        self.builder = build.Builder(
+                self.configuration, self.targets_state, self.state_store)
 
         self.build_tracker = build.BuildTracker(
                 self.graph, self.targets_state, self.builder,
-                self.compilation_database, self.threading_manager)
+                self.compilation_database, self.threading_manager,
+                self.trace_store)
         
         self.watch_index = notify.WatchIndex()
 
@@ -40,7 +48,8 @@ class Server(object):
                 self.configuration, self.builder, self.watch_index)
         
         self.cpp_plugin = cpp.CppPlugin(
-                self.compilation_database, self.pkg_config, self.threading_manager, self.configuration)
+                self.compilation_database, self.pkg_config, self.threading_manager, self.configuration,
+                self.state_store)
         self.cpp_plugin.RegisterBuilders(self.builder)
 
         self.module_definition_evaluator = moduledef.Evaluator(
@@ -61,7 +70,9 @@ class Server(object):
         self.tracked_target_state_emitter = web.TrackedTargetsStateEmitter(self.graph)
         self.build_progress_state_emitter = web.BuildProcessStateEmitter(self.builder)
 
-        self.web = web.WebUIServer([self.tracked_target_state_emitter, self.build_progress_state_emitter])
+        self.web = web.WebUIServer(
+                [self.tracked_target_state_emitter, self.build_progress_state_emitter],
+                self.trace_store)
 
         # Post init
         self.graph.AddTrackedHandler(
@@ -72,8 +83,16 @@ class Server(object):
                 functools.partial(manager.Manager.OnRefreshedAsDependency, self.manager))
     
 
+        self.target_watcher.AddModuleDefinitionChangeHandler(
+                self.module_definition_evaluator.InvalidateModuleDefinition)
+        self.target_watcher.AddDeletionHandler(
+                self.compilation_database.OnFileDeleted)
         self.target_watcher.AddModificationHandler(
                 functools.partial(manager.Manager.OnModifiedFiles, self.manager))
+
+        metrics.registry.AddCollector(self.threading_manager.UpdateMetrics)
+        metrics.registry.AddCollector(self.watch_index.UpdateMetrics)
+        metrics.registry.AddCollector(self.cpp_plugin.UpdateMetrics)
     
     def Run(self):
         self.web.Start()
@@ -0,0 +1,71 @@
+import copy
+import json
+import logging
+import os
+import threading
+
+from nibt import utils
+
+STATE_VERSION = 1
+
+class StateStore(object):
+    def __init__(self, configuration):
+        self._root = configuration.GetExpandedDir("projects", "root_dir")
+        self._state_file_path = os.path.join(self._root, ".nibt", "state.json")
+        self._lock = threading.RLock()
+        self._state = {}
+        self._dirty = False
+        self._LoadState()
+
+    def _LoadState(self):
+        if not os.path.exists(self._state_file_path):
+            return
+        try:
+            with open(self._state_file_path, "r") as f:
+                state = json.load(f)
+            if state.get("version") != STATE_VERSION:
+                logging.warning("Build state has version %s, expected %s, "
+                                "starting from empty state...",
+                                state.get("version"), STATE_VERSION)
+                return
+            sections = state.get("sections", {})
+            if not all(isinstance(section, dict)
+                       for section in sections.values()):
+                raise ValueError("Build state sections must be objects")
+            self._state = sections
+            logging.info("Loaded build state: %s",
+                    {name: len(section) for name, section in self._state.items()})
+        except (ValueError, AttributeError):
+            logging.warning("Build state is corrupted, "
+                            "starting from empty state...")
+
+    def Get(self, section, key, default=None):
+        with self._lock:
+            value = self._state.get(section, {}).get(key, default)
+            return copy.deepcopy(value)
+
+    def Set(self, section, key, value):
+        with self._lock:
+            section_dict = self._state.setdefault(section, {})
+            if section_dict.get(key) != value:
+                section_dict[key] = copy.deepcopy(value)
+                self._dirty = True
+
+    def Delete(self, section, key):
+        with self._lock:
+            section_dict = self._state.get(section, {})
+            if key in section_dict:
+                del section_dict[key]
+                self._dirty = True
+
+    def Flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps({
+                "version": STATE_VERSION,
+                "sections": self._state,
+            })
+            utils.WriteFileAtomically(self._state_file_path, data)
+            self._dirty = False
+        logging.info("Saved build state to %s", self._state_file_path)
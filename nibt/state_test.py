@@ -0,0 +1,109 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from nibt import config, state
+
+class StateStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.state_file_path = os.path.join(self.root_dir, ".nibt", "state.json")
+        settings = "[projects]\nroot_dir=%s\n" % self.root_dir
+        self.configuration = config.Configuration(
+                [io.BytesIO(settings.encode())])
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def CreateStore(self):
+        return state.StateStore(self.configuration)
+
+    def WriteStateFile(self, content):
+        os.makedirs(os.path.dirname(self.state_file_path), exist_ok=True)
+        with open(self.state_file_path, "w") as f:
+            f.write(content)
+
+    def ReadStateFile(self):
+        with open(self.state_file_path, "r") as f:
+            return f.read()
+
+    def testFlushedStateIsRestored(self):
+        store = self.CreateStore()
+        store.Set("objects", "a.o", {"fingerprint": "f", "includes": ["a.h"]})
+        store.Set("libraries", "lib/a", {"archive_path": "liba.a"})
+        store.Set("libraries", "lib/b", {"archive_path": "libb.a"})
+        store.Delete("libraries", "lib/b")
+        store.Flush()
+
+        restored = self.CreateStore()
+        self.assertEqual({"fingerprint": "f", "includes": ["a.h"]},
+                         restored.Get("objects", "a.o"))
+        self.assertEqual({"archive_path": "liba.a"},
+                         restored.Get("libraries", "lib/a"))
+        self.assertIsNone(restored.Get("libraries", "lib/b"))
+
+    def testFlushWithoutChangesDoesNotWrite(self):
+        store = self.CreateStore()
+        store.Flush()
+        self.assertFalse(os.path.exists(self.state_file_path))
+        store.Set("objects", "a.o", {"fingerprint": "f"})
+        store.Flush()
+        os.remove(self.state_file_path)
+        store.Set("objects", "a.o", {"fingerprint": "f"})
+        store.Flush()
+        self.assertFalse(os.path.exists(self.state_file_path))
+
+    def testFailedFlushKeepsPreviousState(self):
+        store = self.CreateStore()
+        store.Set("objects", "a.o", {"fingerprint": "old"})
+        store.Flush()
+        saved = self.ReadStateFile()
+
+        store.Set("objects", "a.o", {"fingerprint": "new"})
+        with mock.patch("os.fsync", side_effect=OSError("disk full")):
+            self.assertRaises(OSError, store.Flush)
+        self.assertEqual(saved, self.ReadStateFile())
+        self.assertEqual(["state.json"],
+                         os.listdir(os.path.dirname(self.state_file_path)))
+        # The changes are written by the next flush
+        store.Flush()
+        self.assertEqual({"fingerprint": "new"},
+                         self.CreateStore().Get("objects", "a.o"))
+
+    def testCorruptStateStartsEmpty(self):
+        valid = json.dumps({"version": state.STATE_VERSION,
+                            "sections": {"objects": {"a.o": {}}}})
+        for content in [valid[:len(valid) // 2], "", "\x00\x00", "[1, 2]",
+                        json.dumps({"version": state.STATE_VERSION,
+                                    "sections": {"objects": [1]}}),
+                        json.dumps({"version": state.STATE_VERSION,
+                                    "sections": [1]})]:
+            self.WriteStateFile(content)
+            store = self.CreateStore()
+            self.assertIsNone(store.Get("objects", "a.o"), content)
+            # The corrupt file is replaced by the next flush
+            store.Set("objects", "b.o", {"fingerprint": "f"})
+            store.Flush()
+            self.assertEqual({"fingerprint": "f"},
+                             self.CreateStore().Get("objects", "b.o"))
+
+    def testOtherVersionStartsEmpty(self):
+        self.WriteStateFile(json.dumps({
+            "version": state.STATE_VERSION + 1,
+            "sections": {"objects": {"a.o": {"fingerprint": "f"}}}}))
+        self.assertIsNone(self.CreateStore().Get("objects", "a.o"))
+
+    def testGetReturnsCopies(self):
+        store = self.CreateStore()
+        value = {"includes": ["a.h"]}
+        store.Set("objects", "a.o", value)
+        value["includes"].append("b.h")
+        store.Get("objects", "a.o")["includes"].append("c.h")
+        self.assertEqual({"includes": ["a.h"]}, store.Get("objects", "a.o"))
+
+if __name__ == '__main__':
+    unittest.main()
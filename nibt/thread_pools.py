@@ -1,11 +1,134 @@
+import collections
+import contextlib
 import logging
+import os
+import threading
 
 import concurrent.futures
 
+from nibt import metrics, utils
+
+_pool_queued = metrics.registry.Gauge(
+        "ni_thread_pool_queued_tasks",
+        "Tasks submitted to a thread pool and not started yet", ["pool"])
+_pool_active = metrics.registry.Gauge(
+        "ni_thread_pool_active_tasks",
+        "Tasks running in a thread pool", ["pool"])
+_pool_workers = metrics.registry.Gauge(
+        "ni_thread_pool_workers", "Maximum threads of a thread pool", ["pool"])
+_pool_completed = metrics.registry.Counter(
+        "ni_thread_pool_completed_tasks_total",
+        "Tasks finished by a thread pool", ["pool"])
+_job_slots_size = metrics.registry.Gauge(
+        "ni_job_slots", "Processes allowed to run concurrently")
+_job_slots_in_use = metrics.registry.Gauge(
+        "ni_job_slots_in_use", "Job slots taken, by thread pool", ["pool"])
+_job_slots_waiting = metrics.registry.Gauge(
+        "ni_job_slots_waiting", "Threads waiting for a job slot", ["pool"])
+
+_current_pool = threading.local()
+
+def GetCurrentPoolName():
+    return getattr(_current_pool, "name", threading.current_thread().name)
+
+def _InitializePoolThread(name):
+    _current_pool.name = name
+
+class JobSlots(object):
+    def __init__(self, size):
+        self.size = size
+        self._semaphore = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._in_use = collections.Counter()
+        self._waiting = collections.Counter()
+        self._peak = collections.Counter()
+
+    @contextlib.contextmanager
+    def Acquire(self):
+        pool_name = GetCurrentPoolName()
+        with self._lock:
+            self._waiting[pool_name] += 1
+        self._semaphore.acquire()
+        with self._lock:
+            self._waiting[pool_name] -= 1
+            self._in_use[pool_name] += 1
+            self._peak[pool_name] = max(
+                    self._peak[pool_name], self._in_use[pool_name])
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_use[pool_name] -= 1
+            self._semaphore.release()
+
+    def GetUsage(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "in_use": {k: v for k, v in self._in_use.items() if v},
+                "waiting": {k: v for k, v in self._waiting.items() if v},
+                "peak": dict(self._peak),
+            }
+
+class ThreadPool(concurrent.futures.ThreadPoolExecutor):
+    def __init__(self, name, max_workers):
+        concurrent.futures.ThreadPoolExecutor.__init__(
+                self, max_workers=max_workers, thread_name_prefix=name,
+                initializer=_InitializePoolThread, initargs=(name,))
+        self.name = name
+        self.size = max_workers
+        self._stats_lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+
+    def submit(self, fn, *args, **kwargs):
+        with self._stats_lock:
+            self.queued += 1
+        future = concurrent.futures.ThreadPoolExecutor.submit(
+                self, self._RunTask, fn, args, kwargs)
+        future.add_done_callback(self._OnTaskDone)
+        return future
+
+    def _RunTask(self, fn, args, kwargs):
+        with self._stats_lock:
+            self.queued -= 1
+            self.active += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._stats_lock:
+                self.active -= 1
+                self.completed += 1
+
+    def _OnTaskDone(self, future):
+        if future.cancelled():
+            with self._stats_lock:
+                self.queued -= 1
+
+    def GetStats(self):
+        with self._stats_lock:
+            return {
+                "workers": self.size,
+                "queued": self.queued,
+                "active": self.active,
+                "completed": self.completed,
+            }
+
 class ThreadingManager(object):
     def __init__(self, configuration):
         self.configuration = configuration
         self.thread_pools = {}
+        self.job_slots = JobSlots(self._GetJobSlotsCount())
+        logging.info("Allowing %d concurrent processes", self.job_slots.size)
+        utils.SetJobSlots(self.job_slots)
+
+    def _GetJobSlotsCount(self):
+        jobs = self.configuration.Get(
+            "thread_pools", "jobs", raise_exception=False, default="auto")
+        if jobs == "auto":
+            return os.cpu_count() or 1
+        return int(jobs)
 
     def _GetThreadPoolSize(self, name):
         setting_name = name+"_workers"
@@ -17,12 +140,28 @@ class ThreadingManager(object):
         if name not in self.thread_pools:
             tp_size = self._GetThreadPoolSize(name)
             logging.info("Allocating thread pool '%s' of size %s", name, tp_size)
-            tp = concurrent.futures.ThreadPoolExecutor(max_workers=tp_size)
+            tp = ThreadPool(name, tp_size)
             self.thread_pools[name] = tp
             return tp
         else:
             return self.thread_pools[name]
 
+    def UpdateMetrics(self):
+        for name, tp in list(self.thread_pools.items()):
+            stats = tp.GetStats()
+            _pool_queued.Set(stats["queued"], pool=name)
+            _pool_active.Set(stats["active"], pool=name)
+            _pool_workers.Set(stats["workers"], pool=name)
+            _pool_completed.Set(stats["completed"], pool=name)
+        usage = self.job_slots.GetUsage()
+        _job_slots_size.Set(usage["size"])
+        _job_slots_in_use.Clear()
+        for pool_name, in_use in usage["in_use"].items():
+            _job_slots_in_use.Set(in_use, pool=pool_name)
+        _job_slots_waiting.Clear()
+        for pool_name, waiting in usage["waiting"].items():
+            _job_slots_waiting.Set(waiting, pool=pool_name)
+
     def Join(self):
         for tp_name, tp in self.thread_pools.items():
             logging.info("Shutting down thread pool '%s'", tp_name)
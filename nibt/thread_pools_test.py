@@ -0,0 +1,74 @@
+import threading
+import time
+import unittest
+
+from nibt import thread_pools
+
+def WaitFor(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+class JobSlotsTest(unittest.TestCase):
+    def setUp(self):
+        self.job_slots = thread_pools.JobSlots(2)
+        self.pool = thread_pools.ThreadPool("compile", 3)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.pool.shutdown()
+
+    def HoldSlot(self):
+        with self.job_slots.Acquire():
+            self.release.wait()
+
+    def testAcquireBlocksBeyondSize(self):
+        futures = [self.pool.submit(self.HoldSlot) for _ in range(3)]
+        self.assertTrue(WaitFor(lambda: self.job_slots.GetUsage()["waiting"]))
+        self.assertEqual({
+            "size": 2,
+            "in_use": {"compile": 2},
+            "waiting": {"compile": 1},
+            "peak": {"compile": 2},
+        }, self.job_slots.GetUsage())
+        self.assertFalse(any(future.done() for future in futures))
+
+        self.release.set()
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual({"size": 2, "in_use": {}, "waiting": {},
+                          "peak": {"compile": 2}},
+                         self.job_slots.GetUsage())
+
+    def testUsageIsAccountedPerPool(self):
+        future = self.pool.submit(self.HoldSlot)
+        self.assertTrue(WaitFor(lambda: self.job_slots.GetUsage()["in_use"]))
+        with self.job_slots.Acquire():
+            usage = self.job_slots.GetUsage()
+            self.assertEqual({"compile": 1,
+                              threading.current_thread().name: 1},
+                             usage["in_use"])
+            self.assertEqual({}, usage["waiting"])
+        self.release.set()
+        future.result(timeout=5)
+        self.assertEqual({"compile": 1, threading.current_thread().name: 1},
+                         self.job_slots.GetUsage()["peak"])
+
+    def testSlotIsReleasedOnException(self):
+        def Fail():
+            with self.job_slots.Acquire():
+                raise ValueError("compile failed")
+        for _ in range(3):
+            self.assertRaises(ValueError, Fail)
+        self.assertEqual({}, self.job_slots.GetUsage()["in_use"])
+        # Both slots can still be taken together
+        with self.job_slots.Acquire(), self.job_slots.Acquire():
+            self.assertEqual({threading.current_thread().name: 2},
+                             self.job_slots.GetUsage()["in_use"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+import collections
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+# Spans of the daemon in the Chrome trace event format, viewable in
+# chrome://tracing or Perfetto. Events are collected continuously and cut
+# into a trace at the end of every build.
+
+# Events kept while no build finishes
+MAX_EVENTS = 200000
+
+class Tracer(object):
+    def __init__(self):
+        self.enabled = True
+        self._epoch = time.perf_counter()
+        self._lock = threading.Lock()
+        self._events = collections.deque(maxlen=MAX_EVENTS)
+        self._thread_names = {}
+        self._local = threading.local()
+
+    def Now(self):
+        return time.perf_counter()
+
+    def GetCurrentTarget(self):
+        return getattr(self._local, "target", None)
+
+    def SetCurrentTarget(self, target_name):
+        previous = self.GetCurrentTarget()
+        self._local.target = target_name
+        return previous
+
+    def AddSpan(self, name, start, end=None, category="ni", **args):
+        if not self.enabled:
+            return
+        if end is None:
+            end = self.Now()
+        if "target" not in args and self.GetCurrentTarget() is not None:
+            args["target"] = self.GetCurrentTarget()
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round((start - self._epoch) * 1e6, 1),
+            "dur": round((end - start) * 1e6, 1),
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": args,
+        }
+        with self._lock:
+            self._thread_names[thread.ident] = thread.name
+            self._events.append(event)
+
+    def Cut(self, name):
+        with self._lock:
+            events = list(self._events)
+            self._events.clear()
+            thread_names = dict(self._thread_names)
+        metadata = [{
+            "name": "thread_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": {"name": thread_name},
+        } for tid, thread_name in sorted(thread_names.items())]
+        return {
+            "traceEvents": metadata + events,
+            "displayTimeUnit": "ms",
+            "otherData": {"name": name, "created": time.time()},
+        }
+
+
+class Span(object):
+    def __init__(self, name, category="ni", **args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = tracer.Now()
+        self.previous_target = None
+        if "target" in self.args:
+            self.previous_target = tracer.SetCurrentTarget(self.args["target"])
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.args["error"] = repr(exc_value)
+        tracer.AddSpan(self.name, self.start, category=self.category,
+                       **self.args)
+        if "target" in self.args:
+            tracer.SetCurrentTarget(self.previous_target)
+        return False
+
+tracer = Tracer()
+
+def AddSpan(name, start, end=None, category="ni", **args):
+    tracer.AddSpan(name, start, end, category, **args)
+
+def Now():
+    return tracer.Now()
+
+
+class TraceStore(object):
+    def __init__(self, configuration):
+        tracer.enabled = configuration.Get(
+                "trace", "enabled", raise_exception=False,
+                default="true") == "true"
+        self._keep = int(configuration.Get(
+                "trace", "keep", raise_exception=False, default="20"))
+        self._trace_dir = os.path.join(
+                configuration.GetExpandedDir("projects", "root_dir"),
+                ".nibt", "traces")
+        self._lock = threading.Lock()
+        self._traces = collections.OrderedDict()
+        self._next_id = 1
+        # Traces are written by their own thread, the build loop does not
+        # wait for the disk
+        self._write_queue = queue.Queue()
+        self._write_thread = threading.Thread(
+                target=self._WriteThreadProc, daemon=True)
+        self._write_thread.start()
+
+    def CutTrace(self, name):
+        if not tracer.enabled:
+            return None
+        trace = tracer.Cut(name)
+        with self._lock:
+            trace_id = self._next_id
+            self._next_id += 1
+            self._traces[trace_id] = trace
+            while len(self._traces) > self._keep:
+                self._traces.popitem(last=False)
+        self._write_queue.put((trace_id, trace))
+        return trace_id
+
+    def _WriteThreadProc(self):
+        while True:
+            trace_id, trace = self._write_queue.get()
+            try:
+                self._WriteTrace(trace_id, trace)
+            except Exception:
+                logging.exception("Unable to write trace %d", trace_id)
+            finally:
+                self._write_queue.task_done()
+
+    def WaitForWrites(self):
+        self._write_queue.join()
+
+    def _WriteTrace(self, trace_id, trace):
+        os.makedirs(self._trace_dir, exist_ok=True)
+        trace_path = os.path.join(self._trace_dir, "trace-%s-%d.json" % (
+            time.strftime("%Y%m%d-%H%M%S"), trace_id))
+        tmp_path = trace_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(trace, f)
+            os.replace(tmp_path, trace_path)
+            trace_files = sorted(
+                (os.path.getmtime(os.path.join(self._trace_dir, file_name)),
+                 file_name)
+                for file_name in os.listdir(self._trace_dir)
+                if file_name.startswith("trace-") and file_name.endswith(".json"))
+            for _, file_name in trace_files[:-self._keep]:
+                os.remove(os.path.join(self._trace_dir, file_name))
+        except OSError:
+            logging.exception("Unable to write trace %s", trace_path)
+
+    def GetTraceList(self):
+        with self._lock:
+            traces = list(self._traces.items())
+        result = []
+        for trace_id, trace in traces:
+            spans = [event for event in trace["traceEvents"]
+                     if event["ph"] == "X"]
+            duration = 0
+            if spans:
+                duration = (max(e["ts"] + e["dur"] for e in spans) -
+                            min(e["ts"] for e in spans)) / 1000
+            result.append({
+                "id": trace_id,
+                "name": trace["otherData"]["name"],
+                "created": trace["otherData"]["created"],
+                "events": len(spans),
+                "duration_ms": round(duration, 3),
+            })
+        return result
+
+    def GetTrace(self, trace_id):
+        with self._lock:
+            return self._traces.get(trace_id)
@@ -0,0 +1,48 @@
+import io
+import os
+import tempfile
+import unittest
+
+from nibt import config, trace
+
+class TracerTest(unittest.TestCase):
+    def setUp(self):
+        trace.tracer.Cut("setup")
+
+    def testSpansAreAttributedToTarget(self):
+        with trace.Span("Build", target="a/b"):
+            trace.AddSpan("clang++", trace.Now(), category="process")
+        trace.AddSpan("Other", trace.Now())
+
+        events = trace.tracer.Cut("test")["traceEvents"]
+        spans = {e["name"]: e for e in events if e["ph"] == "X"}
+        self.assertEqual("a/b", spans["clang++"]["args"]["target"])
+        self.assertEqual("a/b", spans["Build"]["args"]["target"])
+        self.assertNotIn("target", spans["Other"]["args"])
+
+    def testCutStartsNewTrace(self):
+        trace.AddSpan("First", trace.Now())
+        first = trace.tracer.Cut("first")
+        second = trace.tracer.Cut("second")
+
+        self.assertEqual(["First"], [e["name"] for e in first["traceEvents"]
+                                     if e["ph"] == "X"])
+        self.assertEqual([], [e for e in second["traceEvents"]
+                              if e["ph"] == "X"])
+
+class TraceStoreTest(unittest.TestCase):
+    def testTracesAreWrittenInBackground(self):
+        with tempfile.TemporaryDirectory() as root:
+            settings = "[projects]\nroot_dir=%s\n[trace]\nkeep=2\n" % root
+            store = trace.TraceStore(config.Configuration(
+                    [io.BytesIO(settings.encode())]))
+            trace_ids = [store.CutTrace("build") for _ in range(3)]
+            store.WaitForWrites()
+
+            trace_dir = os.path.join(root, ".nibt", "traces")
+            self.assertEqual(2, len(os.listdir(trace_dir)))
+            self.assertEqual(trace_ids[1:],
+                             [t["id"] for t in store.GetTraceList()])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,21 +1,162 @@
+import codecs
+import collections
+import contextlib
+import functools
 import subprocess
 import os
 import logging
+import selectors
+import signal
 import time
+import threading
+import weakref
 
-def RunProcess(args):
+from nibt import metrics, trace
+
+_processes = metrics.registry.Counter(
+        "ni_processes_total", "Processes run, by program and status",
+        ["program", "status"])
+_process_duration = metrics.registry.Histogram(
+        "ni_process_duration_seconds", "Execution time of processes",
+        ["program"])
+_job_slot_wait = metrics.registry.Histogram(
+        "ni_job_slot_wait_seconds", "Time spent waiting for a job slot")
+
+_job_slots = None
+
+def SetJobSlots(job_slots):
+    global _job_slots
+    _job_slots = job_slots
+
+def _AcquireJobSlot():
+    if _job_slots is None:
+        return contextlib.nullcontext()
+    return _job_slots.Acquire()
+
+class CancellationToken(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._processes = set()
+
+    def Cancel(self):
+        with self._lock:
+            self._cancelled = True
+            processes = list(self._processes)
+        for process in processes:
+            logging.info("Terminating process %s", process.pid)
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                pass
+
+    def IsCancelled(self):
+        return self._cancelled
+
+    def RegisterProcess(self, process):
+        with self._lock:
+            self._processes.add(process)
+            cancelled = self._cancelled
+        if cancelled:
+            process.terminate()
+
+    def UnregisterProcess(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+# Output kept in memory per stream of a process, the rest is only
+# streamed to on_output
+MAX_PROCESS_OUTPUT_BYTES = 1024 * 1024
+
+class BoundedOutput(object):
+    def __init__(self, limit=MAX_PROCESS_OUTPUT_BYTES):
+        self.limit = limit
+        self.chunks = []
+        self.size = 0
+        self.dropped = 0
+
+    def Append(self, data):
+        kept = data[:max(0, self.limit - self.size)]
+        if kept:
+            self.chunks.append(kept)
+            self.size += len(kept)
+        self.dropped += len(data) - len(kept)
+
+    def GetValue(self):
+        value = b"".join(self.chunks)
+        if self.dropped:
+            value += b"\n[%d more bytes truncated]\n" % self.dropped
+        return value
+
+def _StreamProcessOutput(process, on_output):
+    outputs = {
+        process.stdout: ("stdout", BoundedOutput(),
+            codecs.getincrementaldecoder("utf-8")(errors="replace")),
+        process.stderr: ("stderr", BoundedOutput(),
+            codecs.getincrementaldecoder("utf-8")(errors="replace")),
+    }
+    with selectors.DefaultSelector() as selector:
+        for stream in outputs:
+            selector.register(stream, selectors.EVENT_READ)
+        while selector.get_map():
+            for key, _ in selector.select():
+                name, output, decoder = outputs[key.fileobj]
+                data = os.read(key.fd, 65536)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                output.Append(data)
+                if on_output is None:
+                    continue
+                text = decoder.decode(data, final=not data)
+                if not text:
+                    continue
+                try:
+                    on_output(name, text)
+                except Exception:
+                    logging.exception("Output handler failed")
+    return outputs[process.stdout][1].GetValue(), \
+           outputs[process.stderr][1].GetValue()
+
+def RunProcess(args, cancellation=None, on_output=None):
     start = time.time()
-    logging.info("Running %s", args)
-    process = subprocess.Popen(
-            args, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-    out, err = process.communicate()
+    trace_start = trace.Now()
+    with _AcquireJobSlot():
+        started = time.time()
+        _job_slot_wait.Observe(started - start)
+        if started - start > 0.01:
+            logging.info("Waited %.3f s for a job slot", started - start)
+            trace.AddSpan("JobSlotWait", trace_start, category="queue")
+        trace_started = trace.Now()
+        if cancellation is not None and cancellation.IsCancelled():
+            logging.info("Not running %s, cancelled", args)
+            return -signal.SIGTERM, b"", b"Cancelled"
+        logging.info("Running %s", args)
+        process = subprocess.Popen(
+                args, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        if cancellation is not None:
+            cancellation.RegisterProcess(process)
+        try:
+            out, err = _StreamProcessOutput(process, on_output)
+            result = process.wait()
+        finally:
+            if cancellation is not None:
+                cancellation.UnregisterProcess(process)
     if out:
-        logging.info("Output '%s'", out.decode())
+        logging.info("Output '%s'", out.decode(errors="replace"))
     if err:
-        logging.info("Error '%s'", err.decode())
-    result = process.wait()
-    logging.info("Result %s, execution time %.3f s.", result, time.time()-start)
+        logging.info("Error '%s'", err.decode(errors="replace"))
+    logging.info("Result %s, execution time %.3f s.", result, time.time()-started)
+    program = os.path.basename(args[0])
+    trace.AddSpan(program, trace_started, category="process",
+                  command=" ".join(args), result=result)
+    if cancellation is not None and cancellation.IsCancelled():
+        status = "cancelled"
+    else:
+        status = "ok" if result == 0 else "failed"
+    _processes.Inc(program=program, status=status)
+    _process_duration.Observe(time.time() - started, program=program)
     return result, out, err
 
 class FuncCall(object):
@@ -31,24 +172,170 @@ class FuncCall(object):
         all_args = args_str if not kwargs_str else args_str+", "+kwargs_str
         return "%s(%s)" % (func_name, all_args)
 
-def memoize(log=False):
-    cache = {}
+class MemoizeStats(object):
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+
+    def Copy(self):
+        stats = MemoizeStats(self.max_size, self.ttl)
+        stats.hits = self.hits
+        stats.misses = self.misses
+        stats.evictions = self.evictions
+        stats.size = self.size
+        return stats
+
+    def __repr__(self):
+        return "MemoizeStats(hits=%d, misses=%d, evictions=%d, size=%d)" % (
+            self.hits, self.misses, self.evictions, self.size)
+
+# Memoized function -> (name, MemoizeStats). Functions with the same
+# qualified name, e.g. local ones, get numbered names, functions that are
+# not referenced anymore are dropped.
+_memoize_registry = weakref.WeakKeyDictionary()
+_memoize_registry_lock = threading.Lock()
+
+def _RegisterMemoized(wrapper, name, stats):
+    with _memoize_registry_lock:
+        names = set(name for name, _ in _memoize_registry.values())
+        unique_name = name
+        index = 2
+        while unique_name in names:
+            unique_name = "%s#%d" % (name, index)
+            index += 1
+        _memoize_registry[wrapper] = (unique_name, stats)
+
+def GetMemoizeStats():
+    with _memoize_registry_lock:
+        registered = list(_memoize_registry.values())
+    return {name: stats.Copy() for name, stats in registered}
+
+_memoize_hits = metrics.registry.Counter(
+        "ni_memoize_hits_total", "Memoized calls served from the cache",
+        ["function"])
+_memoize_misses = metrics.registry.Counter(
+        "ni_memoize_misses_total", "Memoized calls that were computed",
+        ["function"])
+_memoize_evictions = metrics.registry.Counter(
+        "ni_memoize_evictions_total", "Memoized values evicted", ["function"])
+_memoize_size = metrics.registry.Gauge(
+        "ni_memoize_entries", "Values held by a memoized function",
+        ["function"])
+
+def _UpdateMemoizeMetrics():
+    for function, stats in GetMemoizeStats().items():
+        _memoize_hits.Set(stats.hits, function=function)
+        _memoize_misses.Set(stats.misses, function=function)
+        _memoize_evictions.Set(stats.evictions, function=function)
+        _memoize_size.Set(stats.size, function=function)
+
+metrics.registry.AddCollector(_UpdateMemoizeMetrics)
+
+def memoize(log=False, max_size=None, ttl=None, per_instance=False):
+    # per_instance keeps a separate cache for each value of the first
+    # argument, which is only weakly referenced
     def memoize_callable(func):
+        stats = MemoizeStats(max_size, ttl)
+        lock = threading.Lock()
+        if per_instance:
+            caches = weakref.WeakKeyDictionary()
+        else:
+            shared_cache = collections.OrderedDict()
+
+        def GetCache(args, create):
+            if not per_instance:
+                return shared_cache, args
+            cache = caches.get(args[0])
+            if cache is None and create:
+                cache = collections.OrderedDict()
+                caches[args[0]] = cache
+            return cache, args[1:]
+
+        def GetSize():
+            if per_instance:
+                return sum(len(cache) for cache in caches.values())
+            return len(shared_cache)
+
         def wrapper(*args, **kwargs):
-            args_tp = tuple(args)
-            kwargs_tp = tuple(sorted(kwargs.items()))
-            tp = (args_tp, kwargs_tp)
-            if tp in cache:
+            with lock:
+                cache, key_args = GetCache(args, True)
+                tp = (tuple(key_args), tuple(sorted(kwargs.items())))
+                entry = cache.get(tp)
+                if entry is not None and ttl is not None and (
+                        time.monotonic() - entry[0] > ttl):
+                    del cache[tp]
+                    stats.evictions += 1
+                    entry = None
+                if entry is not None:
+                    cache.move_to_end(tp)
+                    stats.hits += 1
+                else:
+                    stats.misses += 1
+            if entry is not None:
                 if log:
                     logging.info("Getting value of %s from cache", 
                             FuncCall(func, args, kwargs))
-                return cache[tp]
-            else:
-                if log:
-                    logging.info("Calling %s, not cached yet",
-                            FuncCall(func, args, kwargs))
-                result = func(*args, **kwargs)
-                cache[tp] = result
-                return result
+                return entry[1]
+            if log:
+                logging.info("Calling %s, not cached yet",
+                        FuncCall(func, args, kwargs))
+            result = func(*args, **kwargs)
+            with lock:
+                cache[tp] = (time.monotonic(), result)
+                cache.move_to_end(tp)
+                while max_size is not None and len(cache) > max_size:
+                    cache.popitem(last=False)
+                    stats.evictions += 1
+                stats.size = GetSize()
+            return result
+
+        def invalidate(*args, **kwargs):
+            with lock:
+                cache, key_args = GetCache(args, False)
+                if cache is not None:
+                    cache.pop((tuple(key_args), tuple(sorted(kwargs.items()))),
+                              None)
+                stats.size = GetSize()
+
+        def cache_clear():
+            with lock:
+                if per_instance:
+                    caches.clear()
+                else:
+                    shared_cache.clear()
+                stats.size = 0
+
+        def cache_info():
+            with lock:
+                stats.size = GetSize()
+                return stats.Copy()
+
+        wrapper = functools.wraps(func)(wrapper)
+        wrapper.invalidate = invalidate
+        wrapper.cache_clear = cache_clear
+        wrapper.cache_info = cache_info
+        _RegisterMemoized(wrapper,
+                "%s.%s" % (func.__module__, func.__qualname__), stats)
         return wrapper
     return memoize_callable
+
+def WriteFileAtomically(path, data):
+    dir_name = os.path.dirname(path)
+    if dir_name and not os.path.exists(dir_name):
+        os.makedirs(dir_name, exist_ok=True)
+    tmp_path = "%s.tmp.%d.%d" % (path, os.getpid(), threading.get_ident())
+    mode = "wb" if isinstance(data, bytes) else "w"
+    try:
+        with open(tmp_path, mode) as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
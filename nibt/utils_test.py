@@ -0,0 +1,109 @@
+import gc
+import time
+import unittest
+
+from nibt import utils
+
+class Counter(object):
+    def __init__(self):
+        self.calls = 0
+
+    @utils.memoize(per_instance=True)
+    def Get(self, value):
+        self.calls += 1
+        return value * 2
+
+class RunProcessTest(unittest.TestCase):
+    def testOutputIsStreamed(self):
+        chunks = []
+        result, out, err = utils.RunProcess(
+                ["sh", "-c", "echo out; echo err >&2; exit 3"],
+                on_output=lambda name, text: chunks.append((name, text)))
+        self.assertEqual(3, result)
+        self.assertEqual(b"out\n", out)
+        self.assertEqual(b"err\n", err)
+        self.assertIn(("stdout", "out\n"), chunks)
+        self.assertIn(("stderr", "err\n"), chunks)
+
+    def testKeptOutputIsBounded(self):
+        output = utils.BoundedOutput(limit=4)
+        output.Append(b"abc")
+        output.Append(b"def")
+        self.assertEqual(b"abcd\n[2 more bytes truncated]\n", output.GetValue())
+
+class MemoizeTest(unittest.TestCase):
+    def testLeastRecentlyUsedIsEvicted(self):
+        calls = []
+        @utils.memoize(max_size=2)
+        def Square(x):
+            calls.append(x)
+            return x * x
+        Square(1)
+        Square(2)
+        Square(1)
+        Square(3)
+        Square(1)
+        Square(2)
+        self.assertEqual([1, 2, 3, 2], calls)
+        info = Square.cache_info()
+        self.assertEqual((2, 4, 2, 2),
+                (info.hits, info.misses, info.evictions, info.size))
+
+    def testExpiredEntryIsRecomputed(self):
+        calls = []
+        @utils.memoize(ttl=0.05)
+        def Get(x):
+            calls.append(x)
+            return x
+        Get(1)
+        Get(1)
+        time.sleep(0.1)
+        Get(1)
+        self.assertEqual([1, 1], calls)
+
+    def testInvalidate(self):
+        calls = []
+        @utils.memoize()
+        def Get(x):
+            calls.append(x)
+            return x
+        Get(1)
+        Get.invalidate(1)
+        Get(1)
+        Get.cache_clear()
+        Get(1)
+        self.assertEqual([1, 1, 1], calls)
+
+    def testPerInstanceCacheDoesNotKeepInstances(self):
+        first, second = Counter(), Counter()
+        self.assertEqual(2, first.Get(1))
+        self.assertEqual(2, first.Get(1))
+        self.assertEqual(2, second.Get(1))
+        self.assertEqual((1, 1), (first.calls, second.calls))
+        del first, second
+        gc.collect()
+        self.assertEqual(0, Counter.Get.cache_info().size)
+        self.assertIn("nibt.utils_test.Counter.Get", utils.GetMemoizeStats())
+
+    def testSameNamedFunctionsHaveOwnStats(self):
+        def Create(offset):
+            @utils.memoize()
+            def Add(x):
+                return x + offset
+            return Add
+        first, second = Create(1), Create(2)
+        first(1)
+        second(1)
+        second(1)
+
+        name = "%s.%s" % (first.__module__, first.__qualname__)
+        stats = utils.GetMemoizeStats()
+        self.assertEqual([(0, 1), (1, 1)], sorted(
+                (stats[key].hits, stats[key].misses)
+                for key in (name, name + "#2")))
+        info = second.cache_info()
+        second(1)
+        self.assertEqual(1, info.hits)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,40 +8,96 @@ from aiohttp import web
 import os.path
 import mimetypes
 import threading
+import time
 
+import collections
 import json
+import zlib
+
+from nibt import common, metrics
+
+_syncs = metrics.registry.Counter(
+        "ni_websocket_syncs_total",
+        "Streams sent to WebSocket clients that connected or fell behind, "
+        "as a snapshot or as the missed events", ["kind"])
+
+# Events of all streams are sent to the clients in batches, every client
+# has a bounded queue and gets the events it missed, or a snapshot when
+# they are not kept anymore, instead of the events it was too slow to
+# receive
+BATCH_INTERVAL = 0.02
+MAX_PENDING_MESSAGES = 10000
+MAX_CLIENT_FRAMES = 100
+MAX_CLIENT_BYTES = 8 * 1024 * 1024
+# Clients that do not read anything for this long are disconnected
+CLIENT_STALL_TIMEOUT = 30
+TRANSPORT_HIGH_WATER_BYTES = 256 * 1024
+# Events kept per stream for clients that resume from a version
+MAX_HISTORY_EVENTS = 2000
+# Frames of at least this size are sent deflated to clients that accept it,
+# aiohttp does not negotiate permessage-deflate
+COMPRESS_MIN_BYTES = 64 * 1024
 
 class WebSocketStateEmitter(object):
+    # Every event gets the next version of the stream. A snapshot has the
+    # version of the last event before it was taken and may already reflect
+    # the events after it, so events must be safe to apply twice.
+
     def __init__(self, stream_id):
         self.stream_id = stream_id
-        self.websockets = set()
-        self.websockets_lock = threading.RLock()
+        self.publisher = None
+        self.lock = threading.Lock()
+        self.version = 0
+        self.history = collections.deque(maxlen=MAX_HISTORY_EVENTS)
+        self._snapshot = None
 
-    def RegisterWebSocket(self, ws):
-        with self.websockets_lock:
-            self.websockets.add(ws)
-            msg = {
-                "sid": self.stream_id,
-                "type": "init",
-                "data": self.GetInitialStateDict()
-            }
-            msg_str = json.dumps(msg)
-            ws.send_str(msg_str)
+    def SetPublisher(self, publisher):
+        self.publisher = publisher
 
-    def UnregisterWebSocket(self, ws):
-        with self.websockets_lock:
-            self.websockets.remove(ws)
-    
-    def EmitEvent(self, event):
-        msg = {
+    def GetSnapshot(self):
+        # Init message and its JSON, reused until the next event
+        with self.lock:
+            version = self.version
+            if self._snapshot is not None and self._snapshot[0] == version:
+                return self._snapshot[1], self._snapshot[2]
+        message = {
             "sid": self.stream_id,
-            "type": "event",
-            "data": event
+            "type": "init",
+            "version": version,
+            "data": self.GetInitialStateDict()
         }
-        msg_str = json.dumps(msg) 
-        with self.websockets_lock:
-            for ws in self.websockets:
-                ws.send_str(msg_str)
+        message_json = json.dumps(message)
+        with self.lock:
+            self._snapshot = (version, message, message_json)
+        return message, message_json
+
+    def GetEventsSince(self, version):
+        # None when some of the events are not kept anymore
+        with self.lock:
+            if version > self.version:
+                return None
+            if self.history:
+                oldest = self.history[0]["version"]
+            else:
+                oldest = self.version + 1
+            if version + 1 < oldest:
+                return None
+            return [message for message in self.history
+                    if message["version"] > version]
+
+    def EmitEvent(self, event):
+        # Called from any thread, the event is sent by the web UI loop
+        with self.lock:
+            self.version += 1
+            message = {
+                "sid": self.stream_id,
+                "type": "event",
+                "version": self.version,
+                "data": event
+            }
+            self.history.append(message)
+            if self.publisher is not None:
+                self.publisher(message)
 
     def GetInitialStateDict(self):
         return {}
@@ -86,6 +142,7 @@ class BuildProcessStateEmitter(WebSocketStateEmitter):
         self.builder = builder
         self.builder.AddBuildStartHandler(self.OnBuildStarted)
         self.builder.AddBuildFinishHandler(self.OnBuildFinished)
+        self.builder.AddBuildOutputHandler(self.OnBuildOutput)
 
     def OnBuildStarted(self, target_name):
         self.EmitEvent({
@@ -93,6 +150,14 @@ class BuildProcessStateEmitter(WebSocketStateEmitter):
             "target_name": target_name
         })
 
+    def OnBuildOutput(self, target_name, stream_name, text):
+        self.EmitEvent({
+            "action": "output",
+            "target_name": target_name,
+            "stream": stream_name,
+            "data": text
+        })
+
     def OnBuildFinished(self, target_name, result):
         msg = {
             "action": "finished",
@@ -101,6 +166,8 @@ class BuildProcessStateEmitter(WebSocketStateEmitter):
         if len(result)==1:
             if result[0].ok():
                 msg["result"]="ok"
+            elif isinstance(result[0], common.CancelledBuildResult):
+                msg["result"]="cancelled"
             else:
                 msg["result"]="failed"
                 msg["error"]=result[0].GetErrorMessage()
@@ -109,16 +176,222 @@ class BuildProcessStateEmitter(WebSocketStateEmitter):
             msg["error"]="Unsupported number of results: %s" % (len(result),)
         self.EmitEvent(msg)
 
+class Frame(object):
+    def __init__(self, text, versions):
+        self.text = text
+        # Stream id -> last version in the frame
+        self.versions = versions
+        self._compressed = None
+
+    def GetCompressed(self):
+        if self._compressed is None:
+            self._compressed = zlib.compress(self.text.encode())
+        return self._compressed
+
+def _GetVersions(messages):
+    versions = {}
+    for message in messages:
+        versions[message["sid"]] = max(
+                message["version"], versions.get(message["sid"], 0))
+    return versions
+
+class WebSocketClient(object):
+    def __init__(self, ws, transport, peername, versions, compress):
+        self.ws = ws
+        self.transport = transport
+        self.peername = peername
+        # Stream id -> last version sent to the client
+        self.versions = versions
+        self.compress = compress
+        self.frames = collections.deque()
+        self.queued_bytes = 0
+        # Starts with the streams changed since the versions it resumes from
+        self.resync = True
+        self.closed = False
+        self.wakeup = asyncio.Event()
+
+    def Enqueue(self, frame):
+        if self.resync:
+            return
+        if (len(self.frames) >= MAX_CLIENT_FRAMES or
+                self.queued_bytes + len(frame.text) > MAX_CLIENT_BYTES):
+            logging.warning("WebSocket client %s is too slow, resyncing",
+                            self.peername)
+            self.Resync()
+            return
+        self.frames.append(frame)
+        self.queued_bytes += len(frame.text)
+        self.wakeup.set()
+
+    def Resync(self):
+        self.frames.clear()
+        self.queued_bytes = 0
+        self.resync = True
+        self.wakeup.set()
+
+    def IsWriteBufferFull(self):
+        return (self.transport.get_write_buffer_size() >
+                TRANSPORT_HIGH_WATER_BYTES)
+
+def _CoalesceMessages(messages):
+    # Consecutive output chunks of a target and stream are sent as one
+    # event, the messages are copied as they are also kept in the stream
+    # history
+    result = []
+    for message in messages:
+        data = message["data"]
+        if result and message["type"] == "event" and data.get("action") == "output":
+            last = result[-1]
+            if (last["sid"] == message["sid"] and last["type"] == "event" and
+                    last["data"].get("action") == "output" and
+                    last["data"]["target_name"] == data["target_name"] and
+                    last["data"].get("stream") == data.get("stream")):
+                result[-1] = dict(last, version=message["version"], data=dict(
+                    last["data"], data=last["data"]["data"] + data["data"]))
+                continue
+        result.append(message)
+    return result
+
 class WebUIServer(object):
     
-    def __init__(self, emitters):
+    def __init__(self, emitters, trace_store):
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
         self.app = web.Application()
         self.app.router.add_route("GET", "/ws", self.WebSocket)
+        self.app.router.add_route("GET", "/metrics", self.Metrics)
+        self.app.router.add_route("GET", "/traces", self.ListTraces)
+        self.app.router.add_route("GET", r"/traces/{trace_id:\d+}", self.GetTrace)
         self.app.router.add_route("GET", r"/{path:.*}", self.ServeResources)
-        self.websockets = set()
+        self.clients = set()
+        # Versions of a previous daemon are not resumed
+        self.epoch = int(time.time() * 1000)
         self.emitters = emitters
+        self.trace_store = trace_store
+        self._pending_lock = threading.Lock()
+        self._pending = []
+        self._flush_scheduled = False
+        self._overflow = False
+        for emitter in self.emitters:
+            emitter.SetPublisher(self.Publish)
+
+    def Publish(self, message):
+        # Called from any thread
+        if not self.clients:
+            return
+        with self._pending_lock:
+            if len(self._pending) >= MAX_PENDING_MESSAGES:
+                self._overflow = True
+                return
+            self._pending.append(message)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self.loop.call_soon_threadsafe(
+                self.loop.call_later, BATCH_INTERVAL, self._Flush)
+
+    def _Flush(self):
+        with self._pending_lock:
+            messages = self._pending
+            overflow = self._overflow
+            self._pending = []
+            self._overflow = False
+            self._flush_scheduled = False
+        if overflow:
+            logging.warning("Too many events, resyncing WebSocket clients")
+            for client in self.clients:
+                client.Resync()
+            return
+        if not messages:
+            return
+        messages = _CoalesceMessages(messages)
+        frame = self._MakeFrame([json.dumps(message) for message in messages],
+                                _GetVersions(messages))
+        for client in self.clients:
+            client.Enqueue(frame)
+
+    def _MakeFrame(self, messages_json, versions):
+        return Frame('{"type": "batch", "epoch": %d, "messages": [%s]}' % (
+            self.epoch, ", ".join(messages_json)), versions)
+
+    def _GetSyncFrame(self, client):
+        # Snapshots are serialized once and shared by all clients
+        messages_json = []
+        versions = {}
+        for emitter in self.emitters:
+            events = None
+            if emitter.stream_id in client.versions:
+                events = emitter.GetEventsSince(client.versions[emitter.stream_id])
+            if events is None:
+                _syncs.Inc(kind="snapshot")
+                message, message_json = emitter.GetSnapshot()
+                messages_json.append(message_json)
+                versions[emitter.stream_id] = message["version"]
+            else:
+                _syncs.Inc(kind="events")
+                events = _CoalesceMessages(events)
+                messages_json.extend(json.dumps(event) for event in events)
+                versions.update(_GetVersions(events))
+        return self._MakeFrame(messages_json, versions)
+
+    def _SendFrame(self, client, frame):
+        if all(version <= client.versions.get(stream_id, -1)
+               for stream_id, version in frame.versions.items()):
+            # Already sent as part of a resync
+            return
+        if client.compress and len(frame.text) >= COMPRESS_MIN_BYTES:
+            client.ws.send_bytes(frame.GetCompressed())
+        else:
+            client.ws.send_str(frame.text)
+        for stream_id, version in frame.versions.items():
+            client.versions[stream_id] = max(
+                    version, client.versions.get(stream_id, version))
+
+    def _CloseClient(self, client):
+        self.clients.discard(client)
+        client.closed = True
+        client.wakeup.set()
+        try:
+            client.ws.close()
+        except Exception:
+            logging.exception("Unable to close WebSocket client %s",
+                              client.peername)
+
+    @asyncio.coroutine
+    def _SendFrames(self, client):
+        try:
+            yield from self._SendClientFrames(client)
+        except Exception:
+            logging.exception("Unable to send to WebSocket client %s",
+                              client.peername)
+            self._CloseClient(client)
+
+    @asyncio.coroutine
+    def _SendClientFrames(self, client):
+        stalled_since = None
+        while not client.closed:
+            if not client.frames and not client.resync:
+                yield from client.wakeup.wait()
+                client.wakeup.clear()
+                continue
+            if client.IsWriteBufferFull():
+                if stalled_since is None:
+                    stalled_since = time.time()
+                elif time.time() - stalled_since > CLIENT_STALL_TIMEOUT:
+                    logging.warning("WebSocket client %s is stalled, closing",
+                                    client.peername)
+                    self._CloseClient(client)
+                    return
+                yield from asyncio.sleep(BATCH_INTERVAL)
+                continue
+            stalled_since = None
+            if client.resync:
+                client.resync = False
+                frame = self._GetSyncFrame(client)
+            else:
+                frame = client.frames.popleft()
+                client.queued_bytes -= len(frame.text)
+            self._SendFrame(client, frame)
 
     def Run(self):
         host = "127.0.0.1"
@@ -136,6 +409,22 @@ class WebUIServer(object):
         thread = threading.Thread(target=self.Run, daemon=True)
         thread.start()
  
+    def _GetResumeVersions(self, request):
+        # /ws?epoch=<epoch>&<stream id>=<last version>...
+        versions = {}
+        try:
+            if int(request.GET.get("epoch", "0")) != self.epoch:
+                return versions
+            for emitter in self.emitters:
+                if emitter.stream_id in request.GET:
+                    versions[emitter.stream_id] = int(
+                            request.GET[emitter.stream_id])
+        except ValueError:
+            logging.warning("Invalid WebSocket resume parameters %s",
+                            request.GET)
+            return {}
+        return versions
+
     @asyncio.coroutine
     def WebSocket(self, request):
         peername = request.transport.get_extra_info('peername') 
@@ -143,8 +432,11 @@ class WebUIServer(object):
         logging.info("WebSocket client connected: %s", peername)
         ws.start(request)
         
-        for emitter in self.emitters:
-            emitter.RegisterWebSocket(ws)
+        client = WebSocketClient(ws, request.transport, peername,
+                                 self._GetResumeVersions(request),
+                                 request.GET.get("compress") == "deflate")
+        self.clients.add(client)
+        self.loop.create_task(self._SendFrames(client))
 
         while True:
             try:
@@ -153,10 +445,38 @@ class WebUIServer(object):
                     ws.close()
             except aiohttp.errors.WSClientDisconnectedError as exc:
                 logging.info("WebSocket client disconnected: %s", peername)
-                for emitter in self.emitters:
-                    emitter.UnregisterWebSocket(ws)
+                self.clients.discard(client)
+                client.closed = True
+                client.wakeup.set()
                 return ws
 
+    @asyncio.coroutine
+    def Metrics(self, request):
+        return web.Response(
+            body=metrics.registry.Expose().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4"})
+
+    @asyncio.coroutine
+    def ListTraces(self, request):
+        return web.Response(
+            body=json.dumps(self.trace_store.GetTraceList()).encode(),
+            headers={"Content-Type": "application/json"})
+
+    @asyncio.coroutine
+    def GetTrace(self, request):
+        trace_id = int(request.match_info["trace_id"])
+        trace = self.trace_store.GetTrace(trace_id)
+        if trace is None:
+            return web.Response(status=404,
+                                body=("No trace %d" % trace_id).encode())
+        return web.Response(
+            body=json.dumps(trace).encode(),
+            headers={
+                "Content-Type": "application/json",
+                "Content-Disposition":
+                    "attachment; filename=trace-%d.json" % trace_id,
+            })
+
     @asyncio.coroutine
     def ServeResources(self, request):
         path = request.match_info["path"]
@@ -0,0 +1,144 @@
+import json
+import unittest
+import zlib
+
+try:
+    from nibt import web
+except (ImportError, AttributeError):
+    # aiohttp is missing or needs an older asyncio
+    web = None
+
+def OutputEvent(version, target_name, text, stream="stdout"):
+    return {"sid": "build", "type": "event", "version": version,
+            "data": {"action": "output", "target_name": target_name,
+                     "stream": stream, "data": text}}
+
+class FakeWebSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_str(self, text):
+        self.sent.append(text)
+
+    def send_bytes(self, data):
+        self.sent.append(data)
+
+    def close(self):
+        pass
+
+class FakeTransport(object):
+    def get_write_buffer_size(self):
+        return 0
+
+class FakeRequest(object):
+    def __init__(self, query):
+        self.GET = query
+
+@unittest.skipIf(web is None, "aiohttp is not available")
+class WebUIServerTest(unittest.TestCase):
+    def setUp(self):
+        self.emitter = web.WebSocketStateEmitter("build")
+        self.server = web.WebUIServer([self.emitter], None)
+
+    def tearDown(self):
+        self.server.loop.close()
+
+    def _AddClient(self, versions=None):
+        client = web.WebSocketClient(FakeWebSocket(), FakeTransport(),
+                                     "client", versions or {}, False)
+        client.resync = False
+        self.server.clients.add(client)
+        return client
+
+    def testCoalesceMessagesMergesOutputOfSameStream(self):
+        history = [OutputEvent(1, "a", "x"), OutputEvent(2, "a", "y"),
+                   OutputEvent(3, "a", "z", stream="stderr"),
+                   OutputEvent(4, "b", "w")]
+        messages = web._CoalesceMessages(history)
+
+        self.assertEqual([("xy", 2), ("z", 3), ("w", 4)],
+                         [(m["data"]["data"], m["version"]) for m in messages])
+        # History messages are not changed
+        self.assertEqual("x", history[0]["data"]["data"])
+
+    def testEnqueueOverflowResyncs(self):
+        client = self._AddClient()
+        for i in range(web.MAX_CLIENT_FRAMES):
+            client.Enqueue(web.Frame("{}", {"build": i + 1}))
+        self.assertEqual(web.MAX_CLIENT_FRAMES, len(client.frames))
+
+        client.Enqueue(web.Frame("{}", {"build": web.MAX_CLIENT_FRAMES + 1}))
+        self.assertTrue(client.resync)
+        self.assertEqual(0, len(client.frames))
+        self.assertEqual(0, client.queued_bytes)
+        # Nothing is queued until the resync frame is sent
+        client.Enqueue(web.Frame("{}", {"build": web.MAX_CLIENT_FRAMES + 2}))
+        self.assertEqual(0, len(client.frames))
+
+    def testFlushSendsPendingEventsAsOneFrame(self):
+        clients = [self._AddClient(), self._AddClient()]
+        self.emitter.EmitEvent({"action": "started", "target_name": "a"})
+        self.emitter.EmitEvent({"action": "output", "target_name": "a",
+                                "stream": "stdout", "data": "x"})
+        self.emitter.EmitEvent({"action": "output", "target_name": "a",
+                                "stream": "stdout", "data": "y"})
+        self.server._Flush()
+
+        for client in clients:
+            self.assertEqual(1, len(client.frames))
+        frame = clients[0].frames[0]
+        self.assertIs(frame, clients[1].frames[0])
+        self.assertEqual({"build": 3}, frame.versions)
+        batch = json.loads(frame.text)
+        self.assertEqual(self.server.epoch, batch["epoch"])
+        self.assertEqual(["started", "output"],
+                         [m["data"]["action"] for m in batch["messages"]])
+        self.assertEqual("xy", batch["messages"][1]["data"]["data"])
+
+        self.server._Flush()
+        self.assertEqual(1, len(clients[0].frames))
+
+    def testResumeFromDroppedVersionSendsSnapshot(self):
+        for _ in range(web.MAX_HISTORY_EVENTS + 5):
+            self.emitter.EmitEvent({"action": "started", "target_name": "a"})
+        self.assertIsNone(self.emitter.GetEventsSince(2))
+        self.assertEqual(5, len(self.emitter.GetEventsSince(
+                web.MAX_HISTORY_EVENTS)))
+
+        client = self._AddClient({"build": 2})
+        batch = json.loads(self.server._GetSyncFrame(client).text)
+        self.assertEqual(["init"], [m["type"] for m in batch["messages"]])
+        self.assertEqual(web.MAX_HISTORY_EVENTS + 5,
+                         batch["messages"][0]["version"])
+
+    def testResumeFromOtherEpochIsIgnored(self):
+        epoch = str(self.server.epoch)
+        self.assertEqual({"build": 3}, self.server._GetResumeVersions(
+                FakeRequest({"epoch": epoch, "build": "3"})))
+        self.assertEqual({}, self.server._GetResumeVersions(
+                FakeRequest({"epoch": epoch + "1", "build": "3"})))
+        self.assertEqual({}, self.server._GetResumeVersions(
+                FakeRequest({"build": "3"})))
+
+    def testFramesAlreadySentAreSkipped(self):
+        client = self._AddClient({"build": 5})
+        self.server._SendFrame(client, web.Frame("old", {"build": 4}))
+        self.server._SendFrame(client, web.Frame("same", {"build": 5}))
+        self.assertEqual([], client.ws.sent)
+
+        self.server._SendFrame(client, web.Frame("new", {"build": 6}))
+        self.assertEqual(["new"], client.ws.sent)
+        self.assertEqual({"build": 6}, client.versions)
+
+    def testCompressedFrameRoundTrip(self):
+        text = json.dumps({"data": "x" * web.COMPRESS_MIN_BYTES})
+        frame = web.Frame(text, {"build": 1})
+        self.assertEqual(text, zlib.decompress(frame.GetCompressed()).decode())
+
+        client = self._AddClient()
+        client.compress = True
+        self.server._SendFrame(client, frame)
+        self.assertEqual(text, zlib.decompress(client.ws.sent[0]).decode())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,340 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+
+from nibt import utils
+
+# Compile workers receive preprocessed sources and return object files.
+# Every message is a 4 byte big endian length, a JSON header of that length
+# and header["size"] bytes of payload. Workers run whatever flags they are
+# sent, so they must only listen on trusted networks.
+
+MAX_HEADER_SIZE = 1024 * 1024
+MAX_PAYLOAD_SIZE = 1024 * 1024 * 1024
+
+# Seconds a worker is not used after a connection failure
+RETRY_DELAY = 30
+
+class WorkerError(Exception):
+    pass
+
+def ParseAddress(address):
+    kind, _, location = address.partition(":")
+    if kind == "unix":
+        return socket.AF_UNIX, location
+    elif kind == "tcp":
+        host, _, port = location.rpartition(":")
+        return socket.AF_INET, (host, int(port))
+    raise ValueError("Unsupported worker address '%s'" % address)
+
+def SendMessage(sock, header, payload=b""):
+    header = dict(header, size=len(payload))
+    data = json.dumps(header).encode()
+    sock.sendall(struct.pack("!I", len(data)) + data)
+    if payload:
+        sock.sendall(payload)
+
+def _ReceiveExactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def ReceiveMessage(sock):
+    header_size, = struct.unpack("!I", _ReceiveExactly(sock, 4))
+    if header_size > MAX_HEADER_SIZE:
+        raise ConnectionError("Header of %d bytes is too large" % header_size)
+    header = json.loads(_ReceiveExactly(sock, header_size).decode())
+    if header.get("size", 0) > MAX_PAYLOAD_SIZE:
+        raise ConnectionError("Payload of %d bytes is too large" % header["size"])
+    return header, _ReceiveExactly(sock, header.get("size", 0))
+
+
+class WorkerState(object):
+    def __init__(self, compiler, jobs):
+        self.compiler = compiler
+        self.jobs = jobs
+        self.slots = threading.Semaphore(jobs)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+
+    def GetStats(self):
+        with self.lock:
+            return {
+                "jobs": self.jobs,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+            }
+
+    def Compile(self, header, source):
+        with self.lock:
+            self.queued += 1
+        with self.slots:
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                return self._RunCompiler(header, source)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+
+    def _RunCompiler(self, header, source):
+        work_dir = tempfile.mkdtemp(prefix="niw-")
+        try:
+            source_file = os.path.join(work_dir, "source" + header["suffix"])
+            object_file = os.path.join(work_dir, "source.o")
+            with open(source_file, "wb") as f:
+                f.write(source)
+            args = [self.compiler]
+            args.extend(header["args"])
+            args.extend(["-c", source_file, "-o", object_file])
+            result, _, err = utils.RunProcess(args)
+            object_data = b""
+            if result == 0:
+                with open(object_file, "rb") as f:
+                    object_data = f.read()
+            return result, err, object_data
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+class WorkerRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        state = self.server.worker_state
+        while True:
+            try:
+                header, payload = ReceiveMessage(self.request)
+            except (ConnectionError, OSError, ValueError):
+                return
+            if header.get("type") == "compile":
+                result, err, object_data = state.Compile(header, payload)
+                response = {
+                    "type": "result",
+                    "returncode": result,
+                    "stderr": err.decode(errors="replace"),
+                }
+                response.update(state.GetStats())
+                SendMessage(self.request, response, object_data)
+            elif header.get("type") == "stats":
+                response = {"type": "stats"}
+                response.update(state.GetStats())
+                SendMessage(self.request, response)
+            else:
+                SendMessage(self.request, {
+                    "type": "error",
+                    "message": "Unknown request %s" % header.get("type"),
+                })
+
+
+class ThreadingTCPWorkerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class ThreadingUnixWorkerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+def CreateServer(address, worker_state):
+    family, location = ParseAddress(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(location):
+            os.remove(location)
+        server = ThreadingUnixWorkerServer(location, WorkerRequestHandler)
+    else:
+        server = ThreadingTCPWorkerServer(location, WorkerRequestHandler)
+    server.worker_state = worker_state
+    return server
+
+
+# Arguments that only matter for preprocessing or name inputs and outputs,
+# they are not sent along with the preprocessed source
+LOCAL_ARGS_WITH_VALUE = set([
+    "-I", "-D", "-U", "-include", "-include-pch", "-isystem", "-iquote",
+    "-MF", "-MT", "-MQ", "-o", "-x"])
+LOCAL_FLAGS = set(["-c", "-E", "-MD", "-MMD", "-M", "-MM", "-MP"])
+# Arguments whose value is forwarded to the worker
+REMOTE_ARGS_WITH_VALUE = set(["-Xclang", "-target", "-arch", "-mllvm"])
+
+def GetRemoteArgs(args):
+    # Drops the compiler, local only arguments and inputs
+    remote_args = []
+    args = iter(args[1:])
+    for arg in args:
+        if arg in LOCAL_ARGS_WITH_VALUE:
+            next(args, None)
+        elif arg in REMOTE_ARGS_WITH_VALUE:
+            remote_args.extend([arg, next(args, "")])
+        elif arg in LOCAL_FLAGS or arg.startswith(("-I", "-D", "-U")):
+            pass
+        elif arg.startswith("-"):
+            remote_args.append(arg)
+    return remote_args
+
+
+class WorkerStats(object):
+    def __init__(self, address):
+        self.address = address
+        self.jobs = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.busy_time = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.queue_depth = 0
+        self.unavailable_until = 0
+
+    def GetThroughput(self):
+        if not self.busy_time:
+            return 0.0
+        return self.jobs / self.busy_time
+
+    def __repr__(self):
+        return ("%s: %d jobs, %d failures, %.2f jobs/s, queue depth %d, "
+                "%d in flight" % (self.address, self.jobs, self.failures,
+                    self.GetThroughput(), self.queue_depth, self.in_flight))
+
+
+class WorkerPool(object):
+    def __init__(self, configuration):
+        addresses = configuration.Get("workers", "addresses",
+                raise_exception=False, default="")
+        self.jobs_per_worker = int(configuration.Get(
+            "workers", "jobs_per_worker", raise_exception=False, default="4"))
+        self.timeout = float(configuration.Get(
+            "workers", "timeout_s", raise_exception=False, default="300"))
+        self._lock = threading.Lock()
+        self._workers = [WorkerStats(address) for address in addresses.split()]
+        self._connections = {address: [] for address in addresses.split()}
+
+    def IsEnabled(self):
+        return bool(self._workers)
+
+    def GetStats(self):
+        with self._lock:
+            return list(self._workers)
+
+    def Acquire(self):
+        # Least loaded available worker, None when all of them are busy so
+        # that the caller compiles locally instead of waiting
+        now = time.time()
+        with self._lock:
+            available = [worker for worker in self._workers
+                         if worker.unavailable_until <= now and
+                            worker.in_flight < self.jobs_per_worker]
+            if not available:
+                return None
+            worker = min(available, key=lambda w: (w.in_flight, w.queue_depth))
+            worker.in_flight += 1
+            return worker
+
+    def Release(self, worker):
+        with self._lock:
+            worker.in_flight -= 1
+
+    def _TakePooledConnection(self, worker):
+        with self._lock:
+            if self._connections[worker.address]:
+                return self._connections[worker.address].pop()
+        return None
+
+    def _Connect(self, worker):
+        family, location = ParseAddress(worker.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(location)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _Request(self, sock, header, payload):
+        try:
+            SendMessage(sock, header, payload)
+            return ReceiveMessage(sock)
+        except Exception:
+            sock.close()
+            raise
+
+    def _RequestPooled(self, worker, header, payload):
+        # Pooled connections may have been closed by the worker while they
+        # were idle, such a request is retried once on a new connection
+        sock = self._TakePooledConnection(worker)
+        if sock is not None:
+            try:
+                return sock, self._Request(sock, header, payload)
+            except socket.timeout:
+                raise
+            except (OSError, ValueError) as e:
+                logging.info("Pooled connection to %s failed: %s, "
+                             "reconnecting", worker.address, e)
+        sock = self._Connect(worker)
+        return sock, self._Request(sock, header, payload)
+
+    def Compile(self, worker, args, source, suffix):
+        started = time.time()
+        try:
+            sock, (header, object_data) = self._RequestPooled(worker, {
+                "type": "compile",
+                "args": args,
+                "suffix": suffix,
+            }, source)
+        except (OSError, ValueError) as e:
+            logging.warning("Worker %s failed: %s", worker.address, e)
+            with self._lock:
+                worker.failures += 1
+                worker.unavailable_until = time.time() + RETRY_DELAY
+            raise WorkerError("Worker %s failed: %s" % (worker.address, e))
+        with self._lock:
+            self._connections[worker.address].append(sock)
+            worker.jobs += 1
+            worker.busy_time += time.time() - started
+            worker.bytes_sent += len(source)
+            worker.bytes_received += len(object_data)
+            worker.queue_depth = header.get("queued", 0)
+        if header.get("type") != "result":
+            raise WorkerError("Worker %s: %s" % (
+                worker.address, header.get("message")))
+        return header["returncode"], object_data, header["stderr"].encode()
+
+
+def Main():
+    parser = argparse.ArgumentParser(
+            description="Compiles preprocessed sources for ni")
+    parser.add_argument("--listen", nargs="+", default=["tcp:127.0.0.1:7878"],
+                        help="tcp:host:port or unix:path addresses")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--compiler", default="clang++")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    state = WorkerState(args.compiler, args.jobs)
+    servers = [CreateServer(address, state) for address in args.listen]
+    for address, server in zip(args.listen, servers):
+        logging.info("Worker listening on %s with %d jobs", address, args.jobs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        logging.info("Interrupted, shutting down...")
+    for server in servers:
+        server.shutdown()
+
+if __name__ == '__main__':
+    Main()
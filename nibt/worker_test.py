@@ -0,0 +1,118 @@
+import concurrent.futures
+import os
+import shutil
+import socket
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+
+from nibt import worker
+
+FAKE_COMPILER = """#!%s
+import sys
+args = sys.argv[1:]
+with open(args[args.index("-c") + 1], "rb") as f:
+    source = f.read()
+if b"error" in source:
+    sys.stderr.write("fake error\\n")
+    sys.exit(1)
+with open(args[args.index("-o") + 1], "wb") as f:
+    f.write(b"object " + " ".join(args[:args.index("-c")]).encode() + b" " + source)
+"""
+
+class FakeConfiguration(object):
+    def __init__(self, values):
+        self.values = values
+
+    def Get(self, section, key, raise_exception=True, default=None):
+        return self.values.get(key, default)
+
+class WorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        compiler = os.path.join(self.temp_dir, "fake-compiler")
+        with open(compiler, "w") as f:
+            f.write(FAKE_COMPILER % sys.executable)
+        os.chmod(compiler, stat.S_IRWXU)
+        self.addresses = ["tcp:127.0.0.1:0",
+                          "unix:" + os.path.join(self.temp_dir, "worker.sock")]
+        self.servers = []
+        for i, address in enumerate(self.addresses):
+            server = worker.CreateServer(address, worker.WorkerState(compiler, 2))
+            if address.startswith("tcp:"):
+                self.addresses[i] = "tcp:127.0.0.1:%d" % server.server_address[1]
+            threading.Thread(target=server.serve_forever, args=(0.05,),
+                             daemon=True).start()
+            self.servers.append(server)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def CreatePool(self, addresses):
+        return worker.WorkerPool(FakeConfiguration({
+            "addresses": " ".join(addresses),
+            "jobs_per_worker": "2",
+        }))
+
+    def Compile(self, pool, source):
+        compile_worker = pool.Acquire()
+        if compile_worker is None:
+            return None
+        try:
+            return pool.Compile(compile_worker, ["-O2"], source, ".ii")
+        finally:
+            pool.Release(compile_worker)
+
+    def testJobsAreSpreadAcrossWorkers(self):
+        pool = self.CreatePool(self.addresses)
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(
+                lambda i: self.Compile(pool, b"source %d" % i), range(20)))
+        compiled = [result for result in results if result is not None]
+        self.assertTrue(compiled)
+        for result, object_data, _ in compiled:
+            self.assertEqual(0, result)
+            self.assertTrue(object_data.startswith(b"object -O2 source "))
+        stats = pool.GetStats()
+        self.assertEqual(len(compiled), sum(w.jobs for w in stats))
+        self.assertTrue(all(w.jobs > 0 for w in stats))
+        self.assertTrue(all(w.in_flight == 0 for w in stats))
+
+    def testCompilationErrorIsReturned(self):
+        result, object_data, err = self.Compile(
+                self.CreatePool(self.addresses[:1]), b"error")
+        self.assertEqual(1, result)
+        self.assertEqual(b"", object_data)
+        self.assertEqual(b"fake error\n", err)
+
+    def testUnavailableWorkerIsSkipped(self):
+        pool = self.CreatePool(["unix:" + os.path.join(self.temp_dir, "none")])
+        with self.assertRaises(worker.WorkerError):
+            self.Compile(pool, b"source")
+        self.assertIsNone(pool.Acquire())
+
+    def testClosedPooledConnectionIsReplaced(self):
+        pool = self.CreatePool(self.addresses[:1])
+        self.Compile(pool, b"first")
+        pool._connections[self.addresses[0]][0].shutdown(socket.SHUT_RDWR)
+
+        result, object_data, _ = self.Compile(pool, b"second")
+        self.assertEqual(0, result)
+        self.assertTrue(object_data.endswith(b"second"))
+        self.assertEqual(0, pool.GetStats()[0].failures)
+        self.assertIsNotNone(pool.Acquire())
+
+    def testPreprocessorArgumentsAreNotSent(self):
+        self.assertEqual(["-O2", "-std=c++11", "-Xclang", "-v"],
+                worker.GetRemoteArgs([
+                    "clang++", "-O2", "-I/include", "-I", "/include2",
+                    "-DX=1", "-std=c++11", "-include", "pch.h", "-Xclang", "-v",
+                    "-c", "a.cc", "-o", "a.o", "-MD", "-MF", "a.o.d"]))
+
+if __name__ == '__main__':
+    unittest.main()
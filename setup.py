@@ -11,6 +11,7 @@ setup(name='ni',
         'console_scripts': [
             'ni = nibt.client:Main',
             'nid = nibt.server:Main',
+            'niw = nibt.worker:Main',
         ]
     },
     package_data = {